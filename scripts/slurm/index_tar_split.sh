@@ -0,0 +1,17 @@
+#!/bin/bash
+#SBATCH -J index_tar            # Job name
+#SBATCH -p cpu-farm               # Partition name
+#SBATCH --qos=normal      # Quality of Service
+#SBATCH --nodes=1                 # Number of nodes
+#SBATCH --ntasks-per-node=1       # Number of tasks (processes) per node
+#SBATCH --cpus-per-task=2         # Number of CPU cores per task
+#SBATCH -o logs/%x_%j.log         # Standard output file path
+
+# Builds data_viscot/cot_images_tar_split/cot_images.index.tsv so load_ds.py / load_gqa_filtered.py
+# read images straight from the cot_images_* parts; replaces unzip_tar_split.sh
+
+echo "Working directory: $(pwd)"
+
+python src/utils/tar_index.py data_viscot/cot_images_tar_split
+
+echo "Done"
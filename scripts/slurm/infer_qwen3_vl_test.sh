@@ -51,10 +51,10 @@ if [ $SERVER_READY -eq 0 ]; then
 fi
 
 echo "VLLM is ready. Running inference script..."
-uv run python src/infer/vlm/qwen3vl.py --model "$MODEL" --port 10630 --output_dir "output" --system_prompt_path "configs/prompts/think_first_v0.txt" --dataset_name "ohjoonhee/Visual-CoT-4k" --split "train"
-uv run python src/infer/vlm/qwen3vl.py --model "$MODEL" --port 10630 --output_dir "output" --system_prompt_path "configs/prompts/think_first_v0.txt" --dataset_name "DreamMr/HR-Bench" --split "hrbench_4k"
-uv run python src/infer/vlm/qwen3vl.py --model "$MODEL" --port 10630 --output_dir "output" --system_prompt_path "configs/prompts/think_first_v0.txt" --dataset_name "DreamMr/HR-Bench" --split "hrbench_8k"
-uv run python src/infer/vlm/qwen3vl.py --model "$MODEL" --port 10630 --output_dir "output" --system_prompt_path "configs/prompts/think_first_v0.txt" --dataset_name "jonathan-roberts1/zerobench" --split "zerobench" --question_column "question_text" --image_column "question_images_decoded"
+uv run python src/infer/vlm/qwen3vl.py --model "$MODEL" --port 10630 --output_dir "output" --system_prompt_path "configs/prompts/think_first_v0.txt" --max_concurrency 64 --dataset_name "ohjoonhee/Visual-CoT-4k" --split "train"
+uv run python src/infer/vlm/qwen3vl.py --model "$MODEL" --port 10630 --output_dir "output" --system_prompt_path "configs/prompts/think_first_v0.txt" --max_concurrency 64 --dataset_name "DreamMr/HR-Bench" --split "hrbench_4k"
+uv run python src/infer/vlm/qwen3vl.py --model "$MODEL" --port 10630 --output_dir "output" --system_prompt_path "configs/prompts/think_first_v0.txt" --max_concurrency 64 --dataset_name "DreamMr/HR-Bench" --split "hrbench_8k"
+uv run python src/infer/vlm/qwen3vl.py --model "$MODEL" --port 10630 --output_dir "output" --system_prompt_path "configs/prompts/think_first_v0.txt" --max_concurrency 64 --dataset_name "jonathan-roberts1/zerobench" --split "zerobench" --question_column "question_text" --image_column "question_images_decoded"
 
 
 echo "Inference complete. Stopping VLLM server (PID: $VLLM_PID)..."
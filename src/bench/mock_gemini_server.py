@@ -0,0 +1,105 @@
+"""
+Local stand-in for the Gemini ``generateContent`` API used by ``gemini.py`` and ``gemini_refine.py``.
+
+The google-genai client is pointed at it with ``GOOGLE_GEMINI_BASE_URL``:
+
+    python src/bench/mock_gemini_server.py --port 18100 --latency_ms 1500 --latency_sigma 0.4 --tokens_per_s 120
+    GOOGLE_GEMINI_BASE_URL=http://localhost:18100 GOOGLE_API_KEY=mock python src/gemini_refine.py
+"""
+
+import re
+import json
+import time
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from mock_latency import LatencyModel, add_latency_arguments, pad_reply
+
+# Gemini bills a fixed number of tokens per image at default resolution
+IMAGE_TOKENS = 258
+
+
+class MockGeminiState:
+    def __init__(self, reply=None, behaviour=None, reply_tokens=0):
+        self.reply = reply
+        self.behaviour = behaviour or LatencyModel()
+        self.reply_tokens = reply_tokens
+
+    def generate(self, model: str, body: dict) -> dict:
+        parts = [part for content in body.get("contents", []) for part in content.get("parts", [])]
+        texts = [part["text"] for part in parts if "text" in part]
+        images = sum(1 for part in parts if "inlineData" in part or "inline_data" in part)
+        text = pad_reply(self.reply if self.reply is not None else (texts[-1][-200:] if texts else ""), self.reply_tokens)
+        thinking = "thinkingConfig" in body.get("generationConfig", {})
+        reply_parts = ([{"text": "mock thought summary", "thought": True}] if thinking else []) + [{"text": text}]
+        prompt_tokens = sum(len(t) // 4 for t in texts) + IMAGE_TOKENS * images
+        completion_tokens = len(text) // 4
+        thoughts_tokens = 64 if thinking else 0
+        return {
+            "candidates": [{"content": {"role": "model", "parts": reply_parts}, "finishReason": "STOP", "index": 0}],
+            "usageMetadata": {
+                "promptTokenCount": prompt_tokens,
+                "candidatesTokenCount": completion_tokens,
+                "thoughtsTokenCount": thoughts_tokens,
+                "totalTokenCount": prompt_tokens + completion_tokens + thoughts_tokens,
+            },
+            "modelVersion": model,
+        }
+
+
+def make_handler(state: MockGeminiState):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, payload, status=200, headers=None):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _send_error(self, status, message, reason):
+            self._send_json({"error": {"code": status, "message": message, "status": reason}}, status=status, headers={"retry-after": str(state.behaviour.retry_after)} if status == 429 else None)
+
+        def do_GET(self):
+            if self.path == "/mock/stats":
+                return self._send_json(state.behaviour.stats())
+            self._send_error(404, f"Not found: {self.path}", "NOT_FOUND")
+
+        def do_POST(self):
+            match = re.fullmatch(r"/v1\w*/models/([^:/]+):generateContent(\?.*)?", self.path)
+            if not match:
+                return self._send_error(404, f"Not found: {self.path}", "NOT_FOUND")
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            status = state.behaviour.admit()
+            if status == 429:
+                return self._send_error(429, "Resource has been exhausted (e.g. check quota).", "RESOURCE_EXHAUSTED")
+            if status:
+                return self._send_error(status, "An internal error has occurred.", "INTERNAL")
+            response = state.generate(match.group(1), body)
+            time.sleep(state.behaviour.first_token_delay() + state.behaviour.token_delay(response["usageMetadata"]["candidatesTokenCount"]))
+            self._send_json(response)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a mock Gemini generateContent API.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind.")
+    parser.add_argument("--port", type=int, default=18100, help="Port to bind.")
+    parser.add_argument("--reply", type=str, default=None, help="Fixed reply content. Defaults to echoing the end of the prompt.")
+    add_latency_arguments(parser)
+    args = parser.parse_args()
+
+    state = MockGeminiState(reply=args.reply, behaviour=LatencyModel.from_args(args), reply_tokens=args.reply_tokens)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    print(f"Mock Gemini server listening on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Server-side behaviour shared by the mock API servers: a latency distribution, token throughput,
+429 rate limiting and injected failures, plus counters the benchmark reads back from ``/mock/stats``.
+"""
+
+import math
+import time
+import random
+import threading
+from collections import Counter, deque
+from typing import Optional
+
+
+class LatencyModel:
+    """
+    Time to first token is log-normal around ``latency_ms`` (``latency_sigma`` = 0 makes it fixed);
+    the rest of the reply takes ``completion_tokens / tokens_per_s``. Requests beyond ``rate_limit_rpm``
+    in a sliding minute, plus a random ``rate_limit_rate`` fraction, get a 429 with ``retry_after``;
+    a random ``failure_rate`` fraction gets a 500.
+    """
+
+    def __init__(self, latency_ms=0.0, latency_sigma=0.0, tokens_per_s=0.0, rate_limit_rpm=0, rate_limit_rate=0.0, failure_rate=0.0, retry_after=1.0, seed=None):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.tokens_per_s = tokens_per_s
+        self.rate_limit_rpm = rate_limit_rpm
+        self.rate_limit_rate = rate_limit_rate
+        self.failure_rate = failure_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.window = deque()
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_args(cls, args) -> "LatencyModel":
+        return cls(
+            latency_ms=args.latency_ms,
+            latency_sigma=args.latency_sigma,
+            tokens_per_s=args.tokens_per_s,
+            rate_limit_rpm=args.rate_limit_rpm,
+            rate_limit_rate=args.rate_limit_rate,
+            failure_rate=args.failure_rate,
+            retry_after=args.retry_after,
+            seed=args.seed,
+        )
+
+    def admit(self) -> Optional[int]:
+        """
+        None if the request is served, otherwise the error status to answer with.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.counts["requests"] += 1
+            while self.window and now - self.window[0] > 60:
+                self.window.popleft()
+            if (self.rate_limit_rpm and len(self.window) >= self.rate_limit_rpm) or self.random.random() < self.rate_limit_rate:
+                self.counts["rate_limited"] += 1
+                return 429
+            if self.random.random() < self.failure_rate:
+                self.counts["failed"] += 1
+                return 500
+            self.window.append(now)
+            self.counts["served"] += 1
+            return None
+
+    def first_token_delay(self) -> float:
+        if not self.latency_ms:
+            return 0.0
+        with self.lock:
+            noise = self.random.gauss(0.0, self.latency_sigma) if self.latency_sigma else 0.0
+        return self.latency_ms / 1000 * math.exp(noise)
+
+    def token_delay(self, tokens: int) -> float:
+        return tokens / self.tokens_per_s if self.tokens_per_s else 0.0
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self.lock:
+            self.counts[name] += amount
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.counts)
+
+
+def add_latency_arguments(parser) -> None:
+    parser.add_argument("--latency_ms", type=float, default=0.0, help="Median time to first token in milliseconds.")
+    parser.add_argument("--latency_sigma", type=float, default=0.0, help="Sigma of the log-normal time to first token (0 makes it fixed).")
+    parser.add_argument("--tokens_per_s", type=float, default=0.0, help="Decode speed per request after the first token (0 returns the whole reply at once).")
+    parser.add_argument("--reply_tokens", type=int, default=0, help="Pad replies to roughly this many completion tokens.")
+    parser.add_argument("--rate_limit_rpm", type=int, default=0, help="Answer 429 beyond this many requests in a sliding minute (0 disables).")
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0, help="Fraction of requests answered with a random 429.")
+    parser.add_argument("--failure_rate", type=float, default=0.0, help="Fraction of requests answered with a 500.")
+    parser.add_argument("--retry_after", type=float, default=1.0, help="Retry-After seconds sent with 429 responses.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the latency and failure draws.")
+
+
+def pad_reply(text: str, reply_tokens: int) -> str:
+    """
+    ``text`` padded with filler words to about ``reply_tokens`` tokens at 4 characters per token.
+    """
+    missing = reply_tokens * 4 - len(text)
+    return text + " lorem" * (missing // 6) if missing > 0 else text
@@ -0,0 +1,207 @@
+"""
+Local stand-in for the OpenAI-compatible endpoints used by this repo.
+
+Implements chat completions (including ``stream=True``) plus the files and batches endpoints, so
+the online and ``--mode batch`` paths can be exercised without spending API quota:
+
+    python src/bench/mock_openai_server.py --port 18000 --latency_ms 800 --latency_sigma 0.5 --tokens_per_s 60 --rate_limit_rpm 600
+    OPENAI_BASE_URL=http://localhost:18000/v1 OPENAI_API_KEY=mock python src/llm_judge.py --mode batch --poll_interval 1
+"""
+
+import re
+import json
+import time
+import uuid
+import argparse
+import threading
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from mock_latency import LatencyModel, add_latency_arguments, pad_reply
+
+
+class MockState:
+    def __init__(self, reply=None, batch_delay=1.0, behaviour=None, reply_tokens=0):
+        self.reply = reply
+        self.batch_delay = batch_delay
+        self.behaviour = behaviour or LatencyModel()
+        self.reply_tokens = reply_tokens
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    def add_file(self, data: bytes, filename: str, purpose: str) -> dict:
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        meta = {"id": file_id, "object": "file", "bytes": len(data), "created_at": int(time.time()), "filename": filename, "purpose": purpose, "status": "processed"}
+        with self.lock:
+            self.files[file_id] = (meta, data)
+        return meta
+
+    def completion(self, body: dict) -> dict:
+        last = body["messages"][-1]["content"]
+        if isinstance(last, list):
+            last = " ".join(part.get("text", "") for part in last if part.get("type") == "text")
+        contents = [pad_reply(self.reply if self.reply is not None else f"<think>mock reasoning {i}</think>{last[-200:]}", self.reply_tokens) for i in range(body.get("n") or 1)]
+        prompt_tokens = sum(len(json.dumps(m["content"])) // 4 for m in body["messages"])
+        completion_tokens = sum(len(content) // 4 for content in contents)
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{"index": i, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"} for i, content in enumerate(contents)],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    def create_batch(self, body: dict) -> dict:
+        batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+        batch = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": body["endpoint"],
+            "input_file_id": body["input_file_id"],
+            "completion_window": body.get("completion_window", "24h"),
+            "status": "validating",
+            "created_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        with self.lock:
+            self.batches[batch_id] = batch
+        threading.Thread(target=self._run_batch, args=(batch_id,), daemon=True).start()
+        return batch
+
+    def _run_batch(self, batch_id: str) -> None:
+        batch = self.batches[batch_id]
+        _, data = self.files[batch["input_file_id"]]
+        lines = [json.loads(line) for line in data.decode("utf-8").splitlines() if line.strip()]
+        batch["request_counts"]["total"] = len(lines)
+        batch["status"] = "in_progress"
+        time.sleep(self.batch_delay)
+
+        outputs = []
+        for item in lines:
+            outputs.append({"id": f"batch_req_{uuid.uuid4().hex[:24]}", "custom_id": item["custom_id"], "response": {"status_code": 200, "body": self.completion(item["body"])}, "error": None})
+            batch["request_counts"]["completed"] += 1
+        output = "".join(json.dumps(o) + "\n" for o in outputs).encode("utf-8")
+        batch["output_file_id"] = self.add_file(output, f"{batch_id}_output.jsonl", "batch_output")["id"]
+        batch["status"] = "completed"
+
+
+def make_handler(state: MockState):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, payload, status=200, headers=None):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _send_stream(self, completion, include_usage):
+            # Server-sent events like vLLM's: a role delta, then one delta of about a token (4 characters)
+            # per decoding step, interleaved across choices, then usage. A client that disconnects
+            # cancels the rest, as vLLM aborts the request.
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            base = {key: completion[key] for key in ("id", "created", "model")}
+            contents = [choice["message"]["content"] for choice in completion["choices"]]
+            steps = [[{"index": i, "delta": {"role": "assistant", "content": ""}, "finish_reason": None} for i in range(len(contents))]]
+            for start in range(0, max(len(content) for content in contents), 4):
+                steps.append([{"index": i, "delta": {"content": content[start : start + 4]}, "finish_reason": None} for i, content in enumerate(contents) if start < len(content)])
+            steps.append([{"index": i, "delta": {}, "finish_reason": "stop"} for i in range(len(contents))])
+            time.sleep(state.behaviour.first_token_delay())
+            sent_tokens = 0
+            try:
+                for step in steps:
+                    time.sleep(state.behaviour.token_delay(1))
+                    for event in step:
+                        self.wfile.write(f"data: {json.dumps({**base, 'object': 'chat.completion.chunk', 'choices': [event]})}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                    sent_tokens += len(step)
+                if include_usage:
+                    self.wfile.write(f"data: {json.dumps({**base, 'object': 'chat.completion.chunk', 'choices': [], 'usage': completion['usage']})}\n\n".encode("utf-8"))
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                state.behaviour.count("cancelled")
+            state.behaviour.count("streamed_tokens", sent_tokens)
+            self.close_connection = True
+
+        def _body(self) -> bytes:
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def do_GET(self):
+            if self.path == "/mock/stats":
+                return self._send_json(state.behaviour.stats())
+            if self.path in ("/health", "/v1/models"):
+                return self._send_json({"object": "list", "data": [{"id": "mock", "object": "model"}]})
+            match = re.fullmatch(r"/v1/files/([\w-]+)/content", self.path)
+            if match and match.group(1) in state.files:
+                _, data = state.files[match.group(1)]
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+            match = re.fullmatch(r"/v1/files/([\w-]+)", self.path)
+            if match and match.group(1) in state.files:
+                return self._send_json(state.files[match.group(1)][0])
+            match = re.fullmatch(r"/v1/batches/([\w-]+)", self.path)
+            if match and match.group(1) in state.batches:
+                return self._send_json(state.batches[match.group(1)])
+            self._send_json({"error": {"message": f"Not found: {self.path}"}}, status=404)
+
+        def do_POST(self):
+            if self.path == "/v1/chat/completions":
+                body = json.loads(self._body())
+                status = state.behaviour.admit()
+                if status == 429:
+                    return self._send_json({"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}, status=429, headers={"retry-after": str(state.behaviour.retry_after)})
+                if status:
+                    return self._send_json({"error": {"message": "The server had an error while processing your request", "type": "server_error"}}, status=status)
+                completion = state.completion(body)
+                if body.get("stream"):
+                    return self._send_stream(completion, (body.get("stream_options") or {}).get("include_usage", False))
+                time.sleep(state.behaviour.first_token_delay() + state.behaviour.token_delay(completion["usage"]["completion_tokens"]))
+                return self._send_json(completion)
+            if self.path == "/v1/batches":
+                return self._send_json(state.create_batch(json.loads(self._body())))
+            if self.path == "/v1/files":
+                header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8")
+                message = BytesParser(policy=default_policy).parsebytes(header + self._body())
+                fields = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+                upload = fields["file"]
+                purpose = fields["purpose"].get_content().strip() if "purpose" in fields else "batch"
+                return self._send_json(state.add_file(upload.get_payload(decode=True), upload.get_filename() or "upload.jsonl", purpose))
+            self._send_json({"error": {"message": f"Not found: {self.path}"}}, status=404)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a mock OpenAI-compatible API (chat completions, files, batches).")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind.")
+    parser.add_argument("--port", type=int, default=18000, help="Port to bind.")
+    parser.add_argument("--reply", type=str, default=None, help="Fixed reply content. Defaults to echoing the end of the prompt.")
+    parser.add_argument("--batch_delay", type=float, default=1.0, help="Seconds a batch stays in progress before completing.")
+    add_latency_arguments(parser)
+    args = parser.parse_args()
+
+    state = MockState(reply=args.reply, batch_delay=args.batch_delay, behaviour=LatencyModel.from_args(args), reply_tokens=args.reply_tokens)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    print(f"Mock OpenAI server listening on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
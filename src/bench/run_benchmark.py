@@ -0,0 +1,263 @@
+"""
+Offline throughput benchmark for the inference, refine and judge entry points.
+
+Starts the mock OpenAI-compatible and Gemini servers with the requested latency / rate-limit /
+failure behaviour, runs each entry point as a subprocess over synthetic inputs, and reports
+samples/s, CPU time per sample and peak RSS (from ``wait4``, so only the entry point is measured).
+With ``--baseline`` the run fails when any entry point regresses beyond ``--tolerance``:
+
+    python src/bench/run_benchmark.py --num_samples 500 --latency_ms 300 --latency_sigma 0.5 --output bench.json
+    python src/bench/run_benchmark.py --num_samples 500 --latency_ms 300 --latency_sigma 0.5 --baseline bench.json
+"""
+
+import os
+import ast
+import sys
+import json
+import glob
+import time
+import shlex
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+
+from mock_latency import add_latency_arguments
+from synthetic_data import make_image_dataset, make_predictions_jsonl
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.dirname(BENCH_DIR)
+REPO_ROOT = os.path.dirname(SRC_DIR)
+
+# entry point -> (script, mock server it talks to, input kind)
+ENTRY_POINTS = {
+    "qwen3vl": ("infer/vlm/qwen3vl.py", "openai", "images"),
+    "gemini": ("infer/vlm/gemini.py", "gemini", "images"),
+    "llm_refine": ("llm_refine.py", "openai", "predictions"),
+    "gemini_refine": ("gemini_refine.py", "gemini", "predictions"),
+    "llm_judge": ("llm_judge.py", "openai", "predictions"),
+}
+LATENCY_OPTIONS = ["latency_ms", "latency_sigma", "tokens_per_s", "reply_tokens", "rate_limit_rpm", "rate_limit_rate", "failure_rate", "retry_after", "seed"]
+# Higher is better for samples/s, lower for the rest
+COMPARED_METRICS = {"samples_per_s": 1, "cpu_ms_per_sample": -1, "peak_rss_mb": -1}
+
+
+def module_constant(script: str, name: str) -> str:
+    """
+    A string constant of an entry point, read without importing it (imports have side effects).
+    """
+    with open(os.path.join(SRC_DIR, script), "r") as f:
+        for node in ast.parse(f.read()).body:
+            if isinstance(node, ast.Assign) and any(isinstance(target, ast.Name) and target.id == name for target in node.targets):
+                return ast.literal_eval(node.value)
+    raise KeyError(f"{name} not found in {script}")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(script: str, port: int, args, log_path: str) -> subprocess.Popen:
+    command = [sys.executable, os.path.join(BENCH_DIR, script), "--port", str(port)]
+    for option in LATENCY_OPTIONS:
+        value = getattr(args, option)
+        if value is not None:
+            command += [f"--{option}", str(value)]
+    process = subprocess.Popen(command, stdout=open(log_path, "w"), stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            server_stats(port)
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError(f"{script} exited with {process.returncode}; see {log_path}")
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"{script} did not come up on port {port}")
+
+
+def server_stats(port: int) -> dict:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/mock/stats", timeout=5) as response:
+        return json.loads(response.read())
+
+
+def count_completed(path: str) -> int:
+    completed = 0
+    for file in glob.glob(path):
+        with open(file, "r") as f:
+            for line in f:
+                if line.strip() and "error" not in json.loads(line):
+                    completed += 1
+    return completed
+
+
+def entry_point_command(name: str, args, workdir: str, ports: dict):
+    """
+    ``(command, output glob)`` for one entry point; refine/judge scripts read and write their module-level paths under ``workdir``.
+    """
+    script, _, kind = ENTRY_POINTS[name]
+    command = [sys.executable, os.path.join(SRC_DIR, script)]
+    if kind == "images":
+        output_dir = os.path.join(workdir, "out", name)
+        shutil.rmtree(output_dir, ignore_errors=True)
+        command += ["--output_dir", output_dir, "--dataset_name", os.path.join(workdir, "data", "images"), "--image_cache", ""]
+        if name == "qwen3vl":
+            command += ["--port", str(ports["openai"]), "--model", "mock-vlm", "--max_concurrency", str(args.concurrency)]
+        return command + args.extra_args.get(name, []), os.path.join(output_dir, "*_results.jsonl")
+
+    input_file = os.path.join(workdir, module_constant(script, "INPUT_FILE"))
+    output_file = os.path.join(workdir, module_constant(script, "OUTPUT_FILE"))
+    os.makedirs(os.path.dirname(input_file), exist_ok=True)
+    shutil.copyfile(os.path.join(workdir, "data", "predictions.jsonl"), input_file)
+    for stale in glob.glob(output_file + "*"):
+        os.remove(stale)
+    return command + args.extra_args.get(name, []), output_file
+
+
+def run_entry_point(name: str, args, workdir: str, ports: dict) -> dict:
+    command, output = entry_point_command(name, args, workdir, ports)
+    env = dict(
+        os.environ,
+        OPENAI_BASE_URL=f"http://127.0.0.1:{ports['openai']}/v1",
+        OPENAI_API_KEY="mock",
+        GOOGLE_GEMINI_BASE_URL=f"http://127.0.0.1:{ports['gemini']}",
+        GOOGLE_API_KEY="mock",
+        RESPONSE_CACHE="",
+        MAX_CONCURRENCY=str(args.concurrency),
+        REQUESTS_PER_MINUTE=str(args.client_rpm),
+        TOKENS_PER_MINUTE=str(args.client_tpm),
+    )
+    env.pop("GEMINI_API_KEY", None)
+    port = ports[ENTRY_POINTS[name][1]]
+    before = server_stats(port)
+    log_path = os.path.join(workdir, f"{name}.log")
+
+    print(f"[{name}] {shlex.join(command)}")
+    start = time.monotonic()
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+    wall = time.monotonic() - start
+    returncode = os.waitstatus_to_exitcode(status)
+    if returncode != 0:
+        print(f"[{name}] exited with {returncode}; see {log_path}")
+
+    after = server_stats(port)
+    completed = count_completed(output)
+    cpu = usage.ru_utime + usage.ru_stime
+    return {
+        "entry_point": name,
+        "samples": args.num_samples,
+        "completed": completed,
+        "wall_s": wall,
+        "samples_per_s": completed / wall if wall else 0.0,
+        "cpu_s": cpu,
+        "cpu_ms_per_sample": cpu / completed * 1000 if completed else None,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": usage.ru_maxrss / 1024,
+        "requests": after.get("requests", 0) - before.get("requests", 0),
+        "rate_limited": after.get("rate_limited", 0) - before.get("rate_limited", 0),
+        "failed": after.get("failed", 0) - before.get("failed", 0),
+        "returncode": returncode,
+    }
+
+
+def report(results) -> None:
+    print(f"{'entry point':<14} {'done':>9} {'wall s':>8} {'samples/s':>10} {'cpu ms/smp':>10} {'rss MB':>8} {'requests':>8} {'429s':>6} {'5xx':>5}")
+    for r in results:
+        cpu = "-" if r["cpu_ms_per_sample"] is None else f"{r['cpu_ms_per_sample']:.1f}"
+        print(
+            f"{r['entry_point']:<14} {r['completed']:>4}/{r['samples']:<4} {r['wall_s']:>8.1f} {r['samples_per_s']:>10.2f} {cpu:>10} {r['peak_rss_mb']:>8.0f} "
+            f"{r['requests']:>8} {r['rate_limited']:>6} {r['failed']:>5}"
+        )
+
+
+def find_regressions(results, baseline, tolerance: float):
+    previous = {r["entry_point"]: r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        base = previous.get(r["entry_point"])
+        if base is None:
+            continue
+        if r["completed"] < base["completed"]:
+            regressions.append(f"{r['entry_point']}: completed {r['completed']} < baseline {base['completed']}")
+        for metric, direction in COMPARED_METRICS.items():
+            if r[metric] is None or not base.get(metric):
+                continue
+            change = (r[metric] - base[metric]) / base[metric] * direction
+            if change < -tolerance:
+                regressions.append(f"{r['entry_point']}: {metric} {r[metric]:.2f} vs baseline {base[metric]:.2f} ({-change:.0%} worse)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the entry points against local mock API servers.")
+    parser.add_argument("--entry_points", type=str, default=",".join(ENTRY_POINTS), help="Comma-separated entry points to run.")
+    parser.add_argument("--num_samples", type=int, default=200, help="Synthetic samples per entry point.")
+    parser.add_argument("--image_size", type=int, default=512, help="Side length of the synthetic images.")
+    parser.add_argument("--concurrency", type=int, default=64, help="max_concurrency / MAX_CONCURRENCY for the entry points.")
+    parser.add_argument("--client_rpm", type=float, default=1e9, help="REQUESTS_PER_MINUTE for the refine/judge limiters (default: effectively unpaced).")
+    parser.add_argument("--client_tpm", type=float, default=1e12, help="TOKENS_PER_MINUTE for the refine/judge limiters.")
+    parser.add_argument("--extra_args", type=json.loads, default={}, help='Extra CLI arguments per entry point as JSON, e.g. \'{"qwen3vl": ["--telemetry"]}\'.')
+    parser.add_argument("--workdir", type=str, default=None, help="Working directory for inputs, outputs and logs (default: a fresh temp dir).")
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON to this file.")
+    parser.add_argument("--baseline", type=str, default=None, help="Results JSON of an earlier run to compare against; exits 1 on regressions.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative slack before a metric counts as regressed.")
+    add_latency_arguments(parser)
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.entry_points.split(",") if name.strip()]
+    unknown = [name for name in names if name not in ENTRY_POINTS]
+    if unknown:
+        parser.error(f"unknown entry points: {unknown}; choose from {list(ENTRY_POINTS)}")
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="bench_"))
+    os.makedirs(workdir, exist_ok=True)
+    # The refine scripts load their prompt relative to the working directory
+    if not os.path.exists(os.path.join(workdir, "configs")):
+        os.symlink(os.path.join(REPO_ROOT, "configs"), os.path.join(workdir, "configs"))
+
+    print(f"Generating {args.num_samples} synthetic samples in {workdir}/data...")
+    if any(ENTRY_POINTS[name][2] == "images" for name in names):
+        make_image_dataset(os.path.join(workdir, "data", "images"), args.num_samples, args.image_size, seed=args.seed or 0)
+    make_predictions_jsonl(os.path.join(workdir, "data", "predictions.jsonl"), args.num_samples, seed=args.seed or 0)
+
+    ports = {"openai": free_port(), "gemini": free_port()}
+    servers = [
+        start_server("mock_openai_server.py", ports["openai"], args, os.path.join(workdir, "mock_openai_server.log")),
+        start_server("mock_gemini_server.py", ports["gemini"], args, os.path.join(workdir, "mock_gemini_server.log")),
+    ]
+    try:
+        results = [run_entry_point(name, args, workdir, ports) for name in names]
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+
+    report(results)
+    settings = {option: getattr(args, option) for option in LATENCY_OPTIONS + ["num_samples", "image_size", "concurrency"]}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"settings": settings, "results": results}, f, indent=2)
+        print(f"Wrote results to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        if baseline.get("settings") != settings:
+            print(f"Warning: baseline was recorded with different settings: {baseline.get('settings')}")
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Synthetic inputs for the benchmarks: an image/question dataset in the layout the inference
+scripts load, and a predictions JSONL in the layout the refine and judge scripts read.
+
+    python src/bench/synthetic_data.py --output_dir /tmp/bench_data --num_samples 1000 --image_size 768
+"""
+
+import os
+import json
+import random
+import argparse
+from io import BytesIO
+
+import numpy as np
+import datasets
+from PIL import Image
+
+ANSWERS = ["red", "blue", "two", "three", "left", "right", "yes", "no", "cat", "dog", "42", "7.5"]
+
+
+def synthetic_image(rng: np.random.Generator, size: int) -> bytes:
+    """
+    JPEG of a noisy gradient; plain noise would compress far worse than real photos.
+    """
+    gradient = np.linspace(0, 255, size, dtype=np.float32)
+    base = (gradient[None, :, None] + gradient[:, None, None] * rng.uniform(0.2, 1.0, size=3)) / 2
+    pixels = np.clip(base + rng.normal(0, 12, size=(size, size, 3)), 0, 255).astype(np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def make_image_dataset(output_dir: str, num_samples: int, image_size: int = 512, seed: int = 0) -> str:
+    """
+    Write ``num_samples`` rows of (image, question, answer) to ``output_dir/train.parquet``; the
+    directory loads with ``load_dataset(output_dir, split="train")``.
+    """
+    rng = np.random.default_rng(seed)
+    rows = {"image": [], "question": [], "answer": []}
+    for i in range(num_samples):
+        rows["image"].append({"bytes": synthetic_image(rng, image_size), "path": None})
+        rows["question"].append(f"Question {i}: what is shown in the highlighted region of the image?")
+        rows["answer"].append(ANSWERS[i % len(ANSWERS)])
+    features = datasets.Features({"image": datasets.Image(), "question": datasets.Value("string"), "answer": datasets.Value("string")})
+    os.makedirs(output_dir, exist_ok=True)
+    datasets.Dataset.from_dict(rows, features=features).to_parquet(os.path.join(output_dir, "train.parquet"))
+    return output_dir
+
+
+def make_predictions_jsonl(path: str, num_samples: int, reasoning_words: int = 300, seed: int = 0) -> str:
+    """
+    Records with ``prediction`` and ``refined_prediction``. Every other prediction states its answer
+    plainly so rule-based judging settles about half of them, as on real outputs.
+    """
+    rand = random.Random(seed)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(num_samples):
+            answer = ANSWERS[i % len(ANSWERS)]
+            reasoning = " ".join(rand.choice(["look", "region", "object", "color", "count", "near", "the", "so"]) for _ in range(reasoning_words))
+            final = f"The answer is {answer}." if i % 2 == 0 else f"It could plausibly be described as something close to {rand.choice(ANSWERS)}."
+            prediction = f"<think>{reasoning}</think>{final}"
+            record = {"sample_id": i, "question": f"Question {i}: what is shown in the highlighted region of the image?", "answer": answer, "prediction": prediction, "refined_prediction": prediction}
+            f.write(json.dumps(record) + "\n")
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic benchmark inputs.")
+    parser.add_argument("--output_dir", type=str, required=True, help="Directory for the dataset and predictions file.")
+    parser.add_argument("--num_samples", type=int, default=1000, help="Rows to generate.")
+    parser.add_argument("--image_size", type=int, default=512, help="Side length of the square images.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    args = parser.parse_args()
+
+    make_image_dataset(os.path.join(args.output_dir, "images"), args.num_samples, args.image_size, args.seed)
+    make_predictions_jsonl(os.path.join(args.output_dir, "predictions.jsonl"), args.num_samples, seed=args.seed)
+    print(f"Wrote {args.num_samples} synthetic samples to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,20 @@
-import json
 import os
-from openai import OpenAI
+import time
+import asyncio
+import argparse
 from google import genai
 from tqdm import tqdm
 import dotenv
 
+from utils.adaptive_concurrency import AIMDLimiter
+from utils.candidates import for_each_candidate
+from utils.concurrency import OrderedBuffer, bounded_map
+from utils.gemini_retry import generate_content_with_retry
+from utils.rate_limit import TokenBucketLimiter, estimate_tokens
+from utils.response_cache import ResponseCache, open_response_cache
+from utils.result_io import OUTPUT_FORMATS, ResultWriter, iter_records, resolve_input, with_format
+from utils.telemetry import open_telemetry, gemini_usage
+
 dotenv.load_dotenv()
 
 # Files
@@ -19,61 +29,128 @@ with open(REFINE_PROMPT_PATH, "r", encoding="utf-8") as f:
 MODEL = "gemini-3-flash-preview"
 # API_KEY = os.getenv("OPENAI_API_KEY", None)
 
-
-def refine_jsonl():
+# Rate limits of the project tier; requests are paced to stay just under them
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", 64))
+REQUESTS_PER_MINUTE = float(os.getenv("REQUESTS_PER_MINUTE", 1000))
+TOKENS_PER_MINUTE = float(os.getenv("TOKENS_PER_MINUTE", 1_000_000))
+# Retries per request on 429, deadline and server errors
+MAX_RETRIES = int(os.getenv("MAX_RETRIES", 8))
+
+
+async def refine_one(client, limiter, record, cache=None, telemetry=None, concurrency=None):
+    """
+    Add ``refined_prediction`` to a record, or ``error`` if the API call fails after ``MAX_RETRIES`` retries.
+    Multi-candidate records get one refinement per candidate.
+    Responses already in ``cache`` for the same model and rendered prompt are reused.
+    ``concurrency`` is an optional ``AIMDLimiter`` that backs off when the API reports overload.
+    """
+    if "candidates" in record:
+        return await for_each_candidate(
+            record, lambda view: refine_one(client, limiter, view, cache=cache, telemetry=telemetry, concurrency=concurrency), ["refined_prediction"]
+        )
+
+    prediction = record.get("prediction", "")
+
+    if not prediction:
+        # If no prediction, just write the record as is or skip?
+        # We'll write it through without refinement.
+        return record
+
+    prompt = REFINE_PROMPT.format(input=prediction)
+
+    key = ResponseCache.request_key(MODEL, prompt) if cache else None
+    cached = cache.get_text(key) if cache else None
+    if cached is not None:
+        record["refined_prediction"] = cached
+        return record
+
+    # The refined output is roughly as long as the prediction it rewrites
+    queued = time.monotonic()
+    estimated = await limiter.acquire(estimate_tokens(prompt) + estimate_tokens(prediction))
+
+    def on_error(error, started):
+        if telemetry:
+            telemetry.record("refine", MODEL, record.get("sample_id"), queue_wait_s=started - queued, latency_s=time.monotonic() - started, error=error)
+
+    try:
+        response, sent = await generate_content_with_retry(
+            client, MAX_RETRIES, limiter=concurrency, on_error=on_error, label=f"Refine {record.get('sample_id')}", model=MODEL, contents=prompt
+        )
+        usage = response.usage_metadata
+        limiter.settle(estimated, usage.total_token_count if usage else None)
+        if telemetry:
+            telemetry.record("refine", MODEL, record.get("sample_id"), queue_wait_s=sent - queued, latency_s=time.monotonic() - sent, **gemini_usage(usage))
+
+        refined_content = response.text
+        record["refined_prediction"] = refined_content
+        if cache and refined_content is not None:
+            cache.put_text(key, refined_content)
+
+    except Exception as e:
+        print(f"API call failed: {e}")
+        # We keep the record even if API fails, maybe mark it
+        record["error"] = str(e)
+
+    return record
+
+
+async def refine_record(client, limiter, record, cache=None, telemetry=None, concurrency=None):
+    """
+    Refine one input record. Returns the record to write, or None if it failed unexpectedly.
+    """
+    try:
+        return await refine_one(client, limiter, record, cache=cache, telemetry=telemetry, concurrency=concurrency)
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+    return None
+
+
+async def refine_records(client, records, output, cache=None, telemetry=None):
+    limiter = TokenBucketLimiter(requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE)
+    # The token bucket paces to the published quota; AIMD backs off further when requests still get throttled
+    concurrency = AIMDLimiter(initial=min(8, MAX_CONCURRENCY), maximum=MAX_CONCURRENCY)
+    # Responses arrive out of order; the buffer writes them back in input order
+    writer = OrderedBuffer(output.write)
+
+    with tqdm(desc="Processing records") as progress:
+        async for position, record in bounded_map(lambda record: refine_record(client, limiter, record, cache=cache, telemetry=telemetry, concurrency=concurrency), records, MAX_CONCURRENCY):
+            writer.put(position, record)
+            progress.update(1)
+
+
+def refine_jsonl(telemetry=False, metrics_port=None):
     client = genai.Client()
 
-    if not os.path.exists(INPUT_FILE):
+    input_file = resolve_input(INPUT_FILE)
+    if not os.path.exists(input_file):
         print(f"Input file not found: {INPUT_FILE}")
         return
 
     # Ensure output directory exists
     os.makedirs(os.path.dirname(OUTPUT_FILE), exist_ok=True)
 
-    print(f"Reading from {INPUT_FILE}...")
-    with open(INPUT_FILE, "r", encoding="utf-8") as infile, open(OUTPUT_FILE, "w", encoding="utf-8") as outfile:
-
-        for line in tqdm(infile, desc="Processing lines"):
-            line = line.strip()
-            if not line:
-                continue
-
-            try:
-                record = json.loads(line)
-                prediction = record.get("prediction", "")
-
-                if not prediction:
-                    # If no prediction, just write the record as is or skip?
-                    # We'll write it through without refinement.
-                    outfile.write(json.dumps(record) + "\n")
-                    continue
+    cache = open_response_cache()
+    telemetry = open_telemetry(OUTPUT_FILE, telemetry, metrics_port)
 
-                # Prepare the prompt for refinement
-                # messages = [
-                #     {"role": "user", "content": REFINE_PROMPT.format(input=prediction)},
-                # ]
+    print(f"Reading from {input_file}...")
+    with ResultWriter(OUTPUT_FILE, overwrite=True) as output:
+        asyncio.run(refine_records(client, iter_records(input_file), output, cache=cache, telemetry=telemetry))
 
-                try:
-                    # response = client.chat.completions.create(model=MODEL, messages=messages)
-                    response = client.models.generate_content(model=MODEL, contents=REFINE_PROMPT.format(input=prediction))
+    if cache:
+        cache.report()
+        cache.close()
 
-                    refined_content = response.text
-                    record["refined_prediction"] = refined_content
-
-                except Exception as e:
-                    print(f"API call failed: {e}")
-                    # We keep the record even if API fails, maybe mark it
-                    record["error"] = str(e)
-
-                outfile.write(json.dumps(record) + "\n")
-                outfile.flush()
-
-            except json.JSONDecodeError:
-                print(f"Failed to decode JSON: {line[:50]}...")
-            except Exception as e:
-                print(f"Unexpected error: {e}")
+    if telemetry:
+        telemetry.report()
+        telemetry.close()
 
 
 if __name__ == "__main__":
-
-    refine_jsonl()
+    parser = argparse.ArgumentParser(description="Refine model reasoning traces with Gemini.")
+    parser.add_argument("--telemetry", action="store_true", help="Record per-request latency/token metrics to a .metrics.jsonl sidecar next to the output.")
+    parser.add_argument("--metrics_port", type=int, default=None, help="Also serve the metrics in Prometheus text format on this port (implies --telemetry).")
+    parser.add_argument("--output_format", choices=OUTPUT_FORMATS, default=None, help="Write the output as JSONL, zstd-compressed JSONL or Parquet parts instead of the format OUTPUT_FILE names.")
+    args = parser.parse_args()
+    OUTPUT_FILE = with_format(OUTPUT_FILE, args.output_format)
+
+    refine_jsonl(telemetry=args.telemetry, metrics_port=args.metrics_port)
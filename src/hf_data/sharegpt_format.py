@@ -1,39 +1,119 @@
-import json
+import os
+import sys
+import tempfile
+import functools
 import datasets
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 from datasets import load_dataset
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.images import disable_image_decoding  # noqa: E402
+from utils.result_io import iter_records, resolve_input  # noqa: E402
+
 SOURCE_DATASET_REPO = "ohjoonhee/Visual-CoT-4k"
 SOURCE_JSONL = "output/judge_filtered_reasoning_v3_v2.jsonl"
 
+SHAREGPT_FEATURES = {
+    "messages": [{"role": datasets.Value("string"), "content": datasets.Value("string")}],
+    "images": datasets.Sequence(datasets.Image()),
+}
+SPILL_SCHEMA = pa.schema(
+    [
+        ("sample_id", pa.int64()),
+        ("position", pa.int64()),
+        ("accepted", pa.bool_()),
+        ("question", pa.large_string()),
+        ("prediction", pa.large_string()),
+    ]
+)
+SPILL_BATCH_SIZE = 4096
+
+
+def spill_judged(cot_records, path):
+    """
+    Stream judged records into an Arrow file at ``path``, one batch at a time: a row per accepted
+    candidate (one per record for single-candidate records), and a row with ``accepted`` false for
+    a record without any, so it still replaces an earlier record of the same ID. Records without a
+    ``sample_id`` (older outputs) are keyed by their position.
+    """
+    batch = []
+    with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, SPILL_SCHEMA) as writer:
+        for position, record in enumerate(cot_records):
+            sample_id = record.get("sample_id", position)
+            predictions = [entry["refined_prediction"] for entry in record.get("candidates", [record]) if entry.get("judge_result") == "1"]
+            for prediction in predictions or [None]:
+                accepted = prediction is not None
+                batch.append({"sample_id": sample_id, "position": position, "accepted": accepted, "question": record["question"] if accepted else None, "prediction": prediction})
+            if len(batch) >= SPILL_BATCH_SIZE:
+                writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=SPILL_SCHEMA))
+                batch = []
+        if batch:
+            writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=SPILL_SCHEMA))
+
+
+@functools.lru_cache(maxsize=None)
+def _open_spill(path):
+    # Memory-mapped: columns are only paged in when they are read
+    return pa.ipc.open_file(pa.memory_map(path)).read_all()
+
+
+def accepted_rows(path):
+    """
+    Row numbers in the spill file of the accepted predictions of each sample's latest record,
+    ordered by ``sample_id``. Only the integer and flag columns are read.
+    """
+    table = _open_spill(path).select(["sample_id", "position", "accepted"])
+    table = table.append_column("row", pa.array(np.arange(table.num_rows, dtype=np.int64)))
+    latest = table.group_by("sample_id").aggregate([("position", "max")])
+    latest = pa.table({"sample_id": latest["sample_id"], "position": latest["position_max"]})
+    kept = table.join(latest, ["sample_id", "position"], join_type="inner").filter(pc.field("accepted"))
+    return kept.sort_by([("sample_id", "ascending"), ("row", "ascending")])["row"].to_numpy()
+
+
+def build_sharegpt(dataset, cot_records, num_proc=None):
+    """
+    Join judged CoT records onto their source rows by ``sample_id`` and keep the accepted ones in ShareGPT layout.
+
+    The judged records are streamed to a memory-mapped Arrow file instead of being held in a dict,
+    so memory stays flat however large the judged output is; prompts and predictions are read back
+    per batch during the map. Rejected samples are dropped before any image is read, and images are
+    carried through as their stored bytes rather than decoded and re-encoded. Every accepted
+    candidate of a multi-candidate record becomes its own row. Raises ``ValueError`` when nothing
+    was accepted, rather than returning an empty dataset without a schema.
+    """
+    with tempfile.TemporaryDirectory() as spill_dir:
+        path = os.path.join(spill_dir, "accepted.arrow")
+        spill_judged(cot_records, path)
+        rows = accepted_rows(path)
+        sample_ids = _open_spill(path)["sample_id"].take(pa.array(rows)).to_numpy()
+        print(f"Accepted {len(rows)} judged predictions from {len(np.unique(sample_ids))} samples")
+        if not len(rows):
+            _open_spill.cache_clear()
+            raise ValueError("No judged record was accepted; refusing to export an empty ShareGPT dataset")
+
+        dataset = disable_image_decoding(dataset.select(sample_ids), "image")
+
+        def to_sharegpt(batch, indices):
+            texts = _open_spill(path).select(["question", "prediction"]).take(pa.array(rows[indices]))
+            messages = []
+            for question, cot_question, prediction in zip(batch["question"], texts["question"].to_pylist(), texts["prediction"].to_pylist()):
+                assert cot_question == question, f"Judged record does not match its source row: {cot_question[:50]!r}"
+                messages.append([{"role": "user", "content": "<image>" + question}, {"role": "assistant", "content": prediction}])
+            return {"messages": messages, "images": [[image] for image in batch["image"]]}
+
+        removed = [c for c in ["conversations", "question", "answer", "image"] if c in dataset.column_names]
+        features = datasets.Features({**{c: f for c, f in dataset.features.items() if c not in removed}, **SHAREGPT_FEATURES})
+        dataset = dataset.map(to_sharegpt, batched=True, with_indices=True, remove_columns=removed, features=features, num_proc=num_proc)
+        _open_spill.cache_clear()
+    return dataset
+
 
 def main():
+    cpus = int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count()))
     dataset = load_dataset(SOURCE_DATASET_REPO, split="train")
-    with open(SOURCE_JSONL, "r") as f:
-        cot_lines = [json.loads(line) for line in f.readlines()]
-
-    dataset = dataset.select(range(len(cot_lines)))
-
-    def construct_messages(example, idx):
-        cot_record = cot_lines[idx]
-        assert cot_record["question"] == example["question"]
-        assert cot_record["answer"] == example["answer"]
-        example["messages"] = [
-            {"role": "user", "content": "<image>" + example["question"]},
-            {"role": "assistant", "content": cot_record["refined_prediction"]},
-        ]
-        example["cot_validation"] = cot_record["judge_result"]
-        return example
-
-    def image_to_images(example):
-        img = example["image"]
-        example["images"] = [img]
-        return example
-
-    dataset = dataset.map(construct_messages, with_indices=True)
-    dataset = dataset.map(image_to_images)
-    dataset = dataset.cast_column("images", datasets.Sequence(datasets.Image()))
-    dataset = dataset.filter(lambda x: x["cot_validation"] == "1")
-    dataset = dataset.remove_columns(["conversations", "question", "answer", "cot_validation", "image"])
+    dataset = build_sharegpt(dataset, iter_records(resolve_input(SOURCE_JSONL)), num_proc=max(cpus - 1, 1))
 
     print(dataset)
     print(dataset[0])
@@ -1,9 +1,10 @@
 import os
-import json
+import sys
+import time
+import asyncio
+import hashlib
 import argparse
-import base64
-from io import BytesIO
-from typing import List, Union
+from typing import List, Tuple
 
 import dotenv
 from google import genai
@@ -12,6 +13,19 @@ from datasets import load_dataset
 from PIL import Image
 from tqdm import tqdm
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from utils.adaptive_concurrency import AIMDLimiter  # noqa: E402
+from utils.concurrency import OrderedBuffer, Prefetcher, bounded_map  # noqa: E402
+from utils.dataset_stream import iter_pending, split_size, stream_dataset  # noqa: E402
+from utils.gemini_retry import generate_content_with_retry  # noqa: E402
+from utils.image_cache import ImageCache  # noqa: E402
+from utils.images import ImagePreprocessor, disable_image_decoding, is_image_path  # noqa: E402
+from utils.manifest import CompletionManifest  # noqa: E402
+from utils.result_io import OUTPUT_FORMATS, ResultWriter  # noqa: E402
+from utils.sharding import add_shard_arguments, merge_shards, resolve_shard, shard_output_file  # noqa: E402
+from utils.response_cache import ResponseCache, open_response_cache  # noqa: E402
+from utils.telemetry import gemini_usage, open_telemetry  # noqa: E402
+
 # Load environment variables
 dotenv.load_dotenv()
 
@@ -20,30 +34,192 @@ dotenv.load_dotenv()
 DEFAULT_MODEL_NAME = "gemini-3-flash-preview"
 
 
-def _process_single_image(image_input) -> Union[Image.Image, str]:
+def _process_single_image(image_input, preprocessor: ImagePreprocessor) -> Tuple[bytes, str]:
     """
-    Process a single image input into a format suitable for Gemini API (PIL Image).
+    Process a single image input into ``(bytes, mime_type)`` suitable for Gemini API.
     """
-    if isinstance(image_input, Image.Image):
-        return image_input
-    elif isinstance(image_input, str):
-        # Check if it's a file path
-        if len(image_input) < 4096 and os.path.exists(image_input):
-            return Image.open(image_input)
-        return image_input  # Return as string if not a path (maybe a URL or something else, though Gemini might expect PIL)
-    elif isinstance(image_input, bytes):
-        return Image.open(BytesIO(image_input))
-    else:
-        raise ValueError(f"Unsupported image type: {type(image_input)}")
+    if isinstance(image_input, str) and not is_image_path(image_input):
+        raise ValueError(f"Image string is not an existing file path: {image_input[:100]}")
+    if isinstance(image_input, (Image.Image, str, bytes, dict)):
+        return preprocessor(image_input)
+    raise ValueError(f"Unsupported image type: {type(image_input)}")
 
 
-def process_image(image_input) -> List[Union[Image.Image, str]]:
+def process_image(image_input, preprocessor: ImagePreprocessor) -> List[Tuple[bytes, str]]:
     """
-    Process image input (single or list) into a list of PIL Images.
+    Process image input (single or list) into a list of ``(bytes, mime_type)`` pairs.
     """
     if isinstance(image_input, list):
-        return [_process_single_image(img) for img in image_input]
-    return [_process_single_image(image_input)]
+        return [_process_single_image(img, preprocessor) for img in image_input]
+    return [_process_single_image(image_input, preprocessor)]
+
+
+async def generate_with_retry(client, limiter: AIMDLimiter, args, contents, index, picked_up, image_bytes, telemetry=None):
+    """
+    ``generate_content`` through the AIMD limiter. Overload and transient errors are retried up to
+    ``--max_retries`` times, waiting for the retry-after hint or an exponential backoff; other errors raise.
+    """
+
+    def on_error(error, started):
+        if telemetry:
+            telemetry.record("generate", args.model, sample_id=index, queue_wait_s=started - picked_up, latency_s=time.monotonic() - started, image_bytes=image_bytes, error=error)
+
+    response, started = await generate_content_with_retry(
+        client,
+        args.max_retries,
+        limiter=limiter,
+        on_error=on_error,
+        label=f"Sample {index}",
+        model=args.model,
+        contents=contents,
+        config=types.GenerateContentConfig(
+            thinking_config=types.ThinkingConfig(thinking_level="high"),
+        ),
+    )
+    if telemetry:
+        telemetry.record(
+            "generate",
+            args.model,
+            sample_id=index,
+            queue_wait_s=started - picked_up,
+            latency_s=time.monotonic() - started,
+            image_bytes=image_bytes,
+            **gemini_usage(response.usage_metadata),
+        )
+    return response
+
+
+def no_text_reason(response) -> str:
+    feedback = getattr(response, "prompt_feedback", None)
+    if feedback is not None and feedback.block_reason:
+        return f"prompt blocked: {feedback.block_reason}"
+    if response.candidates:
+        return f"finish reason {response.candidates[0].finish_reason}"
+    return "no candidates"
+
+
+async def infer_sample(client, limiter, args, preprocessor, response_cache, index, item, payloads=None, telemetry=None):
+    """
+    Run one dataset row. Returns the result record, or None on failure. ``payloads`` are the row's
+    images when the prefetcher already processed them.
+    """
+    picked_up = time.monotonic()
+    try:
+        question = item[args.question_column]
+        image_input = item[args.image_column]
+
+        # Gemini accepts a list of [image, text, image, text...]
+        # We'll construct contents as [image(s), question]
+
+        if payloads is None:
+            payloads = await asyncio.to_thread(process_image, image_input, preprocessor)
+        processed_images = [
+            types.Part.from_bytes(
+                data=image_bytes,
+                mime_type=mime_type,
+            )
+            for image_bytes, mime_type in payloads
+        ]
+
+        contents = []
+        contents.extend(processed_images)
+        contents.append(question)
+
+        # Images are keyed by content hash so the cache key stays small
+        cache_key = None
+        prediction_text = None
+        if response_cache:
+            image_hashes = [hashlib.sha256(image_bytes).hexdigest() for image_bytes, _ in payloads]
+            cache_key = ResponseCache.request_key(args.model, {"images": image_hashes, "question": question}, thinking_level="high")
+            prediction_text = response_cache.get_text(cache_key)
+
+        if prediction_text is None:
+            image_bytes = sum(len(image_bytes) for image_bytes, _ in payloads)
+            response = await generate_with_retry(client, limiter, args, contents, index, picked_up, image_bytes, telemetry=telemetry)
+            if response.text is None:
+                # Safety block, or a response with nothing but thoughts; recorded instead of retried
+                result = {"sample_id": index, "question": question, "error": f"no text in response ({no_text_reason(response)})"}
+                if "answer" in item:
+                    result["answer"] = item["answer"]
+                print(f"Sample {index}: {result['error']}")
+                return result
+
+            prediction_text = response.text.strip()
+            if response_cache:
+                response_cache.put_text(cache_key, prediction_text)
+
+        result = {
+            "sample_id": index,
+            "question": question,
+            "prediction": prediction_text,
+        }
+
+        if "answer" in item:
+            result["answer"] = item["answer"]
+        return result
+
+    except Exception as e:
+        print(f"Error processing sample {index}: {e}")
+        return None
+
+
+async def run_inference(client, limiter, args, preprocessor, response_cache, dataset, shard_indices, manifest, result_writer, telemetry=None):
+    """
+    Run this shard's missing rows with the AIMD limiter deciding how many requests are in flight;
+    ``--max_concurrency`` only caps it. Results are written back in dataset order.
+
+    With ``--streaming`` the rows come from an ``IterableDataset`` through a ``Prefetcher`` that
+    prepares the next ``--prefetch`` rows' images in worker threads while requests are in flight;
+    ``shard_indices`` is None when the split's size is unknown.
+    """
+    prefetcher = None
+    if args.streaming:
+        total = len(shard_indices) if shard_indices is not None else None
+        rows = iter_pending(dataset, shard_indices, manifest.__contains__)
+        prefetcher = pending = Prefetcher(rows, lambda row: prepare_row(args, preprocessor, *row), depth=args.prefetch or 2 * args.max_concurrency, workers=args.prefetch_workers)
+        initial = len(shard_indices) - len(manifest.missing(shard_indices)) if shard_indices is not None else 0
+    else:
+        total = len(shard_indices)
+        # Only select this shard's missing rows so finished ones are never decoded
+        pending_indices = manifest.missing(shard_indices)
+        pending = zip(pending_indices, dataset.select(pending_indices))
+        initial = total - len(pending_indices)
+
+    writer = OrderedBuffer(result_writer.write)
+    last_index = -1
+    try:
+        with tqdm(total=total, initial=initial) as progress:
+            async for position, (index, result) in bounded_map(lambda row: infer_row(client, limiter, args, preprocessor, response_cache, *row, telemetry=telemetry), pending, args.max_concurrency):
+                writer.put(position, result)
+                last_index = max(last_index, index)
+                progress.update(1)
+                progress.set_postfix(concurrency=f"{limiter.limit:.1f}")
+    finally:
+        if prefetcher:
+            prefetcher.close()
+
+    result_writer.commit()
+    if shard_indices is None:
+        # Streamed split of unknown size; rows after the last one dispatched were all done already
+        shard_indices = range(last_index + 1)
+    failed = len(manifest.missing(shard_indices))
+    if failed:
+        print(f"{failed} samples failed; rerun the same command to retry them.")
+
+
+def prepare_row(args, preprocessor, index, item):
+    """
+    Prefetcher step: the row with its images processed. On failure the images are left to
+    ``infer_sample``, which reports the error for the sample.
+    """
+    try:
+        return index, item, process_image(item[args.image_column], preprocessor)
+    except Exception:
+        return index, item, None
+
+
+async def infer_row(client, limiter, args, preprocessor, response_cache, index, item, payloads=None, telemetry=None):
+    return index, await infer_sample(client, limiter, args, preprocessor, response_cache, index, item, payloads=payloads, telemetry=telemetry)
 
 
 def main():
@@ -51,16 +227,37 @@ def main():
     parser.add_argument("--output_dir", type=str, default="output", help="Directory to save results.")
     parser.add_argument("--dataset_name", type=str, default="ohjoonhee/Visual-CoT-4k", help="Dataset name.")
     parser.add_argument("--split", type=str, default="train", help="Dataset split.")
-    parser.add_argument("--batch_size", type=int, default=1, help="Batch size (currently treating as 1 for simplicity loop).")
+    parser.add_argument("--batch_size", type=int, default=None, help="Alias for --max_concurrency, used when --max_concurrency is not set.")
     parser.add_argument("--model", type=str, default=DEFAULT_MODEL_NAME, help="Model name for API.")
     parser.add_argument("--image_column", type=str, default="image", help="Column name for image.")
     parser.add_argument("--question_column", type=str, default="question", help="Column name for question.")
     parser.add_argument("--limit", type=int, default=None, help="Limit number of samples to process.")
+    parser.add_argument("--passthrough_images", action="store_true", help="Send the stored image bytes unchanged instead of decoding and re-encoding to JPEG.")
+    parser.add_argument("--image_cache", type=str, default="cache/image_payloads.sqlite", help="Path to the encoded image cache. Empty string disables it.")
+    parser.add_argument("--image_cache_size_gb", type=float, default=20.0, help="Size budget of the image cache before LRU eviction.")
+    parser.add_argument("--max_pixels", type=int, default=None, help="Downscale images above this many pixels before sending.")
+    parser.add_argument("--min_pixels", type=int, default=None, help="Never downscale below this many pixels.")
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Stream the split instead of downloading and preparing it first; rows are read undecoded and prepared by the prefetcher.",
+    )
+    parser.add_argument("--prefetch", type=int, default=None, help="Rows prepared ahead of the request loop with --streaming (default 2x max_concurrency).")
+    parser.add_argument("--prefetch_workers", type=int, default=4, help="Threads preparing prefetched rows with --streaming.")
+    parser.add_argument("--image_workers", type=int, default=0, help="Worker processes for image decoding/encoding (0 runs inline).")
+    parser.add_argument("--max_concurrency", type=int, default=None, help="Upper bound for the adaptive number of requests in flight (default: --batch_size, else 64).")
+    parser.add_argument("--initial_concurrency", type=int, default=4, help="Requests in flight at start; grows while latency and errors stay healthy.")
+    parser.add_argument("--max_retries", type=int, default=8, help="Retries per sample on 429, deadline and server errors.")
+    parser.add_argument("--request_timeout", type=float, default=600.0, help="Per-request timeout in seconds.")
+    parser.add_argument("--telemetry", action="store_true", help="Record per-request latency/token metrics to a .metrics.jsonl sidecar next to the output.")
+    parser.add_argument("--metrics_port", type=int, default=None, help="Also serve the metrics in Prometheus text format on this port (implies --telemetry).")
+    parser.add_argument("--output_format", choices=OUTPUT_FORMATS, default="jsonl", help="Results as JSONL, zstd-compressed JSONL or a directory of Parquet parts.")
+    add_shard_arguments(parser)
 
     args = parser.parse_args()
 
-    # Initialize Gemini Client
-    client = genai.Client()  # Assumes GOOGLE_API_KEY is in env
+    if args.max_concurrency is None:
+        args.max_concurrency = args.batch_size or 64
 
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
@@ -69,114 +266,73 @@ def main():
     sanitized_dataset_name = args.dataset_name.replace("/", "__")
     sanitized_split_name = args.split.replace("/", "__")
 
-    output_file = os.path.join(args.output_dir, f"{sanitized_model_name}_{sanitized_dataset_name}_{sanitized_split_name}_results.jsonl")
+    output_file = os.path.join(args.output_dir, f"{sanitized_model_name}_{sanitized_dataset_name}_{sanitized_split_name}_results.{args.output_format}")
 
-    print(f"Loading dataset {args.dataset_name} split {args.split}...")
-    dataset = load_dataset(args.dataset_name, split=args.split)
+    if args.streaming:
+        print(f"Streaming dataset {args.dataset_name} split {args.split}...")
+        dataset = stream_dataset(args.dataset_name, args.split, args.limit)
+        total = split_size(dataset, args.split, args.limit)
+    else:
+        print(f"Loading dataset {args.dataset_name} split {args.split}...")
+        # Images stay encoded: the preprocessor keys its cache on the stored bytes and decodes only on a miss
+        dataset = disable_image_decoding(load_dataset(args.dataset_name, split=args.split), args.image_column, strict=False)
 
-    if args.limit:
-        dataset = dataset.select(range(args.limit))
+        if args.limit:
+            dataset = dataset.select(range(args.limit))
+        total = len(dataset)
 
-    completed_count = 0
-    # Check if output file exists to resume
-    if os.path.exists(output_file):
-        with open(output_file, "r") as f:
-            completed_count = sum(1 for _ in f)
-        print(f"Resuming from {completed_count} completed samples.")
+    if total is None and (args.merge or args.num_shards > 1):
+        raise SystemExit(f"The metadata of {args.dataset_name} doesn't record the size of split {args.split}, which sharding needs")
 
-    print(f"Starting inference with model {args.model}...")
+    if args.merge:
+        incomplete = merge_shards(output_file, total, args.num_shards)
+        sys.exit(1 if incomplete else 0)
 
-    with open(output_file, "a", buffering=1) as f_out:
-        total = len(dataset)
-        for i, item in tqdm(enumerate(dataset), total=total, initial=completed_count):
-            if i < completed_count:
-                continue
-
-            try:
-                question = item[args.question_column]
-                image_input = item[args.image_column]
-
-                # Gemini accepts a list of [image, text, image, text...]
-                # We'll construct contents as [image(s), question]
-
-                processed_images = process_image(image_input)
-
-                # PIL Image to bytes
-                def image_to_bytes(image: Image.Image) -> bytes:
-                    buffer = BytesIO()
-                    image.save(buffer, format="JPEG")
-                    return buffer.getvalue()
-
-                processed_images = [
-                    types.Part.from_bytes(
-                        data=image_to_bytes(image),
-                        mime_type="image/jpeg",
-                    )
-                    for image in processed_images
-                ]
-
-                contents = []
-                contents.extend(processed_images)
-                contents.append(question)
-
-                response = client.models.generate_content(
-                    model=args.model,
-                    contents=contents,
-                    config=types.GenerateContentConfig(
-                        thinking_config=types.ThinkingConfig(thinking_level="high"),
-                    ),
-                )
-
-                # Parse response
-                prediction = ""
-                thoughts = ""
-
-                # Handle possible multiple candidates (usually 1)
-                if response.candidates:
-                    candidate = response.candidates[0]
-                    if candidate.content and candidate.content.parts:
-                        for part in candidate.content.parts:
-                            if not part.text:
-                                continue
-                            if part.thought:
-                                thoughts += part.text + "\n"
-                            else:
-                                prediction += part.text + "\n"
-                            # if part.text:
-                            #     if getattr(
-                            #         part, "thought", False
-                            #     ):  # Check if it's a thought part (SDK dependent, but user example used .thought logic, although SDK usually puts thought in metadata or specific field. Wait, user example: `if part.thought:`)
-                            #         # Actually, looking at user example: `if part.thought:`
-                            #         # It implies `part` object has `thought` attribute which is boolean?
-                            #         # Or maybe `part.thought` is the thought text?
-                            #         # User example:
-                            #         # if part.thought:
-                            #         #     print("Thought summary:")
-                            #         #     print(part.text)
-
-                            #         # So `part.thought` is likely a boolean flag.
-                            #         if part.thought:
-                            #             thoughts += part.text + "\n"
-                            #         else:
-                            #             prediction += part.text + "\n"
-
-                result = {
-                    "question": question,
-                    "prediction": response.text.strip(),
-                    # "thoughts": thoughts.strip(),
-                }
+    shard_indices = resolve_shard(args, total) if total is not None else None
+    output_file = shard_output_file(output_file, args.num_shards, args.shard_index)
 
-                if "answer" in item:
-                    result["answer"] = item["answer"]
+    # Timeouts surface as deadline errors, which the limiter treats as overload
+    client = genai.Client(http_options=types.HttpOptions(timeout=int(args.request_timeout * 1000)))  # Assumes GOOGLE_API_KEY is in env
+    limiter = AIMDLimiter(initial=args.initial_concurrency, maximum=args.max_concurrency)
+
+    # Resume from the completion manifest next to the output file
+    manifest = CompletionManifest.for_output(output_file)
+    if len(manifest):
+        print(f"Resuming with {len(manifest)} completed samples.")
 
-                f_out.write(json.dumps(result) + "\n")
+    image_cache = ImageCache(args.image_cache, max_bytes=int(args.image_cache_size_gb * 1024**3)) if args.image_cache else None
+    preprocessor = ImagePreprocessor(
+        cache=image_cache,
+        passthrough=args.passthrough_images,
+        max_pixels=args.max_pixels,
+        min_pixels=args.min_pixels,
+        num_workers=args.image_workers,
+    )
 
-            except Exception as e:
-                print(f"Error processing sample {i}: {e}")
-                import traceback
+    response_cache = open_response_cache()
+    telemetry = open_telemetry(output_file, args.telemetry, args.metrics_port)
+
+    print(f"Starting inference with model {args.model}...")
 
-                traceback.print_exc()
-                # Optionally write error to a log file or continue
+    async def run(result_writer):
+        try:
+            await run_inference(client, limiter, args, preprocessor, response_cache, dataset, shard_indices, manifest, result_writer, telemetry=telemetry)
+        finally:
+            await client.aio.aclose()
+
+    # Results are committed in batches; the manifest is marked only once they are on disk
+    with ResultWriter(output_file, manifest=manifest) as result_writer:
+        asyncio.run(run(result_writer))
+
+    limiter.report()
+    manifest.close()
+    preprocessor.close()
+    if response_cache:
+        response_cache.report()
+        response_cache.close()
+    if telemetry:
+        telemetry.report()
+        telemetry.close()
 
 
 if __name__ == "__main__":
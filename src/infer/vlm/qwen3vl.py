@@ -1,11 +1,26 @@
 import os
-import json
+import sys
+import time
 import base64
+import asyncio
+import contextlib
 import argparse
-from io import BytesIO
-from openai import Client
+from openai import AsyncOpenAI
 from datasets import load_dataset
-from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from utils.concurrency import OrderedBuffer, Prefetcher, bounded_map  # noqa: E402
+from utils.context_budget import ContextBudget, TextTokenCounter  # noqa: E402
+from utils.dataset_stream import iter_pending, split_size, stream_dataset  # noqa: E402
+from utils.image_cache import ImageCache  # noqa: E402
+from utils.images import ImagePreprocessor, disable_image_decoding, image_dimensions, is_image_path  # noqa: E402
+from utils.load_balancer import EndpointRouter  # noqa: E402
+from utils.manifest import CompletionManifest  # noqa: E402
+from utils.prefix_grouping import order_by_prefix  # noqa: E402
+from utils.result_io import OUTPUT_FORMATS, ResultWriter, iter_records  # noqa: E402
+from utils.sharding import add_shard_arguments, merge_shards, resolve_shard, shard_output_file  # noqa: E402
+from utils.stream_guard import FORMAT_CHECKS, build_guard, parse_format_check  # noqa: E402
+from utils.telemetry import open_telemetry, openai_usage, stream_chat_completion  # noqa: E402
 
 # Default configuration from environment variables or defaults
 BASE_URL = os.getenv("BASE_URL", "http://localhost:10630/v1")
@@ -15,129 +30,591 @@ MODEL_NAME = os.getenv("MODEL", "Qwen/Qwen3-VL-8B-Thinking")
 DEFAULT_SYSTEM_PROMPT = ""
 
 
-def _process_single_image(image_input):
-    if isinstance(image_input, Image.Image):
-        buffered = BytesIO()
-        image_input.save(buffered, format="JPEG")
-        return base64.b64encode(buffered.getvalue()).decode("utf-8")
-    elif isinstance(image_input, str):
-        # Check if it's a file path
-        if len(image_input) < 4096 and os.path.exists(image_input):
-            image = Image.open(image_input)
-            buffered = BytesIO()
-            image.save(buffered, format="JPEG")
-            return base64.b64encode(buffered.getvalue()).decode("utf-8")
-        return image_input
-    elif isinstance(image_input, bytes):
-        return base64.b64encode(image_input).decode("utf-8")
-    else:
-        raise ValueError(f"Unsupported image type: {type(image_input)}")
+def _process_single_image(image_input, preprocessor, max_pixels=None):
+    """
+    Return ``(data URL, (width, height))`` for one image. Raw bytes keep their stored format.
+    """
+    if isinstance(image_input, str) and not is_image_path(image_input):
+        # Assume an already base64-encoded JPEG
+        return f"data:image/jpeg;base64,{image_input}", image_dimensions(base64.b64decode(image_input))
+    data, mime_type = preprocessor(image_input, max_pixels=max_pixels, passthrough=True if isinstance(image_input, bytes) else None)
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}", image_dimensions(data)
 
 
-def process_image(image_input):
+def process_image(image_input, preprocessor, max_pixels=None):
     if isinstance(image_input, list):
-        return [_process_single_image(img) for img in image_input]
-    return [_process_single_image(image_input)]
+        return [_process_single_image(img, preprocessor, max_pixels) for img in image_input]
+    return [_process_single_image(image_input, preprocessor, max_pixels)]
 
 
-def main():
+async def admit_sample(client, args, admission, preprocessor, system_prompt, question, image_input, images):
+    """
+    Fit one request into the server's context before anything is sent. Returns ``(client, images,
+    max_tokens, prompt_tokens, rejected)``: with ``--oversize downscale`` the images are re-encoded
+    at a lower resolution, with ``--oversize route`` the request goes to the long-context endpoint,
+    and ``rejected`` is the reason when the sample can't be fit.
+    """
+    texts = [system_prompt, question]
+    prompt_tokens = admission.prompt_tokens(texts, [size for _, size in images])
+    max_tokens = admission.completion_budget(prompt_tokens, args.max_tokens)
+    if max_tokens is not None:
+        return client, images, max_tokens, prompt_tokens, None
+
+    if args.oversize == "downscale":
+        max_pixels = admission.image_pixel_cap(admission.text_tokens(texts), len(images))
+        if max_pixels is not None:
+            downscaled = await asyncio.to_thread(process_image, image_input, preprocessor, max_pixels)
+            downscaled_tokens = admission.prompt_tokens(texts, [size for _, size in downscaled])
+            max_tokens = admission.completion_budget(downscaled_tokens, args.max_tokens)
+            if max_tokens is not None:
+                admission.downscaled += 1
+                return client, downscaled, max_tokens, downscaled_tokens, None
+    elif args.oversize == "route" and admission.route_client is not None:
+        max_tokens = admission.completion_budget(prompt_tokens, args.max_tokens, admission.route_max_model_len)
+        if max_tokens is not None:
+            admission.routed += 1
+            return admission.route_client, images, max_tokens, prompt_tokens, None
+
+    admission.rejected += 1
+    reason = f"estimated {prompt_tokens} prompt tokens leave less than {admission.min_completion_tokens} completion tokens within max_model_len {admission.max_model_len}"
+    return client, images, None, prompt_tokens, reason
+
+
+async def infer_sample(client, args, system_prompt, preprocessor, index, item, telemetry=None, admission=None, images=None, stage="generate"):
+    """
+    Run a single chat completion for one dataset row. Returns the result record, or None on failure.
+
+    With ``--num_samples`` > 1 all candidates come from one request with ``n`` set, so the image is
+    uploaded and encoded once, and are stored under ``candidates`` (see ``utils.candidates``).
+    With ``telemetry`` the request is streamed so time to first token can be recorded. With
+    ``--reasoning_budget`` or ``--format_check`` it is streamed through a ``StreamGuard`` and cancelled
+    once every choice has been aborted; aborted choices are recorded with ``aborted`` set to the reason
+    instead of a ``prediction``, and count as done so they are not regenerated on a rerun.
+
+    With ``admission`` (``--max_model_len``) the prompt is estimated first and oversized samples are
+    downscaled, routed or recorded with ``rejected`` (see ``admit_sample``); with
+    ``--max_inflight_tokens`` the request also waits until its estimated tokens fit the in-flight cap.
+
+    ``images`` are the row's already processed ``process_image`` payloads, when a prompt sweep shares
+    them across variants; ``stage`` labels the telemetry records.
+    """
+    picked_up = time.monotonic()
+    sent = None
+    image_bytes = 0
+    reserved = 0
+    try:
+        question = item[args.question_column]
+        image_input = item[args.image_column]
+        if images is None:
+            images = await asyncio.to_thread(process_image, image_input, preprocessor)
+        max_tokens = args.max_tokens
+        estimate = {}
+        if admission:
+            client, images, max_tokens, prompt_tokens, rejected = await admit_sample(client, args, admission, preprocessor, system_prompt, question, image_input, images)
+            if rejected:
+                print(f"Rejected sample {index}: {rejected}")
+                result = {"sample_id": index, "question": question, "rejected": rejected, "prompt_tokens": prompt_tokens}
+                if "answer" in item:
+                    result["answer"] = item["answer"]
+                return result
+            estimate = {"estimated_prompt_tokens": prompt_tokens}
+            if admission.inflight:
+                # The KV cache holds the shared prompt once plus every candidate's completion
+                reserved = await admission.inflight.acquire(prompt_tokens + max_tokens * args.num_samples)
+        image_urls = [image_url for image_url, _ in images]
+
+        content = []
+        for image_url in image_urls:
+            content.append(
+                {
+                    "type": "image_url",
+                    "image_url": {"url": image_url},
+                }
+            )
+        content.append({"type": "text", "text": question})
+        image_bytes = sum(len(image_url) for image_url in image_urls)
+
+        sampling = {"n": args.num_samples} if args.num_samples > 1 else {}
+        request = dict(
+            model=args.model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": content},
+            ],
+            max_tokens=max_tokens,
+            temperature=0.7,
+            **sampling,
+        )
+        guard = build_guard(args.reasoning_budget, args.format_check, args.num_samples)
+        sent = time.monotonic()
+        if telemetry or guard:
+            predictions, usage, ttft = await stream_chat_completion(client, guard=guard, **request)
+            aborted = [guard.aborted(i) if guard else None for i in range(len(predictions))]
+            if any(aborted):
+                print(f"Aborted sample {index}: " + "; ".join(reason for reason in aborted if reason))
+            if telemetry:
+                telemetry.record(
+                    stage,
+                    args.model,
+                    sample_id=index,
+                    queue_wait_s=sent - picked_up,
+                    ttft_s=ttft,
+                    latency_s=time.monotonic() - sent,
+                    image_bytes=image_bytes,
+                    aborted=aborted[0] if guard and guard.stopped else None,
+                    **estimate,
+                    **openai_usage(usage),
+                )
+        else:
+            aborted = [None] * args.num_samples
+            response = await client.chat.completions.create(**request)
+            predictions = [choice.message.content for choice in sorted(response.choices, key=lambda choice: choice.index)]
+
+        result = {
+            "sample_id": index,
+            "question": question,
+        }
+        if args.num_samples > 1:
+            if len(predictions) != args.num_samples:
+                raise ValueError(f"expected {args.num_samples} choices, got {len(predictions)}")
+            result["candidates"] = [
+                {"aborted": reason, "reasoning_tokens": guard.reasoning_tokens(i)} if reason else {"prediction": prediction}
+                for i, (prediction, reason) in enumerate(zip(predictions, aborted))
+            ]
+        elif aborted[0]:
+            result["aborted"] = aborted[0]
+            result["reasoning_tokens"] = guard.reasoning_tokens(0)
+        else:
+            result["prediction"] = predictions[0]
+        # Check if answer exists in dataset item
+        if "answer" in item:
+            result["answer"] = item["answer"]
+        return result
+
+    except Exception as e:
+        print(f"Error processing sample {index}: {e}")
+        if telemetry and sent is not None:
+            telemetry.record(stage, args.model, sample_id=index, queue_wait_s=sent - picked_up, latency_s=time.monotonic() - sent, image_bytes=image_bytes, error=e)
+        return None
+    finally:
+        if reserved:
+            admission.inflight.release(reserved)
+
+
+def needs_retry(args, record):
+    """
+    Whether a committed record is one that ``--retry_rejected`` / ``--retry_aborted`` asks to run again.
+    """
+    if args.retry_rejected and "rejected" in record:
+        return True
+    return args.retry_aborted and ("aborted" in record or any("aborted" in candidate for candidate in record.get("candidates", ())))
+
+
+def reopen_retries(args, output_file, manifest):
+    """
+    Take samples whose latest record was rejected or aborted out of ``manifest``, so a rerun with a
+    larger ``--max_model_len`` or ``--reasoning_budget`` generates them again. Their new records are
+    appended; consumers keep the latest record per ``sample_id``.
+    """
+    if not (args.retry_rejected or args.retry_aborted) or not os.path.exists(output_file):
+        return
+    latest = {}
+    for record in iter_records(output_file):
+        if "sample_id" in record:
+            latest[record["sample_id"]] = needs_retry(args, record)
+    retry = [sample_id for sample_id, flagged in latest.items() if flagged]
+    if retry:
+        print(f"Retrying {len(retry)} rejected or aborted samples from {output_file}")
+        manifest.unmark_many(retry)
+
+
+class PromptVariant:
+    """
+    One system prompt of a run, with its own output file, completion manifest and ordered writer.
+    """
+
+    def __init__(self, name, system_prompt, output_file):
+        self.name = name
+        self.system_prompt = system_prompt
+        self.output_file = output_file
+        self.manifest = CompletionManifest.for_output(output_file)
+        self.result_writer = None
+        self.writer = None
+
+    @property
+    def stage(self):
+        return "generate" if self.name is None else f"generate[{self.name}]"
+
+
+async def infer_variants(client, args, variants, preprocessor, index, item, images=None, telemetry=None, admission=None):
+    """
+    Run one row through every variant still missing it. The images are decoded and encoded once
+    (unless the prefetcher already did) and shared by all of the variants' requests. Returns one
+    result (or None) per variant.
+    """
+    todo = [variant for variant in variants if index not in variant.manifest]
+    if len(variants) == 1:
+        return [await infer_sample(client, args, variants[0].system_prompt, preprocessor, index, item, telemetry=telemetry, admission=admission, images=images)]
+    if images is None:
+        try:
+            images = await asyncio.to_thread(process_image, item[args.image_column], preprocessor)
+        except Exception as e:
+            print(f"Error processing sample {index}: {e}")
+            return [None] * len(variants)
+    results = await asyncio.gather(
+        *(
+            infer_sample(client, args, variant.system_prompt, preprocessor, index, item, telemetry=telemetry, admission=admission, images=images, stage=variant.stage)
+            for variant in todo
+        )
+    )
+    by_variant = dict(zip((id(variant) for variant in todo), results))
+    return [by_variant.get(id(variant)) for variant in variants]
+
+
+async def run_inference(client, args, variants, preprocessor, dataset, telemetry=None, admission=None):
+    """
+    Keep up to ``max_concurrency`` requests in flight so the server's continuous batcher stays busy.
+
+    Only this shard's rows missing from a manifest are selected, so finished rows are never
+    decoded. Responses complete out of order; an ``OrderedBuffer`` per variant writes them back in
+    dispatch order, which is dataset order unless ``--group_by_prefix`` reordered the rows. With
+    several ``variants`` (a ``--system_prompt_path`` sweep) every row fans out into one request per
+    variant, so ``max_concurrency`` is split between them.
+
+    With ``--streaming`` the rows come from an ``IterableDataset`` through a ``Prefetcher`` that
+    decodes and encodes the next ``--prefetch`` rows in worker threads while requests are in flight.
+    """
+    prefetcher = None
+    if args.streaming:
+        def is_done(index):
+            return all(index in variant.manifest for variant in variants)
+
+        total = split_size(dataset, args.split)
+        if total is None and args.num_shards > 1:
+            raise SystemExit(f"The metadata of {args.dataset_name} doesn't record the size of split {args.split}, which sharding needs")
+        indices = resolve_shard(args, total) if total is not None else None
+        total = len(indices) if indices is not None else None
+        rows = iter_pending(dataset, indices, is_done)
+        prefetcher = pending = Prefetcher(rows, lambda row: prepare_row(args, preprocessor, *row), depth=args.prefetch or 2 * args.max_concurrency, workers=args.prefetch_workers)
+        finished = sum(1 for index in indices if is_done(index)) if indices is not None else 0
+    else:
+        indices = resolve_shard(args, len(dataset))
+        total = len(indices)
+        missing = set().union(*(variant.manifest.missing(indices) for variant in variants))
+        pending_indices = pending_order(args, dataset, [index for index in indices if index in missing], variants[0].system_prompt)
+        pending = zip(pending_indices, dataset.select(pending_indices))
+        finished = total - len(pending_indices)
+
+    for variant in variants:
+        variant.writer = OrderedBuffer(variant.result_writer.write)
+
+    last_index = -1
+    concurrency = max(1, args.max_concurrency // len(variants))
+    try:
+        async for position, (index, results) in bounded_map(lambda row: infer_row(client, args, variants, preprocessor, *row, telemetry=telemetry, admission=admission), pending, concurrency):
+            for variant, result in zip(variants, results):
+                variant.writer.put(position, result)
+            last_index = max(last_index, index)
+            finished += 1
+            if finished % 10 == 0:
+                print(f"Processing {finished}/{total or '?'} ({max(len(variant.writer) for variant in variants)} buffered)")
+    finally:
+        if prefetcher:
+            prefetcher.close()
+
+    if indices is None:
+        # Streamed split of unknown size; rows after the last one dispatched were all done already
+        indices = range(last_index + 1)
+    for variant in variants:
+        variant.result_writer.commit()
+        failed = len(variant.manifest.missing(indices))
+        if failed:
+            print(f"{failed} samples failed{'' if variant.name is None else f' for {variant.name}'}; rerun the same command to retry them.")
+
+
+def prepare_row(args, preprocessor, index, item):
+    """
+    Prefetcher step: the row with its images processed. On failure the images are left to
+    ``infer_sample``, which reports the error for the sample.
+    """
+    try:
+        return index, item, process_image(item[args.image_column], preprocessor)
+    except Exception:
+        return index, item, None
+
+
+async def infer_row(client, args, variants, preprocessor, index, item, images=None, telemetry=None, admission=None):
+    return index, await infer_variants(client, args, variants, preprocessor, index, item, images=images, telemetry=telemetry, admission=admission)
+
+
+def pending_order(args, dataset, pending_indices, system_prompt):
+    """
+    Dispatch order for the pending rows; with ``--group_by_prefix`` rows sharing an image are sent together.
+    """
+    if not args.group_by_prefix:
+        return pending_indices
+    return order_by_prefix(dataset, pending_indices, args.image_column, system_prompt, window=args.max_concurrency)
+
+
+def format_check_arg(spec):
+    # Build the check once while parsing so a bad spec fails before any request is sent
+    try:
+        parse_format_check(spec)
+    except (ValueError, ImportError, AttributeError) as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return spec
+
+
+def build_parser():
     parser = argparse.ArgumentParser(description="Run Qwen3-VL inference on Visual-CoT dataset.")
     parser.add_argument("--output_dir", type=str, default="output", help="Directory to save results.")
     parser.add_argument("--dataset_name", type=str, default="ohjoonhee/Visual-CoT-4k", help="Dataset name.")
     parser.add_argument("--split", type=str, default="train", help="Dataset split.")
-    parser.add_argument("--batch_size", type=int, default=1, help="Batch size (currently treating as 1 for simplicity loop).")
+    parser.add_argument("--batch_size", type=int, default=1, help="Number of requests in flight (used when --max_concurrency is not set).")
+    parser.add_argument("--max_concurrency", type=int, default=None, help="Maximum number of concurrent requests sent to the server.")
     parser.add_argument("--model", type=str, default=MODEL_NAME, help="Model name for API.")
+    parser.add_argument("--max_tokens", type=int, default=4096, help="Maximum completion tokens per request.")
+    parser.add_argument(
+        "--reasoning_budget",
+        type=int,
+        default=None,
+        help="Stream the response and cancel it once the reasoning exceeds this many tokens; the sample is recorded as aborted.",
+    )
+    parser.add_argument(
+        "--format_check",
+        action="append",
+        type=format_check_arg,
+        default=None,
+        help=f"Stream the response and cancel it when this check fails, e.g. planning:300 (repeatable). Built in: {', '.join(FORMAT_CHECKS)}; or module:function[:arg].",
+    )
+    parser.add_argument("--num_samples", type=int, default=1, help="Candidate completions per sample, generated in one request with n (stored under 'candidates').")
     parser.add_argument("--port", type=str, default=None, help="Port override for API.")
+    parser.add_argument(
+        "--endpoints",
+        type=str,
+        default=os.getenv("ENDPOINTS"),
+        help="Comma-separated vLLM replicas (host:port or base URLs) to load-balance across; overrides BASE_URL/--port.",
+    )
+    parser.add_argument("--health_interval", type=float, default=10.0, help="Seconds between /health probes of each replica when using --endpoints.")
     parser.add_argument("--image_column", type=str, default="image", help="Column name for image.")
     parser.add_argument("--question_column", type=str, default="question", help="Column name for question.")
-    parser.add_argument("--system_prompt_path", type=str, default=None, help="Path to system prompt text file.")
+    parser.add_argument(
+        "--system_prompt_path",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Path to system prompt text file. Several paths run a sweep: each row is encoded once and sent once per prompt, with one output per prompt file.",
+    )
+    parser.add_argument("--passthrough_images", action="store_true", help="Send the stored image bytes unchanged instead of decoding and re-encoding to JPEG.")
+    parser.add_argument("--image_cache", type=str, default="cache/image_payloads.sqlite", help="Path to the encoded image cache. Empty string disables it.")
+    parser.add_argument("--image_cache_size_gb", type=float, default=20.0, help="Size budget of the image cache before LRU eviction.")
+    # Defaults match the Qwen3-VL image processor limits, so downscaling client-side doesn't change what the model sees.
+    parser.add_argument("--max_pixels", type=int, default=16777216, help="Downscale images above this many pixels before sending.")
+    parser.add_argument("--min_pixels", type=int, default=65536, help="Never downscale below this many pixels.")
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Stream the split instead of downloading and preparing it first; rows are read undecoded and prepared by the prefetcher.",
+    )
+    parser.add_argument("--prefetch", type=int, default=None, help="Rows decoded and encoded ahead of the request loop with --streaming (default 2x max_concurrency).")
+    parser.add_argument("--prefetch_workers", type=int, default=4, help="Threads preparing prefetched rows with --streaming.")
+    parser.add_argument("--image_workers", type=int, default=8, help="Worker processes for image decoding/encoding (0 runs in threads).")
+    parser.add_argument(
+        "--group_by_prefix",
+        action="store_true",
+        help="Send requests sharing the same (system prompt, image) prefix back to back so vLLM's prefix cache is reused.",
+    )
+    parser.add_argument(
+        "--max_model_len",
+        type=int,
+        default=int(os.environ["MAX_MODEL_LEN"]) if os.getenv("MAX_MODEL_LEN") else None,
+        help="Server context length (vLLM --max-model-len). Enables estimating each prompt and handling oversized samples before sending.",
+    )
+    parser.add_argument("--retry_rejected", action="store_true", help="Run samples recorded as rejected by admission control again instead of treating them as done.")
+    parser.add_argument("--retry_aborted", action="store_true", help="Run samples with generations aborted by --reasoning_budget or --format_check again instead of treating them as done.")
+    parser.add_argument("--min_completion_tokens", type=int, default=1024, help="A sample fits when its prompt leaves at least this many tokens for the completion.")
+    parser.add_argument(
+        "--oversize",
+        choices=("reject", "downscale", "route"),
+        default="downscale",
+        help="Oversized samples: record them as rejected, downscale their images to fit, or send them to --long_context_endpoint. Samples that still don't fit are rejected.",
+    )
+    parser.add_argument("--long_context_endpoint", type=str, default=None, help="Base URL of a longer-context deployment for --oversize route.")
+    parser.add_argument("--long_context_len", type=int, default=32768, help="Context length of --long_context_endpoint.")
+    parser.add_argument("--tokenizer", type=str, default=None, help="Tokenizer for text token counts (defaults to --model; falls back to 4 characters per token).")
+    parser.add_argument(
+        "--max_inflight_tokens",
+        type=int,
+        default=None,
+        help="Cap on the estimated prompt plus completion tokens of all requests in flight (needs --max_model_len); size it to the server's KV cache.",
+    )
+    parser.add_argument("--telemetry", action="store_true", help="Stream responses and record per-request latency/token metrics to a .metrics.jsonl sidecar.")
+    parser.add_argument("--metrics_port", type=int, default=None, help="Also serve the metrics in Prometheus text format on this port (implies --telemetry).")
+    parser.add_argument("--output_format", choices=OUTPUT_FORMATS, default="jsonl", help="Results as JSONL, zstd-compressed JSONL or a directory of Parquet parts.")
+    add_shard_arguments(parser)
+    return parser
+
+
+def load_system_prompts(args):
+    """
+    ``(variant name, system prompt)`` for every ``--system_prompt_path``. The name is the file's stem,
+    or None for a single prompt, whose results keep the plain output file name.
+    """
+    if not args.system_prompt_path:
+        return [(None, DEFAULT_SYSTEM_PROMPT)]
+    prompts = []
+    for path in args.system_prompt_path:
+        print(f"Loading system prompt from {path}")
+        with open(path, "r") as f:
+            prompts.append((os.path.splitext(os.path.basename(path))[0], f.read()))
+    names = [name for name, _ in prompts]
+    if len(set(names)) != len(names):
+        raise SystemExit(f"System prompt files need distinct names for a sweep: {names}")
+    if len(prompts) == 1:
+        return [(None, prompts[0][1])]
+    return prompts
+
+
+def load_system_prompt(args):
+    prompts = load_system_prompts(args)
+    if len(prompts) > 1:
+        raise SystemExit("This entry point takes a single --system_prompt_path")
+    return prompts[0][1]
+
+
+def build_output_file(args, sharded=True, variant=None):
+    """
+    Results file for this run; with ``sharded`` it is this shard's own file when ``--num_shards`` > 1.
+    Each ``variant`` of a prompt sweep gets its own file.
+    """
+    sanitized_model_name = args.model.replace("/", "__")
+    sanitized_dataset_name = args.dataset_name.replace("/", "__")
+    sanitized_split_name = args.split.replace("/", "__")
+    variant_tag = "" if variant is None else f"_{variant}"
+
+    output_file = os.path.join(args.output_dir, f"{sanitized_model_name}_{sanitized_dataset_name}_{sanitized_split_name}{variant_tag}_results.{args.output_format}")
+    return shard_output_file(output_file, args.num_shards, args.shard_index) if sharded else output_file
+
+
+def dataset_length(args):
+    if not args.streaming:
+        return len(load_dataset(args.dataset_name, split=args.split))
+    total = split_size(stream_dataset(args.dataset_name, args.split), args.split)
+    if total is None:
+        raise SystemExit(f"The metadata of {args.dataset_name} doesn't record the size of split {args.split}")
+    return total
+
 
-    args = parser.parse_args()
+def load_inference_dataset(args):
+    if args.streaming:
+        return stream_dataset(args.dataset_name, args.split)
+    # Images stay encoded: the preprocessor keys its cache on the stored bytes and decodes only on a miss
+    return disable_image_decoding(load_dataset(args.dataset_name, split=args.split), args.image_column, strict=False)
+
+
+def build_client(args):
+    if args.endpoints:
+        return EndpointRouter(args.endpoints.split(","), api_key=API_KEY, health_interval=args.health_interval)
+    return AsyncOpenAI(base_url=BASE_URL, api_key=API_KEY)
+
+
+def build_admission(args):
+    """
+    Context-length admission control, or None unless ``--max_model_len`` is set.
+    """
+    if args.max_model_len is None:
+        return None
+    route_client = AsyncOpenAI(base_url=args.long_context_endpoint, api_key=API_KEY) if args.long_context_endpoint else None
+    if args.oversize == "route" and route_client is None:
+        print("--oversize route without --long_context_endpoint: oversized samples will be rejected")
+    return ContextBudget(
+        args.max_model_len,
+        TextTokenCounter(args.tokenizer or args.model),
+        min_pixels=args.min_pixels,
+        max_pixels=args.max_pixels,
+        min_completion_tokens=args.min_completion_tokens,
+        max_inflight_tokens=args.max_inflight_tokens,
+        route_client=route_client,
+        route_max_model_len=args.long_context_len,
+    )
+
+
+def build_telemetry(args, output_file):
+    return open_telemetry(output_file, args.telemetry, args.metrics_port)
+
+
+def build_preprocessor(args):
+    image_cache = ImageCache(args.image_cache, max_bytes=int(args.image_cache_size_gb * 1024**3)) if args.image_cache else None
+    return ImagePreprocessor(
+        cache=image_cache,
+        passthrough=args.passthrough_images,
+        max_pixels=args.max_pixels,
+        min_pixels=args.min_pixels,
+        num_workers=args.image_workers,
+    )
+
+
+def main():
+    args = build_parser().parse_args()
+    if args.max_concurrency is None:
+        args.max_concurrency = args.batch_size
+
+    if args.streaming and args.group_by_prefix:
+        raise SystemExit("--group_by_prefix reorders rows by random access and can't be combined with --streaming")
+
+    prompts = load_system_prompts(args)
+    if args.merge:
+        total = dataset_length(args)
+        incomplete = [merge_shards(build_output_file(args, sharded=False, variant=name), total, args.num_shards) for name, _ in prompts]
+        sys.exit(1 if any(incomplete) else 0)
 
     # Override BASE_URL if port is provided
     global BASE_URL
     if args.port:
         BASE_URL = f"http://localhost:{args.port}/v1"
 
-    print(f"Connecting to {BASE_URL} with model {args.model}")
+    print(f"Connecting to {args.endpoints or BASE_URL} with model {args.model} (max_concurrency={args.max_concurrency})")
 
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
 
-    system_prompt = DEFAULT_SYSTEM_PROMPT
-    if args.system_prompt_path:
-        print(f"Loading system prompt from {args.system_prompt_path}")
-        with open(args.system_prompt_path, "r") as f:
-            system_prompt = f.read()
+    variants = [PromptVariant(name, system_prompt, build_output_file(args, variant=name)) for name, system_prompt in prompts]
+    dataset = load_inference_dataset(args)
 
-    sanitized_model_name = args.model.replace("/", "__")
-    sanitized_dataset_name = args.dataset_name.replace("/", "__")
-    sanitized_split_name = args.split.replace("/", "__")
+    client = build_client(args)
 
-    output_file = os.path.join(args.output_dir, f"{sanitized_model_name}_{sanitized_dataset_name}_{sanitized_split_name}_results.jsonl")
-
-    dataset = load_dataset(args.dataset_name, split=args.split)
-
-    client = Client(base_url=BASE_URL, api_key=API_KEY)
-
-    completed_count = 0
-    # Check if output file exists to resume
-    if os.path.exists(output_file):
-        with open(output_file, "r") as f:
-            completed_count = sum(1 for _ in f)
-        print(f"Resuming from {completed_count} completed samples.")
-
-    with open(output_file, "a", buffering=1) as f_out:
-        total = len(dataset)
-        for i, item in enumerate(dataset):
-            if i < completed_count:
-                continue
-
-            if i % 10 == 0:
-                print(f"Processing {i}/{total}")
-
-            try:
-                question = item[args.question_column]
-                image_input = item[args.image_column]
-                base64_images = process_image(image_input)
-
-                content = []
-                for b64_img in base64_images:
-                    content.append(
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": f"data:image/jpeg;base64,{b64_img}"},
-                        }
-                    )
-                content.append({"type": "text", "text": question})
-
-                response = client.chat.completions.create(
-                    model=args.model,
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": content},
-                    ],
-                    max_tokens=4096,
-                    temperature=0.7,
-                )
+    # Resume from the completion manifests next to the output files
+    for variant in variants:
+        reopen_retries(args, variant.output_file, variant.manifest)
+        if len(variant.manifest):
+            print(f"Resuming with {len(variant.manifest)} completed samples" + ("." if variant.name is None else f" for {variant.name}."))
 
-                prediction = response.choices[0].message.content
-                # print(response)
+    preprocessor = build_preprocessor(args)
+    telemetry = build_telemetry(args, build_output_file(args))
+    admission = build_admission(args)
 
-                result = {
-                    "question": question,
-                    "prediction": prediction,
-                    # "answer": item.get("answer", ""), # Include ground truth if available in dataset
-                }
-                # Check if answer exists in dataset item
-                if "answer" in item:
-                    result["answer"] = item["answer"]
+    async def run():
+        try:
+            await run_inference(client, args, variants, preprocessor, dataset, telemetry=telemetry, admission=admission)
+        finally:
+            await client.close()
+            if admission:
+                await admission.close()
 
-                f_out.write(json.dumps(result) + "\n")
+    # Results are committed in batches; the manifests are marked only once they are on disk
+    with contextlib.ExitStack() as stack:
+        for variant in variants:
+            variant.result_writer = stack.enter_context(ResultWriter(variant.output_file, manifest=variant.manifest))
+        asyncio.run(run())
 
-            except Exception as e:
-                print(f"Error processing sample {i}: {e}")
-                # Optionally write error to a log file or continue
+    for variant in variants:
+        variant.manifest.close()
+    preprocessor.close()
+    if admission:
+        admission.report()
+    if telemetry:
+        telemetry.report()
+        telemetry.close()
 
 
 if __name__ == "__main__":
@@ -1,9 +1,20 @@
-import json
 import os
-from openai import OpenAI
+import time
+import asyncio
+import argparse
+from openai import AsyncOpenAI, OpenAI
 from tqdm import tqdm
 import dotenv
 
+from utils.answer_match import match_answer
+from utils.batch_api import BatchRunner
+from utils.candidates import candidate_units, for_each_candidate, lift_candidate_errors, summarize_verdicts
+from utils.concurrency import OrderedBuffer, bounded_map
+from utils.rate_limit import TokenBucketLimiter, estimate_tokens
+from utils.response_cache import ResponseCache, open_response_cache
+from utils.result_io import OUTPUT_FORMATS, ResultWriter, iter_records, resolve_input, with_format
+from utils.telemetry import open_telemetry, openai_usage
+
 dotenv.load_dotenv()
 
 # Files
@@ -14,6 +25,11 @@ OUTPUT_FILE = "output/judge_filtered_reasoning_v3_v2.jsonl"
 MODEL = "gpt-4.1-nano-2025-04-14"
 API_KEY = os.getenv("OPENAI_API_KEY", None)
 
+# Rate limits of the account tier; requests are paced to stay just under them
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", 64))
+REQUESTS_PER_MINUTE = float(os.getenv("REQUESTS_PER_MINUTE", 500))
+TOKENS_PER_MINUTE = float(os.getenv("TOKENS_PER_MINUTE", 200_000))
+
 
 BINARY_JUDGE_PROMPT = """You are a strict evaluator assessing answer correctness. You must output {positive} for fully correct answers and {negative} for any other case.
 
@@ -44,59 +60,224 @@ Model Prediction:
 {positive} or {negative}"""
 
 
-def refine_jsonl():
-    client = OpenAI(api_key=API_KEY)
+def build_messages(record, prediction):
+    return [
+        {"role": "user", "content": BINARY_JUDGE_PROMPT.format(question=record["question"], answer=record["answer"], prediction=prediction, positive="1", negative="0")},
+    ]
+
+
+async def judge_one(client, limiter, record, cache=None, rule_match=True, telemetry=None):
+    """
+    Add ``judge_result`` to a record, or ``error`` if the API call fails.
+    Clear-cut cases are settled by ``match_answer`` without an API call when ``rule_match`` is set;
+    ``judge_method`` records which path decided. Responses already in ``cache`` for the same model
+    and rendered prompt are reused. Multi-candidate records get a verdict per candidate, and a
+    record-level ``judge_result`` of "1" if any candidate was accepted.
+    """
+    if "candidates" in record:
+        await for_each_candidate(record, lambda view: judge_one(client, limiter, view, cache=cache, rule_match=rule_match, telemetry=telemetry), ["judge_result", "judge_method"])
+        summarize_verdicts(record)
+        return record
+
+    prediction = record.get("refined_prediction", "")
+
+    if not prediction:
+        # If no prediction, just write the record as is or skip?
+        # We'll write it through without refinement.
+        return record
+
+    if rule_match:
+        verdict = match_answer(record.get("question", ""), record.get("answer", ""), prediction)
+        if verdict is not None:
+            record["judge_result"] = verdict
+            record["judge_method"] = "rule"
+            return record
+
+    # Prepare the prompt for refinement
+    messages = build_messages(record, prediction)
+
+    key = ResponseCache.request_key(MODEL, messages) if cache else None
+    cached = cache.get_text(key) if cache else None
+    if cached is not None:
+        record["judge_result"] = cached
+        record["judge_method"] = "llm"
+        return record
+
+    # The verdict is a single token, so the prompt dominates the cost
+    queued = time.monotonic()
+    estimated = await limiter.acquire(estimate_tokens(messages[0]["content"]) + 1)
+    sent = time.monotonic()
+    try:
+        response = await client.chat.completions.create(model=MODEL, messages=messages)
+        limiter.settle(estimated, response.usage.total_tokens if response.usage else None)
+        if telemetry:
+            telemetry.record("judge", MODEL, record.get("sample_id"), queue_wait_s=sent - queued, latency_s=time.monotonic() - sent, **openai_usage(response.usage))
+
+        judge_result = response.choices[0].message.content
+        record["judge_result"] = judge_result
+        record["judge_method"] = "llm"
+        if cache and judge_result is not None:
+            cache.put_text(key, judge_result)
+
+    except Exception as e:
+        print(f"API call failed: {e}")
+        if telemetry:
+            telemetry.record("judge", MODEL, record.get("sample_id"), queue_wait_s=sent - queued, latency_s=time.monotonic() - sent, error=e)
+        # We keep the record even if API fails, maybe mark it
+        record["error"] = str(e)
+
+    return record
+
+
+def count_rule_matches(record):
+    """
+    (predictions settled by rules, predictions judged) for one record, counting each candidate.
+    """
+    judged = [entry for entry in record.get("candidates", [record]) if "judge_result" in entry]
+    return sum(entry.get("judge_method") == "rule" for entry in judged), len(judged)
+
+
+def report_rule_matches(by_rule, judged):
+    print(f"Rule-based matching settled {by_rule}/{judged} judged predictions ({by_rule / judged if judged else 0.0:.1%}) without an LLM call")
+
 
-    if not os.path.exists(INPUT_FILE):
+async def judge_record(client, limiter, record, cache=None, rule_match=True, telemetry=None):
+    """
+    Judge one input record. Returns the record to write, or None if it failed unexpectedly.
+    """
+    try:
+        return await judge_one(client, limiter, record, cache=cache, rule_match=rule_match, telemetry=telemetry)
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+    return None
+
+
+async def judge_records(client, records, output, cache=None, rule_match=True, telemetry=None):
+    limiter = TokenBucketLimiter(requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE)
+    # Responses arrive out of order; the buffer writes them back in input order
+    writer = OrderedBuffer(output.write)
+    by_rule = judged = 0
+
+    with tqdm(desc="Processing records") as progress:
+        async for position, record in bounded_map(lambda record: judge_record(client, limiter, record, cache=cache, rule_match=rule_match, telemetry=telemetry), records, MAX_CONCURRENCY):
+            writer.put(position, record)
+            if record is not None:
+                record_by_rule, record_judged = count_rule_matches(record)
+                by_rule += record_by_rule
+                judged += record_judged
+            progress.update(1)
+
+    report_rule_matches(by_rule, judged)
+
+
+def refine_jsonl(rule_match=True, telemetry=False, metrics_port=None):
+    client = AsyncOpenAI(api_key=API_KEY, max_retries=5)
+
+    input_file = resolve_input(INPUT_FILE)
+    if not os.path.exists(input_file):
         print(f"Input file not found: {INPUT_FILE}")
         return
 
     # Ensure output directory exists
     os.makedirs(os.path.dirname(OUTPUT_FILE), exist_ok=True)
 
-    print(f"Reading from {INPUT_FILE}...")
-    with open(INPUT_FILE, "r", encoding="utf-8") as infile, open(OUTPUT_FILE, "w", encoding="utf-8") as outfile:
+    cache = open_response_cache()
+    telemetry = open_telemetry(OUTPUT_FILE, telemetry, metrics_port)
 
-        for line in tqdm(infile, desc="Processing lines"):
-            line = line.strip()
-            if not line:
-                continue
+    print(f"Reading from {input_file}...")
+    with ResultWriter(OUTPUT_FILE, overwrite=True) as output:
+        asyncio.run(judge_records(client, iter_records(input_file), output, cache=cache, rule_match=rule_match, telemetry=telemetry))
+
+    if cache:
+        cache.report()
+        cache.close()
 
-            try:
-                record = json.loads(line)
-                prediction = record.get("refined_prediction", "")
+    if telemetry:
+        telemetry.report()
+        telemetry.close()
 
-                if not prediction:
-                    # If no prediction, just write the record as is or skip?
-                    # We'll write it through without refinement.
-                    outfile.write(json.dumps(record) + "\n")
-                    continue
 
-                # Prepare the prompt for refinement
-                messages = [
-                    {"role": "user", "content": BINARY_JUDGE_PROMPT.format(question=record["question"], answer=record["answer"], prediction=prediction, positive="1", negative="0")},
-                ]
+def judge_jsonl_batch(poll_interval, rule_match=True):
+    """
+    Judge every record through the Batch API. Batch state lives next to the output file, so
+    rerunning after an interruption re-attaches to the submitted batches. Records settled by
+    ``match_answer`` never enter the batch.
+    """
+    client = OpenAI(api_key=API_KEY)
 
-                try:
-                    response = client.chat.completions.create(model=MODEL, messages=messages)
+    input_file = resolve_input(INPUT_FILE)
+    if not os.path.exists(input_file):
+        print(f"Input file not found: {INPUT_FILE}")
+        return
+
+    # Ensure output directory exists
+    os.makedirs(os.path.dirname(OUTPUT_FILE), exist_ok=True)
+
+    print(f"Reading from {input_file}...")
+    records = list(iter_records(input_file))
+
+    # One request per prediction (per candidate for multi-candidate records); only those the rules
+    # can't settle and without a cached response go into the batch
+    cache = open_response_cache()
+    keys, cached, messages = {}, {}, {}
+    for custom_id, target, view in candidate_units(records):
+        if view.get("refined_prediction"):
+            verdict = match_answer(view.get("question", ""), view.get("answer", ""), view["refined_prediction"]) if rule_match else None
+            if verdict is not None:
+                target["judge_result"] = verdict
+                target["judge_method"] = "rule"
+                continue
+            messages[custom_id] = build_messages(view, view["refined_prediction"])
+            keys[custom_id] = ResponseCache.request_key(MODEL, messages[custom_id])
+            content = cache.get_text(keys[custom_id]) if cache else None
+            if content is not None:
+                cached[custom_id] = content
 
-                    judge_result = response.choices[0].message.content
-                    record["judge_result"] = judge_result
+    requests = ((custom_id, {"model": MODEL, "messages": messages[custom_id]}) for custom_id in keys if custom_id not in cached)
+    results = BatchRunner(client, OUTPUT_FILE + ".batch", poll_interval=poll_interval).run(requests)
 
-                except Exception as e:
-                    print(f"API call failed: {e}")
-                    # We keep the record even if API fails, maybe mark it
-                    record["error"] = str(e)
+    for custom_id, target, _ in candidate_units(records):
+        if custom_id in cached:
+            target["judge_result"] = cached[custom_id]
+            target["judge_method"] = "llm"
+        elif custom_id in keys:
+            result = results.get(custom_id, {"error": "missing from batch output"})
+            if "error" in result:
+                target["error"] = result["error"]
+            else:
+                target["judge_result"] = result["content"]
+                target["judge_method"] = "llm"
+                if cache and result["content"] is not None:
+                    cache.put_text(keys[custom_id], result["content"])
 
-                outfile.write(json.dumps(record) + "\n")
-                outfile.flush()
+    by_rule = judged = 0
+    with ResultWriter(OUTPUT_FILE, overwrite=True) as output:
+        for record in records:
+            lift_candidate_errors(record)
+            summarize_verdicts(record)
+            record_by_rule, record_judged = count_rule_matches(record)
+            by_rule += record_by_rule
+            judged += record_judged
+            output.write(record)
 
-            except json.JSONDecodeError:
-                print(f"Failed to decode JSON: {line[:50]}...")
-            except Exception as e:
-                print(f"Unexpected error: {e}")
+    report_rule_matches(by_rule, judged)
+    if cache:
+        cache.report()
+        cache.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Judge refined predictions against ground truth with an LLM.")
+    parser.add_argument("--mode", choices=["online", "batch"], default="online", help="Concurrent online requests or the asynchronous Batch API.")
+    parser.add_argument("--poll_interval", type=float, default=60.0, help="Seconds between batch status checks.")
+    parser.add_argument("--no_rule_match", action="store_true", help="Send every record to the LLM instead of settling clear-cut cases with rule-based matching.")
+    parser.add_argument("--telemetry", action="store_true", help="Record per-request latency/token metrics to a .metrics.jsonl sidecar next to the output.")
+    parser.add_argument("--metrics_port", type=int, default=None, help="Also serve the metrics in Prometheus text format on this port (implies --telemetry).")
+    parser.add_argument("--output_format", choices=OUTPUT_FORMATS, default=None, help="Write the output as JSONL, zstd-compressed JSONL or Parquet parts instead of the format OUTPUT_FILE names.")
+    args = parser.parse_args()
+    OUTPUT_FILE = with_format(OUTPUT_FILE, args.output_format)
 
-    refine_jsonl()
+    if args.mode == "batch":
+        judge_jsonl_batch(args.poll_interval, rule_match=not args.no_rule_match)
+    else:
+        refine_jsonl(rule_match=not args.no_rule_match, telemetry=args.telemetry, metrics_port=args.metrics_port)
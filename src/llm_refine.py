@@ -1,9 +1,21 @@
-import json
 import os
-from openai import OpenAI
+import copy
+import time
+import asyncio
+import argparse
+import contextlib
+from openai import AsyncOpenAI, OpenAI
 from tqdm import tqdm
 import dotenv
 
+from utils.batch_api import BatchRunner
+from utils.candidates import candidate_units, for_each_candidate, lift_candidate_errors
+from utils.concurrency import OrderedBuffer, bounded_map
+from utils.rate_limit import TokenBucketLimiter, estimate_tokens
+from utils.response_cache import ResponseCache, open_response_cache
+from utils.result_io import OUTPUT_FORMATS, ResultWriter, iter_records, output_format, resolve_input, with_format
+from utils.telemetry import open_telemetry, openai_usage
+
 dotenv.load_dotenv()
 
 # Files
@@ -18,60 +30,242 @@ with open(REFINE_PROMPT_PATH, "r", encoding="utf-8") as f:
 MODEL = "gpt-4.1-nano-2025-04-14"
 API_KEY = os.getenv("OPENAI_API_KEY", None)
 
+# Rate limits of the account tier; requests are paced to stay just under them
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", 64))
+REQUESTS_PER_MINUTE = float(os.getenv("REQUESTS_PER_MINUTE", 500))
+TOKENS_PER_MINUTE = float(os.getenv("TOKENS_PER_MINUTE", 200_000))
+
+
+def load_refine_prompts(paths):
+    """
+    ``(variant name, prompt)`` per refine prompt file; the name is the file's stem, or None for a
+    single prompt, whose output keeps the plain ``OUTPUT_FILE`` name.
+    """
+    if not paths:
+        return [(None, REFINE_PROMPT)]
+    prompts = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            prompts.append((os.path.splitext(os.path.basename(path))[0], f.read()))
+    names = [name for name, _ in prompts]
+    if len(set(names)) != len(names):
+        raise SystemExit(f"Refine prompt files need distinct names for a sweep: {names}")
+    return [(None, prompts[0][1])] if len(prompts) == 1 else prompts
+
+
+def variant_output_file(name):
+    if name is None:
+        return OUTPUT_FILE
+    fmt = output_format(OUTPUT_FILE)
+    return f"{OUTPUT_FILE[: -len(fmt) - 1]}_{name}.{fmt}"
+
+
+def build_messages(prediction, prompt=None):
+    return [
+        {"role": "user", "content": (prompt or REFINE_PROMPT).format(input=prediction)},
+    ]
+
+
+async def refine_one(client, limiter, record, cache=None, telemetry=None, prompt=None, stage="refine"):
+    """
+    Add ``refined_prediction`` to a record, or ``error`` if the API call fails.
+    Multi-candidate records get one refinement per candidate.
+    Responses already in ``cache`` for the same model and rendered prompt are reused.
+    ``prompt`` overrides ``REFINE_PROMPT``; ``stage`` labels the telemetry records.
+    """
+    if "candidates" in record:
+        return await for_each_candidate(
+            record, lambda view: refine_one(client, limiter, view, cache=cache, telemetry=telemetry, prompt=prompt, stage=stage), ["refined_prediction"]
+        )
+
+    prediction = record.get("prediction", "")
+
+    if not prediction:
+        # If no prediction, just write the record as is or skip?
+        # We'll write it through without refinement.
+        return record
+
+    # Prepare the prompt for refinement
+    messages = build_messages(prediction, prompt)
+
+    key = ResponseCache.request_key(MODEL, messages) if cache else None
+    cached = cache.get_text(key) if cache else None
+    if cached is not None:
+        record["refined_prediction"] = cached
+        return record
+
+    # The refined output is roughly as long as the prediction it rewrites
+    queued = time.monotonic()
+    estimated = await limiter.acquire(estimate_tokens(messages[0]["content"]) + estimate_tokens(prediction))
+    sent = time.monotonic()
+    try:
+        response = await client.chat.completions.create(model=MODEL, messages=messages)
+        limiter.settle(estimated, response.usage.total_tokens if response.usage else None)
+        if telemetry:
+            telemetry.record(stage, MODEL, record.get("sample_id"), queue_wait_s=sent - queued, latency_s=time.monotonic() - sent, **openai_usage(response.usage))
+
+        refined_content = response.choices[0].message.content
+        record["refined_prediction"] = refined_content
+        if cache and refined_content is not None:
+            cache.put_text(key, refined_content)
+
+    except Exception as e:
+        print(f"API call failed: {e}")
+        if telemetry:
+            telemetry.record(stage, MODEL, record.get("sample_id"), queue_wait_s=sent - queued, latency_s=time.monotonic() - sent, error=e)
+        # We keep the record even if API fails, maybe mark it
+        record["error"] = str(e)
+
+    return record
 
-def refine_jsonl():
-    client = OpenAI(api_key=API_KEY)
 
-    if not os.path.exists(INPUT_FILE):
+async def refine_record(client, limiter, record, cache=None, telemetry=None, prompt=None, stage="refine"):
+    """
+    Refine one input record. Returns the record to write, or None if it failed unexpectedly.
+    """
+    try:
+        return await refine_one(client, limiter, record, cache=cache, telemetry=telemetry, prompt=prompt, stage=stage)
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+    return None
+
+
+async def refine_variants(client, limiter, record, prompts, cache=None, telemetry=None):
+    """
+    Refine one input record with every prompt of a sweep concurrently; each variant works on its own copy.
+    """
+    if len(prompts) == 1:
+        return [await refine_record(client, limiter, record, cache=cache, telemetry=telemetry, prompt=prompts[0][1])]
+    return await asyncio.gather(
+        *(refine_record(client, limiter, copy.deepcopy(record), cache=cache, telemetry=telemetry, prompt=prompt, stage=f"refine[{name}]") for name, prompt in prompts)
+    )
+
+
+async def refine_records(client, records, outputs, prompts, cache=None, telemetry=None):
+    """
+    Refine ``records`` once per prompt in ``prompts``, writing each variant to the matching writer in ``outputs``.
+    The input is read once; every record fans out into one request per prompt.
+    """
+    limiter = TokenBucketLimiter(requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE)
+    # Responses arrive out of order; the buffers write them back in input order
+    writers = [OrderedBuffer(output.write) for output in outputs]
+    concurrency = max(1, MAX_CONCURRENCY // len(prompts))
+
+    with tqdm(desc="Processing records") as progress:
+        async for position, results in bounded_map(lambda record: refine_variants(client, limiter, record, prompts, cache=cache, telemetry=telemetry), records, concurrency):
+            for writer, record in zip(writers, results):
+                writer.put(position, record)
+            progress.update(1)
+
+
+def refine_jsonl(prompts, telemetry=False, metrics_port=None):
+    client = AsyncOpenAI(api_key=API_KEY, max_retries=5)
+
+    input_file = resolve_input(INPUT_FILE)
+    if not os.path.exists(input_file):
         print(f"Input file not found: {INPUT_FILE}")
         return
 
     # Ensure output directory exists
     os.makedirs(os.path.dirname(OUTPUT_FILE), exist_ok=True)
 
-    print(f"Reading from {INPUT_FILE}...")
-    with open(INPUT_FILE, "r", encoding="utf-8") as infile, open(OUTPUT_FILE, "w", encoding="utf-8") as outfile:
+    cache = open_response_cache()
+    telemetry = open_telemetry(OUTPUT_FILE, telemetry, metrics_port)
+
+    print(f"Reading from {input_file}...")
+    with contextlib.ExitStack() as stack:
+        outputs = [stack.enter_context(ResultWriter(variant_output_file(name), overwrite=True)) for name, _ in prompts]
+        asyncio.run(refine_records(client, iter_records(input_file), outputs, prompts, cache=cache, telemetry=telemetry))
 
-        for line in tqdm(infile, desc="Processing lines"):
-            line = line.strip()
-            if not line:
-                continue
+    if cache:
+        cache.report()
+        cache.close()
 
-            try:
-                record = json.loads(line)
-                prediction = record.get("prediction", "")
+    if telemetry:
+        telemetry.report()
+        telemetry.close()
 
-                if not prediction:
-                    # If no prediction, just write the record as is or skip?
-                    # We'll write it through without refinement.
-                    outfile.write(json.dumps(record) + "\n")
-                    continue
 
-                # Prepare the prompt for refinement
-                messages = [
-                    {"role": "user", "content": REFINE_PROMPT.format(input=prediction)},
-                ]
+def refine_jsonl_batch(prompts, poll_interval):
+    """
+    Refine every record through the Batch API. Batch state lives next to the output file, so
+    rerunning after an interruption re-attaches to the submitted batches. A prompt sweep submits
+    every variant's requests in the same batch.
+    """
+    client = OpenAI(api_key=API_KEY)
+
+    input_file = resolve_input(INPUT_FILE)
+    if not os.path.exists(input_file):
+        print(f"Input file not found: {INPUT_FILE}")
+        return
+
+    # Ensure output directory exists
+    os.makedirs(os.path.dirname(OUTPUT_FILE), exist_ok=True)
+
+    print(f"Reading from {input_file}...")
+    records = list(iter_records(input_file))
+    # Every variant fills in its own copy of the records; custom IDs are prefixed with the variant's position
+    variants = [(f"p{i}-" if len(prompts) > 1 else "", prompt, copy.deepcopy(records) if len(prompts) > 1 else records) for i, (_, prompt) in enumerate(prompts)]
 
-                try:
-                    response = client.chat.completions.create(model=MODEL, messages=messages)
+    # One request per prediction (per candidate for multi-candidate records); only those without a cached response go into the batch
+    cache = open_response_cache()
+    keys, cached, messages = {}, {}, {}
+    for prefix, prompt, variant_records in variants:
+        for custom_id, _, view in candidate_units(variant_records):
+            if view.get("prediction"):
+                custom_id = prefix + custom_id
+                messages[custom_id] = build_messages(view["prediction"], prompt)
+                keys[custom_id] = ResponseCache.request_key(MODEL, messages[custom_id])
+                content = cache.get_text(keys[custom_id]) if cache else None
+                if content is not None:
+                    cached[custom_id] = content
 
-                    refined_content = response.choices[0].message.content
-                    record["refined_prediction"] = refined_content
+    requests = ((custom_id, {"model": MODEL, "messages": messages[custom_id]}) for custom_id in keys if custom_id not in cached)
+    results = BatchRunner(client, OUTPUT_FILE + ".batch", poll_interval=poll_interval).run(requests)
 
-                except Exception as e:
-                    print(f"API call failed: {e}")
-                    # We keep the record even if API fails, maybe mark it
-                    record["error"] = str(e)
+    for (name, _), (prefix, _, variant_records) in zip(prompts, variants):
+        for custom_id, target, _ in candidate_units(variant_records):
+            custom_id = prefix + custom_id
+            if custom_id in cached:
+                target["refined_prediction"] = cached[custom_id]
+            elif custom_id in keys:
+                result = results.get(custom_id, {"error": "missing from batch output"})
+                if "error" in result:
+                    target["error"] = result["error"]
+                else:
+                    target["refined_prediction"] = result["content"]
+                    if cache and result["content"] is not None:
+                        cache.put_text(keys[custom_id], result["content"])
 
-                outfile.write(json.dumps(record) + "\n")
-                outfile.flush()
+        with ResultWriter(variant_output_file(name), overwrite=True) as output:
+            for record in variant_records:
+                lift_candidate_errors(record)
+                output.write(record)
 
-            except json.JSONDecodeError:
-                print(f"Failed to decode JSON: {line[:50]}...")
-            except Exception as e:
-                print(f"Unexpected error: {e}")
+    if cache:
+        cache.report()
+        cache.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refine model reasoning traces with an LLM.")
+    parser.add_argument("--mode", choices=["online", "batch"], default="online", help="Concurrent online requests or the asynchronous Batch API.")
+    parser.add_argument("--poll_interval", type=float, default=60.0, help="Seconds between batch status checks.")
+    parser.add_argument("--telemetry", action="store_true", help="Record per-request latency/token metrics to a .metrics.jsonl sidecar next to the output.")
+    parser.add_argument("--metrics_port", type=int, default=None, help="Also serve the metrics in Prometheus text format on this port (implies --telemetry).")
+    parser.add_argument("--output_format", choices=OUTPUT_FORMATS, default=None, help="Write the output as JSONL, zstd-compressed JSONL or Parquet parts instead of the format OUTPUT_FILE names.")
+    parser.add_argument(
+        "--refine_prompt_path",
+        type=str,
+        nargs="+",
+        default=None,
+        help=f"Refine prompt file (default {REFINE_PROMPT_PATH}). Several files run a sweep over one pass of the input, writing OUTPUT_FILE with each file's stem appended.",
+    )
+    args = parser.parse_args()
+    OUTPUT_FILE = with_format(OUTPUT_FILE, args.output_format)
+    prompts = load_refine_prompts(args.refine_prompt_path)
 
-    refine_jsonl()
+    if args.mode == "batch":
+        refine_jsonl_batch(prompts, args.poll_interval)
+    else:
+        refine_jsonl(prompts, telemetry=args.telemetry, metrics_port=args.metrics_port)
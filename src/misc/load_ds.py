@@ -1,16 +1,35 @@
 import os
 import re
+import sys
 import datasets
 from datasets import load_dataset
-from PIL import Image
 
-IMG_ROOT = "data_viscot/cot_images_tar_split/cot_image_data"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.dataset_builder import build_parquet_shards, load_built_dataset, stratified_subset  # noqa: E402
+from utils.images import ensure_rgb_bytes  # noqa: E402
+from utils.tar_index import TarArchiveReader  # noqa: E402
+
+TAR_DIR = "data_viscot/cot_images_tar_split"
+IMG_ROOT = os.path.join(TAR_DIR, "cot_image_data")
+OUTPUT_DIR = "data/hf/Visual-CoT-60k"
+NUM_SAMPLES = 60_000
+
+# Read images straight from the split archive once it has been indexed (src/utils/tar_index.py);
+# otherwise expect it extracted under IMG_ROOT
+ARCHIVE = TarArchiveReader(TAR_DIR) if TarArchiveReader.available(TAR_DIR) else None
+
+
+def read_image_bytes(img_path):
+    if ARCHIVE is not None:
+        return ARCHIVE.read(img_path)
+    with open(img_path, "rb") as f:
+        return f.read()
 
 
 def process_example(example):
     img_paths = example["image"]
     if not img_paths:
-        return example
+        return None
     imgs = []
     for i, img_path in enumerate(img_paths):
         if "###" in img_path:
@@ -21,7 +40,8 @@ def process_example(example):
             # imgs.append(Image.open(img_path).convert("RGB").crop(bbox))
         else:
             img_path = os.path.join(IMG_ROOT, img_path.replace("cot/", ""))
-            imgs.append(Image.open(img_path).convert("RGB"))
+            # Kept encoded; only non-RGB sources are converted
+            imgs.append({"bytes": ensure_rgb_bytes(read_image_bytes(img_path)), "path": img_path})
     assert len(imgs) == 1
     example["image"] = imgs[0]
 
@@ -49,17 +69,25 @@ def process_example(example):
 def main():
     cpus = int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count()))
     print("CPU Count: ", cpus)
+    print(f"Reading images from {'indexed archive in ' + TAR_DIR if ARCHIVE else IMG_ROOT}")
     ds = load_dataset("json", data_files="data_viscot/viscot_363k.json", split="train")
     # ds = ds.select(range(100))
     print(ds)
     print(ds[0])
 
-    ds: datasets.Dataset = ds.cast_column("dataset", datasets.ClassLabel(names=ds.unique("dataset")))
-    _, ds = ds.train_test_split(test_size=60_000, stratify_by_column="dataset").values()
-    print(ds)
+    # Pick the stratified subset from the "dataset" column alone, then read only its images
+    subset = ds.select(stratified_subset(ds, NUM_SAMPLES, column="dataset"))
+    subset = subset.cast_column("dataset", datasets.ClassLabel(names=ds.unique("dataset")))
+    print(subset)
+
+    features = subset.features.copy()
+    features["image"] = datasets.Image()
+    features["question"] = datasets.Value("string")
+    features["answer"] = datasets.Value("string")
+    build_parquet_shards(subset, list(range(len(subset))), process_example, features, OUTPUT_DIR, num_workers=max(cpus - 1, 1))
 
-    ds = ds.map(process_example, num_proc=max(cpus - 1, 1))
-    ds = ds.cast_column("image", datasets.Image())
+    ds = load_built_dataset(OUTPUT_DIR)
+    print(ds)
     print(ds[0])
     ds.push_to_hub("Visual-CoT-60k", split="train")
 
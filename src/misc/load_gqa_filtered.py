@@ -1,18 +1,35 @@
 import os
-import re
+import sys
 import datasets
 from datasets import load_dataset
-from PIL import Image
 
-IMG_ROOT = "data_viscot/cot_images_tar_split/cot_image_data/gqa"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.dataset_builder import build_parquet_shards, load_built_dataset, stratified_subset  # noqa: E402
+from utils.images import ensure_rgb_bytes  # noqa: E402
+from utils.tar_index import TarArchiveReader  # noqa: E402
+
+TAR_DIR = "data_viscot/cot_images_tar_split"
+IMG_ROOT = os.path.join(TAR_DIR, "cot_image_data", "gqa")
+OUTPUT_DIR = "data/hf/Visual-CoT-GQA-2k"
+NUM_SAMPLES = 2000
+
+# Read images straight from the split archive once it has been indexed (src/utils/tar_index.py);
+# otherwise expect it extracted under IMG_ROOT
+ARCHIVE = TarArchiveReader(TAR_DIR) if TarArchiveReader.available(TAR_DIR) else None
 
 
 def process_example(example):
     img_path = example["image"]
     if not img_path:
-        return example
+        return None
     img_path = os.path.join(IMG_ROOT, img_path)
-    example["image"] = img_path
+    if ARCHIVE is not None:
+        data = ARCHIVE.read(img_path)
+    else:
+        with open(img_path, "rb") as f:
+            data = f.read()
+    # Kept encoded; only non-RGB sources are converted
+    example["image"] = {"bytes": ensure_rgb_bytes(data), "path": img_path}
 
     return example
 
@@ -20,17 +37,18 @@ def process_example(example):
 def main():
     cpus = int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count()))
     print("CPU Count: ", cpus)
+    print(f"Reading images from {'indexed archive in ' + TAR_DIR if ARCHIVE else IMG_ROOT}")
     ds = load_dataset("json", data_files="data_viscot/gqa_cot_train_filtered_heuristic.jsonl", split="train")
     # ds = ds.select(range(100))
     print(ds)
     print(ds[0])
 
-    ds = ds.map(process_example, num_proc=max(cpus - 1, 1))
+    features = ds.features.copy()
+    features["image"] = datasets.Image()
+    build_parquet_shards(ds, stratified_subset(ds, NUM_SAMPLES), process_example, features, OUTPUT_DIR, num_workers=max(cpus - 1, 1))
 
-    _, ds = ds.train_test_split(test_size=2000).values()
+    ds = load_built_dataset(OUTPUT_DIR)
     print(ds)
-
-    ds = ds.cast_column("image", datasets.Image())
     print(ds[0])
     ds.push_to_hub("Visual-CoT-GQA-2k", split="train")
 
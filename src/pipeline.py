@@ -0,0 +1,260 @@
+"""
+Streaming generate -> refine -> judge pipeline.
+
+Stages run concurrently and are connected by bounded queues, so a sample is refined and judged
+as soon as its Qwen3-VL prediction lands and a slow stage applies backpressure upstream. Each
+stage checkpoints to its own JSONL plus completion manifest keyed by ``sample_id``; on restart a
+stage replays whatever its upstream checkpoint has that it hasn't finished yet.
+
+    python src/pipeline.py --port 10630 --max_concurrency 64 --system_prompt_path configs/prompts/think_first_v0.txt --push_to_hub ohjoonhee/Visual-CoT-4k-Sharegpt
+"""
+
+import os
+import asyncio
+from openai import AsyncOpenAI
+
+import llm_judge
+import llm_refine
+import gemini_refine
+from infer.vlm import qwen3vl
+from utils.manifest import CompletionManifest
+from utils.rate_limit import TokenBucketLimiter
+from utils.response_cache import open_response_cache
+from utils.result_io import ResultWriter, iter_records, with_format
+from utils.sharding import merge_shards, resolve_shard, shard_output_file
+
+END = None
+
+
+class StageCheckpoint:
+    """
+    Append-only output of one stage plus its completion manifest.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest = CompletionManifest.for_output(path)
+        self.writer = ResultWriter(path, manifest=self.manifest)
+
+    def unfinished_from(self, upstream):
+        """
+        Records in the upstream checkpoint that this stage has not completed yet.
+        """
+        records = {}
+        if os.path.exists(upstream.path):
+            for record in iter_records(upstream.path):
+                if record["sample_id"] not in self.manifest:
+                    records[record["sample_id"]] = record
+        return list(records.values())
+
+    def write(self, record):
+        self.writer.write(record)
+
+    def close(self):
+        self.writer.close()
+        self.manifest.close()
+
+
+async def run_stage(name, process, replay, in_queue, out_queue, checkpoint, concurrency):
+    """
+    Process replayed items, then items from ``in_queue`` until ``END``, with up to ``concurrency``
+    in flight. Successful records are checkpointed and forwarded; failed ones, including those whose
+    processing or checkpoint write raised, are left for the next run. ``END`` is always sent
+    downstream, even if the stage itself dies, so later stages don't wait forever.
+    """
+    slots = asyncio.Semaphore(concurrency)
+    tasks = set()
+    done = failed = 0
+
+    async def handle(item):
+        nonlocal done, failed
+        try:
+            record = await process(item)
+            if record is None or "error" in record:
+                failed += 1
+                return
+            checkpoint.write(record)
+            done += 1
+            if done % 50 == 0:
+                print(f"[{name}] {done} done, {failed} failed, {len(tasks)} in flight")
+            if out_queue is not None:
+                await out_queue.put(record)
+        except Exception as e:
+            failed += 1
+            print(f"[{name}] {type(e).__name__}: {e}")
+        finally:
+            slots.release()
+
+    async def items():
+        for item in replay:
+            yield item
+        if in_queue is not None:
+            while (item := await in_queue.get()) is not END:
+                yield item
+
+    try:
+        async for item in items():
+            await slots.acquire()
+            task = asyncio.create_task(handle(item))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        await asyncio.gather(*tasks)
+        print(f"[{name}] finished: {done} done, {failed} failed")
+    finally:
+        if out_queue is not None:
+            await out_queue.put(END)
+
+
+async def run_pipeline(args, dataset, system_prompt, preprocessor, checkpoints, response_cache=None, telemetry=None, admission=None):
+    generate_ckpt, refine_ckpt, judge_ckpt = checkpoints
+
+    generate_client = qwen3vl.build_client(args)
+    if args.refine_backend == "gemini":
+        from google import genai
+
+        refine_module, refine_client = gemini_refine, genai.Client()
+    else:
+        refine_module, refine_client = llm_refine, AsyncOpenAI(api_key=llm_refine.API_KEY, max_retries=5)
+    judge_client = AsyncOpenAI(api_key=llm_judge.API_KEY, max_retries=5)
+    refine_limiter = TokenBucketLimiter(requests_per_minute=refine_module.REQUESTS_PER_MINUTE, tokens_per_minute=refine_module.TOKENS_PER_MINUTE)
+    judge_limiter = TokenBucketLimiter(requests_per_minute=llm_judge.REQUESTS_PER_MINUTE, tokens_per_minute=llm_judge.TOKENS_PER_MINUTE)
+
+    # Bounded queues give backpressure: a stage that falls behind stalls the ones feeding it
+    refine_queue = asyncio.Queue(maxsize=2 * args.refine_concurrency)
+    judge_queue = asyncio.Queue(maxsize=2 * args.judge_concurrency)
+
+    # Snapshot replays before any stage starts writing, so live records are never replayed twice
+    refine_replay = refine_ckpt.unfinished_from(generate_ckpt)
+    judge_replay = judge_ckpt.unfinished_from(refine_ckpt)
+    pending_indices = qwen3vl.pending_order(args, dataset, generate_ckpt.manifest.missing(resolve_shard(args, len(dataset))), system_prompt)
+    print(f"Pending: {len(pending_indices)} to generate, {len(refine_replay)} to refine, {len(judge_replay)} to judge from checkpoints")
+
+    judge_counts = {"rule": 0, "judged": 0}
+
+    async def judge(record):
+        record = await llm_judge.judge_one(judge_client, judge_limiter, record, cache=response_cache, rule_match=not args.no_rule_match, telemetry=telemetry)
+        if record is not None:
+            by_rule, judged = llm_judge.count_rule_matches(record)
+            judge_counts["rule"] += by_rule
+            judge_counts["judged"] += judged
+        return record
+
+    await asyncio.gather(
+        run_stage(
+            "generate",
+            lambda pair: qwen3vl.infer_sample(generate_client, args, system_prompt, preprocessor, *pair, telemetry=telemetry, admission=admission),
+            zip(pending_indices, dataset.select(pending_indices)),
+            None,
+            refine_queue,
+            generate_ckpt,
+            args.max_concurrency,
+        ),
+        run_stage(
+            "refine",
+            lambda record: refine_module.refine_one(refine_client, refine_limiter, record, cache=response_cache, telemetry=telemetry),
+            refine_replay,
+            refine_queue,
+            judge_queue,
+            refine_ckpt,
+            args.refine_concurrency,
+        ),
+        run_stage(
+            "judge",
+            judge,
+            judge_replay,
+            judge_queue,
+            None,
+            judge_ckpt,
+            args.judge_concurrency,
+        ),
+    )
+    await generate_client.close()
+    if admission:
+        await admission.close()
+    llm_judge.report_rule_matches(judge_counts["rule"], judge_counts["judged"])
+
+
+def export_sharegpt(args, judge_path):
+    from datasets import load_dataset
+    from hf_data.sharegpt_format import build_sharegpt
+
+    dataset = load_dataset(args.dataset_name, split=args.split)
+    dataset = build_sharegpt(dataset, iter_records(judge_path), num_proc=args.export_workers)
+    print(dataset)
+    if args.save_to_disk:
+        dataset.save_to_disk(args.save_to_disk)
+    if args.push_to_hub:
+        dataset.push_to_hub(args.push_to_hub)
+
+
+def main():
+    parser = qwen3vl.build_parser()
+    parser.description = "Run generation, refinement and judging as one streaming pipeline."
+    parser.add_argument("--refine_backend", choices=["openai", "gemini"], default="openai", help="Which refine script's model to use.")
+    parser.add_argument("--refine_concurrency", type=int, default=llm_refine.MAX_CONCURRENCY, help="Refine requests in flight.")
+    parser.add_argument("--judge_concurrency", type=int, default=llm_judge.MAX_CONCURRENCY, help="Judge requests in flight.")
+    parser.add_argument("--no_rule_match", action="store_true", help="Judge every record with the LLM instead of settling clear-cut cases with rule-based matching.")
+    parser.add_argument("--save_to_disk", type=str, default=None, help="Save the accepted ShareGPT dataset to this directory.")
+    parser.add_argument(
+        "--export_workers",
+        type=int,
+        default=max(int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count())) - 1, 1),
+        help="Processes for building the ShareGPT export (default: the allocated CPUs minus one).",
+    )
+    parser.add_argument("--push_to_hub", type=str, default=None, help="Push the accepted ShareGPT dataset to this hub repo.")
+    args = parser.parse_args()
+    if args.streaming:
+        parser.error("--streaming is not supported by the pipeline; its stage checkpoints select rows by index")
+    if args.max_concurrency is None:
+        args.max_concurrency = args.batch_size
+
+    if args.port:
+        qwen3vl.BASE_URL = f"http://localhost:{args.port}/v1"
+    print(f"Connecting to {args.endpoints or qwen3vl.BASE_URL} with model {args.model}")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    stem = with_format(qwen3vl.build_output_file(args, sharded=False), "jsonl")[: -len("_results.jsonl")]
+    stage_paths = [f"{stem}_{stage}.{args.output_format}" for stage in ("results", "refined", "judged")]
+
+    if args.merge:
+        from datasets import load_dataset
+
+        total = len(load_dataset(args.dataset_name, split=args.split))
+        incomplete = [merge_shards(path, total, args.num_shards) for path in stage_paths]
+        if args.save_to_disk or args.push_to_hub:
+            export_sharegpt(args, stage_paths[-1])
+        raise SystemExit(1 if any(incomplete) else 0)
+
+    checkpoints = [StageCheckpoint(shard_output_file(path, args.num_shards, args.shard_index)) for path in stage_paths]
+    qwen3vl.reopen_retries(args, checkpoints[0].path, checkpoints[0].manifest)
+
+    system_prompt = qwen3vl.load_system_prompt(args)
+    dataset = qwen3vl.load_inference_dataset(args)
+    preprocessor = qwen3vl.build_preprocessor(args)
+    response_cache = open_response_cache()
+    # One sidecar for all three stages; records carry their stage
+    telemetry = qwen3vl.build_telemetry(args, shard_output_file(f"{stem}_pipeline.jsonl", args.num_shards, args.shard_index))
+    admission = qwen3vl.build_admission(args)
+
+    try:
+        asyncio.run(run_pipeline(args, dataset, system_prompt, preprocessor, checkpoints, response_cache=response_cache, telemetry=telemetry, admission=admission))
+    finally:
+        for checkpoint in checkpoints:
+            checkpoint.close()
+        preprocessor.close()
+        if admission:
+            admission.report()
+        if response_cache:
+            response_cache.report()
+            response_cache.close()
+        if telemetry:
+            telemetry.report()
+            telemetry.close()
+
+    if args.save_to_disk or args.push_to_hub:
+        export_sharegpt(args, checkpoints[-1].path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Additive-increase / multiplicative-decrease concurrency control.
+
+Provider quotas for long ``thinking_level="high"`` calls are not published per request shape, so
+instead of a fixed concurrency ``AIMDLimiter`` probes for it, TCP-style: every healthy response adds
+``1 / limit`` to the limit (one slot per round trip of the whole window), and an overload signal
+(429, deadline exceeded) cuts it by ``decrease`` and pauses new dispatches for the retry-after hint.
+A response counts as healthy when its latency stays within ``latency_tolerance`` times the best
+smoothed latency seen and the recent error rate is below ``max_error_rate``.
+"""
+
+import time
+import asyncio
+from typing import Optional
+
+
+class AIMDLimiter:
+    def __init__(
+        self,
+        initial: int = 4,
+        minimum: int = 1,
+        maximum: int = 256,
+        decrease: float = 0.5,
+        latency_tolerance: float = 2.0,
+        max_error_rate: float = 0.05,
+        smoothing: float = 0.1,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.max_error_rate = max_error_rate
+        self.smoothing = smoothing
+        self.in_flight = 0
+        self.latency = None
+        self.best_latency = None
+        self.error_rate = 0.0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.peak_limit = self.limit
+        self.decreases = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self) -> float:
+        """
+        Wait for a free slot and for any retry-after pause to pass. Returns the dispatch time, to
+        hand back to ``on_success``/``on_overload``/``on_error``.
+        """
+        async with self._condition:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    # Release the lock while sleeping so completions can still be recorded
+                    self._condition.release()
+                    try:
+                        await asyncio.sleep(pause)
+                    finally:
+                        await self._condition.acquire()
+                elif self.in_flight >= int(self.limit):
+                    await self._condition.wait()
+                else:
+                    break
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def _release(self) -> None:
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def _observe_error(self, failed: bool) -> None:
+        self.error_rate += self.smoothing * ((1.0 if failed else 0.0) - self.error_rate)
+
+    async def on_success(self, started: float) -> None:
+        latency = time.monotonic() - started
+        self.latency = latency if self.latency is None else self.latency + self.smoothing * (latency - self.latency)
+        self.best_latency = self.latency if self.best_latency is None else min(self.best_latency, self.latency)
+        self._observe_error(False)
+        if latency <= self.latency_tolerance * self.best_latency and self.error_rate < self.max_error_rate:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.peak_limit = max(self.peak_limit, self.limit)
+        await self._release()
+
+    async def on_overload(self, started: float, retry_after: Optional[float] = None) -> None:
+        """
+        Back off after a 429 / deadline error. Requests dispatched before the previous cut were sent
+        at the old limit, so their failures don't cut again.
+        """
+        self._observe_error(True)
+        now = time.monotonic()
+        if started >= self.last_decrease:
+            previous = self.limit
+            self.limit = max(self.minimum, self.limit * self.decrease)
+            self.last_decrease = now
+            self.decreases += 1
+            if self.limit < previous:
+                print(f"Overloaded: concurrency {previous:.1f} -> {self.limit:.1f}" + (f", pausing {retry_after:.1f}s" if retry_after else ""))
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+        await self._release()
+
+    async def on_error(self, started: float) -> None:
+        """
+        A failure that says nothing about load (bad request, server bug); only feeds the error rate.
+        """
+        self._observe_error(True)
+        await self._release()
+
+    def report(self) -> None:
+        latency = "-" if self.latency is None else f"{self.latency:.1f}s"
+        print(f"Adaptive concurrency: final {self.limit:.1f}, peak {self.peak_limit:.1f}, {self.decreases} backoffs, smoothed latency {latency}, error rate {self.error_rate:.1%}")
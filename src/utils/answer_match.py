@@ -0,0 +1,169 @@
+"""
+Rule-based answer matching that settles clear-cut judge cases locally.
+
+Implements the rules of ``BINARY_JUDGE_PROMPT`` for answers that can be checked mechanically:
+spot the final answer, ignore formatting/case/spacing, map multiple-choice options, compare
+numbers at the precision of the ground truth and require matching units. ``match_answer`` returns
+``"1"`` or ``"0"`` only when the verdict is unambiguous and ``None`` otherwise, so those records
+still go to the LLM. Loose matches (the ground truth somewhere inside a longer answer, units that
+aren't in ``UNIT_ALIASES``) are left to the LLM, since a wrong local verdict skips the judge.
+"""
+
+import re
+import math
+import string
+from typing import Dict, List, Optional, Tuple
+
+ARTICLES = {"a", "an", "the"}
+# Canonical unit -> spellings; units outside this table are never compared locally
+UNIT_ALIASES = {
+    "%": ("%", "percent", "pct"),
+    "mm": ("mm", "millimeter", "millimeters", "millimetre", "millimetres"),
+    "cm": ("cm", "centimeter", "centimeters", "centimetre", "centimetres"),
+    "m": ("m", "meter", "meters", "metre", "metres"),
+    "km": ("km", "kilometer", "kilometers", "kilometre", "kilometres"),
+    "in": ("in", "inch", "inches"),
+    "ft": ("ft", "foot", "feet"),
+    "mi": ("mi", "mile", "miles"),
+    "g": ("g", "gram", "grams"),
+    "kg": ("kg", "kilogram", "kilograms"),
+    "lb": ("lb", "lbs", "pound", "pounds"),
+    "s": ("s", "sec", "secs", "second", "seconds"),
+    "min": ("min", "mins", "minute", "minutes"),
+    "h": ("h", "hr", "hrs", "hour", "hours"),
+    "°": ("°", "deg", "degree", "degrees"),
+    "°c": ("°c", "celsius"),
+    "°f": ("°f", "fahrenheit"),
+    "l": ("l", "liter", "liters", "litre", "litres"),
+    "ml": ("ml", "milliliter", "milliliters", "millilitre", "millilitres"),
+}
+_UNITS = {alias: unit for unit, aliases in UNIT_ALIASES.items() for alias in aliases}
+
+_OPTION_LINE = re.compile(r"^\s*\(?([A-H])[\.\)\:]\s*(.+?)\s*$", flags=re.MULTILINE)
+_LEADING_LETTER = re.compile(r"^\(?([A-H])\)?(?:[\.\)\:,]|\s|$)")
+_ANSWER_IS_LETTER = re.compile(r"\b(?i:answer|option|choice)\s*(?i:is|:)?\s*\(?([A-H])\)?(?:[\.\),:]|\s|$)")
+_NUMBER_WITH_UNIT = re.compile(r"(-?\d[\d,]*(?:\.\d+)?)\s*(%|[a-zA-Z°][a-zA-Z°/²³]*)?")
+_BOXED = re.compile(r"\\boxed\{([^{}]*)\}")
+_ANSWER_PREFIX = re.compile(r"^(?:final\s+)?answer\s*[:：]\s*", flags=re.IGNORECASE)
+
+
+def extract_final_answer(prediction: str) -> str:
+    """
+    The part of a prediction that states the answer: text after ``</think>``, a ``\\boxed{}``
+    value, or an ``Answer:`` line, stripped of markdown emphasis.
+    """
+    text = prediction.split("</think>")[-1].strip()
+    boxed = _BOXED.findall(text)
+    if boxed:
+        return boxed[-1].strip()
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    for line in reversed(lines):
+        if _ANSWER_PREFIX.match(line.replace("*", "")):
+            text = _ANSWER_PREFIX.sub("", line.replace("*", ""))
+            break
+    return text.replace("**", "").replace("__", "").strip()
+
+
+def normalize(text: str) -> str:
+    text = text.lower().strip()
+    text = text.translate(str.maketrans("", "", string.punctuation.replace("'", "").replace("-", "")))
+    return " ".join(word for word in text.split() if word not in ARTICLES)
+
+
+def parse_options(question: str) -> Dict[str, str]:
+    """
+    Multiple-choice options listed one per line as ``A. text`` / ``(B) text``.
+    """
+    options = dict(_OPTION_LINE.findall(question))
+    # A single matched line is more likely a sentence than an option list
+    return options if len(options) >= 2 else {}
+
+
+def _to_letter(text: str, options: Dict[str, str]) -> Optional[str]:
+    stripped = text.strip().replace("*", "")
+    match = _LEADING_LETTER.match(stripped) or _ANSWER_IS_LETTER.search(stripped)
+    if match and (not options or match.group(1) in options):
+        return match.group(1)
+    normalized = normalize(stripped)
+    for letter, option in options.items():
+        if normalized == normalize(option):
+            return letter
+    return None
+
+
+def _parse_numbers(text: str) -> List[Tuple[float, Optional[str]]]:
+    numbers = []
+    for value, unit in _NUMBER_WITH_UNIT.findall(text):
+        try:
+            numbers.append((float(value.replace(",", "")), unit.lower() if unit else None))
+        except ValueError:
+            continue
+    return numbers
+
+
+def _numbers_match(predicted: float, expected: float, expected_text: str) -> bool:
+    """
+    Integer ground truths need the exact value. One given with decimals also accepts a more precise
+    prediction that rounds to it at that precision.
+    """
+    if predicted == expected:
+        return True
+    decimals = len(expected_text.split(".")[1]) if "." in expected_text else 0
+    if not decimals:
+        return False
+    return math.isclose(round(predicted, decimals), expected, rel_tol=0, abs_tol=1e-9)
+
+
+def match_answer(question: str, answer: str, prediction: str) -> Optional[str]:
+    """
+    Return ``"1"`` for a clear match, ``"0"`` for a clear mismatch, or ``None`` when only an LLM can tell.
+    """
+    final = extract_final_answer(prediction or "")
+    answer = (answer or "").strip()
+    if not final or not answer:
+        return None
+
+    # Multiple choice: compare option letters
+    options = parse_options(question or "")
+    expected_letter = _to_letter(answer, options) if options or len(answer) <= 3 else None
+    if expected_letter:
+        predicted_letter = _to_letter(final, options)
+        if predicted_letter:
+            return "1" if predicted_letter == expected_letter else "0"
+        return None
+
+    expected_norm = normalize(answer)
+    final_norm = normalize(final)
+
+    # Yes/no questions; a longer answer can qualify its "yes", so only a bare one is settled here
+    if expected_norm in ("yes", "no"):
+        if final_norm in ("yes", "no"):
+            return "1" if final_norm == expected_norm else "0"
+        return None
+
+    # Numeric answers, with unit check when the ground truth has one
+    expected_numbers = _parse_numbers(answer)
+    if len(expected_numbers) == 1 and re.fullmatch(r"[\d,\.\-\s]+(%|[a-zA-Z°][a-zA-Z°/²³]*)?", answer):
+        expected_value, expected_unit = expected_numbers[0]
+        predicted_numbers = _parse_numbers(final)
+        if len(predicted_numbers) != 1:
+            return None
+        predicted_value, predicted_unit = predicted_numbers[0]
+        expected_text = re.sub(r"[^\d\.\-]", "", answer)
+        if predicted_unit and not expected_unit:
+            # "1990s", "3 people": the suffix may change the meaning
+            return None
+        if expected_unit and predicted_unit != expected_unit:
+            # Spellings of the same unit ("cm" / "centimeters") compare equal; unknown ones go to the LLM
+            if predicted_unit not in _UNITS or expected_unit not in _UNITS:
+                return None
+            if _UNITS[predicted_unit] != _UNITS[expected_unit]:
+                return "0"
+        if not _numbers_match(predicted_value, expected_value, expected_text):
+            return "0"
+        return "1"
+
+    # Only the whole answer counts; the ground truth inside a longer answer ("dog" in "hot dog") is for the LLM
+    if final_norm == expected_norm:
+        return "1"
+    return None
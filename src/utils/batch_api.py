@@ -0,0 +1,173 @@
+import os
+import glob
+import json
+import time
+import hashlib
+from typing import Dict, Iterable, List, Tuple
+
+# Provider limits for a single batch input file
+MAX_REQUESTS_PER_BATCH = 50_000
+MAX_BATCH_FILE_BYTES = 200 * 1024**2
+
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def write_batch_inputs(requests: Iterable[Tuple[str, dict]], work_dir: str, endpoint: str = "/v1/chat/completions") -> List[str]:
+    """
+    Write ``(custom_id, body)`` requests into batch-input JSONL chunks that respect the per-file
+    request and size limits. Returns the chunk paths in order.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    paths = []
+    f = None
+    count = size = 0
+    for custom_id, body in requests:
+        line = json.dumps({"custom_id": custom_id, "method": "POST", "url": endpoint, "body": body}) + "\n"
+        encoded = line.encode("utf-8")
+        if f is None or count >= MAX_REQUESTS_PER_BATCH or size + len(encoded) > MAX_BATCH_FILE_BYTES:
+            if f is not None:
+                f.close()
+            paths.append(os.path.join(work_dir, f"input_{len(paths):04d}.jsonl"))
+            f = open(paths[-1], "wb")
+            count = size = 0
+        f.write(encoded)
+        count += 1
+        size += len(encoded)
+    if f is not None:
+        f.close()
+    return paths
+
+
+class BatchRunner:
+    """
+    Submits batch-input chunks, polls them and collects results keyed by ``custom_id``.
+
+    Progress is kept in ``<work_dir>/state.json`` (chunk path -> batch ID, status, result path), so
+    a restarted run re-attaches to batches that were already submitted instead of paying twice,
+    and downloaded results are reused without touching the API. The state records a hash of the
+    request set and is only reused for the same requests; custom IDs are positional, so results of
+    a run over other inputs or prompts would land on the wrong records.
+    """
+
+    def __init__(self, client, work_dir: str, endpoint: str = "/v1/chat/completions", completion_window: str = "24h", poll_interval: float = 60.0):
+        self.client = client
+        self.work_dir = work_dir
+        self.endpoint = endpoint
+        self.completion_window = completion_window
+        self.poll_interval = poll_interval
+        self.state_path = os.path.join(work_dir, "state.json")
+        self.state = {"chunks": {}}
+        self.custom_ids = set()
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r") as f:
+                self.state = json.load(f)
+
+    def _save_state(self) -> None:
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    @staticmethod
+    def requests_hash(requests: List[Tuple[str, dict]]) -> str:
+        digest = hashlib.sha256()
+        for custom_id, body in requests:
+            digest.update(json.dumps([custom_id, body], sort_keys=True).encode("utf-8"))
+            digest.update(b"\n")
+        return digest.hexdigest()
+
+    def _reset(self) -> None:
+        # Downloaded results are reused by path, so stale chunks must go along with the state
+        for path in glob.glob(os.path.join(self.work_dir, "input_*.jsonl")) + glob.glob(os.path.join(self.work_dir, "output_*.jsonl")):
+            os.remove(path)
+        self.state = {"chunks": {}}
+
+    def prepare(self, requests: Iterable[Tuple[str, dict]]) -> List[str]:
+        """
+        Write input chunks unless a previous run already did for the same requests. State left by
+        a run over different requests is discarded.
+        """
+        requests = list(requests)
+        requests_hash = self.requests_hash(requests)
+        self.custom_ids = {custom_id for custom_id, _ in requests}
+        if self.state["chunks"]:
+            if self.state.get("requests_hash") == requests_hash:
+                print(f"Reusing {len(self.state['chunks'])} batch chunks from {self.state_path}")
+                return list(self.state["chunks"])
+            print(f"Discarding the batch state in {self.state_path}: it was made for a different set of requests")
+            self._reset()
+        paths = write_batch_inputs(requests, self.work_dir, endpoint=self.endpoint)
+        self.state["chunks"] = {path: {} for path in paths}
+        self.state["requests_hash"] = requests_hash
+        self._save_state()
+        return paths
+
+    def submit(self) -> None:
+        for path, chunk in self.state["chunks"].items():
+            if chunk.get("batch_id"):
+                continue
+            with open(path, "rb") as f:
+                input_file = self.client.files.create(file=f, purpose="batch")
+            batch = self.client.batches.create(input_file_id=input_file.id, endpoint=self.endpoint, completion_window=self.completion_window)
+            chunk.update(batch_id=batch.id, status=batch.status)
+            self._save_state()
+            print(f"Submitted {path} as batch {batch.id}")
+
+    def wait(self) -> None:
+        while True:
+            running = 0
+            for path, chunk in self.state["chunks"].items():
+                if chunk.get("status") in TERMINAL_STATUSES:
+                    continue
+                batch = self.client.batches.retrieve(chunk["batch_id"])
+                chunk.update(status=batch.status, output_file_id=batch.output_file_id, error_file_id=batch.error_file_id)
+                counts = batch.request_counts
+                if counts is not None:
+                    print(f"Batch {batch.id}: {batch.status} ({counts.completed}/{counts.total} done, {counts.failed} failed)")
+                if batch.status not in TERMINAL_STATUSES:
+                    running += 1
+            self._save_state()
+            if not running:
+                return
+            time.sleep(self.poll_interval)
+
+    def _download(self, path: str, chunk: dict) -> str:
+        result_path = path.replace("input_", "output_")
+        if not os.path.exists(result_path):
+            with open(result_path + ".tmp", "w", encoding="utf-8") as f:
+                for file_id in (chunk.get("output_file_id"), chunk.get("error_file_id")):
+                    if file_id:
+                        f.write(self.client.files.content(file_id).text)
+            os.replace(result_path + ".tmp", result_path)
+        return result_path
+
+    def results(self) -> Dict[str, dict]:
+        """
+        Map ``custom_id`` to ``{"content": ...}`` for successful requests or ``{"error": ...}`` otherwise.
+        Requests missing from a finished batch (expired, cancelled) are simply absent, and so are
+        results whose ``custom_id`` isn't among the requests passed to ``prepare``.
+        """
+        results = {}
+        for path, chunk in self.state["chunks"].items():
+            if chunk.get("status") != "completed" and not (chunk.get("output_file_id") or chunk.get("error_file_id")):
+                print(f"Batch {chunk.get('batch_id')} ended as {chunk.get('status')} without results")
+                continue
+            with open(self._download(path, chunk), "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    item = json.loads(line)
+                    if item.get("custom_id") not in self.custom_ids:
+                        continue
+                    response = item.get("response") or {}
+                    if item.get("error") or response.get("status_code") != 200:
+                        results[item["custom_id"]] = {"error": json.dumps(item.get("error") or response.get("body"))}
+                    else:
+                        results[item["custom_id"]] = {"content": response["body"]["choices"][0]["message"]["content"]}
+        return results
+
+    def run(self, requests: Iterable[Tuple[str, dict]]) -> Dict[str, dict]:
+        self.prepare(requests)
+        self.submit()
+        self.wait()
+        return self.results()
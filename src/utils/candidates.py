@@ -0,0 +1,85 @@
+"""
+Multi-candidate record layout.
+
+With ``--num_samples`` > 1 a result record holds its predictions under ``candidates`` instead of a
+single ``prediction``::
+
+    {"sample_id": 7, "question": ..., "answer": ..., "candidates": [{"prediction": ...}, {"prediction": ...}]}
+
+Refine and judge work on per-candidate *views* (the shared fields merged with one candidate) and
+write their outputs back into the candidate entries, so single- and multi-candidate records go
+through the same code.
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Iterable, Iterator, List, Tuple
+
+
+def candidate_views(record: dict) -> List[dict]:
+    """
+    The record itself for a single-prediction record, otherwise one view per candidate.
+    """
+    if "candidates" not in record:
+        return [record]
+    shared = {key: value for key, value in record.items() if key != "candidates"}
+    return [{**shared, **candidate} for candidate in record["candidates"]]
+
+
+def store_candidate_fields(record: dict, views: List[dict], fields: Iterable[str]) -> dict:
+    """
+    Copy ``fields`` from processed views back into the candidate entries. A candidate's error is
+    also set on the record, so the whole record counts as failed and is retried.
+    """
+    if "candidates" not in record:
+        return record
+    record.pop("error", None)
+    for candidate, view in zip(record["candidates"], views):
+        candidate.pop("error", None)
+        for field in fields:
+            if field in view:
+                candidate[field] = view[field]
+        if "error" in view:
+            candidate["error"] = record["error"] = view["error"]
+    return record
+
+
+async def for_each_candidate(record: dict, process: Callable[[dict], Awaitable[dict]], fields: Iterable[str]) -> dict:
+    """
+    Run ``process`` on every candidate view concurrently and store ``fields`` back on the record.
+    """
+    views = candidate_views(record)
+    await asyncio.gather(*(process(view) for view in views))
+    return store_candidate_fields(record, views, fields)
+
+
+def candidate_units(records: List[dict]) -> Iterator[Tuple[str, dict, dict]]:
+    """
+    ``(custom_id, target, view)`` for every prediction in ``records``, for the Batch API paths.
+    ``target`` is the dict that receives the outputs: the record, or the candidate entry.
+    """
+    for i, record in enumerate(records):
+        if "candidates" in record:
+            for j, (candidate, view) in enumerate(zip(record["candidates"], candidate_views(record))):
+                yield f"line-{i}-{j}", candidate, view
+        else:
+            yield f"line-{i}", record, record
+
+
+def lift_candidate_errors(record: dict) -> None:
+    if "candidates" in record:
+        errors = [candidate["error"] for candidate in record["candidates"] if "error" in candidate]
+        if errors:
+            record["error"] = errors[0]
+
+
+def summarize_verdicts(record: dict) -> None:
+    """
+    Record-level ``judge_result`` for a multi-candidate record: "1" if any candidate was accepted,
+    "0" if all were judged and none was. Left unset while any candidate is unjudged. Candidates whose
+    generation was aborted early have no prediction and are left out.
+    """
+    if "candidates" not in record:
+        return
+    verdicts = [candidate.get("judge_result") for candidate in record["candidates"] if "aborted" not in candidate]
+    if verdicts and "error" not in record and None not in verdicts:
+        record["judge_result"] = "1" if "1" in verdicts else "0"
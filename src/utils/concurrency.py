@@ -0,0 +1,148 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, Iterable, Tuple, Union
+
+
+async def bounded_map(func: Callable[[Any], Awaitable[Any]], items: Union[Iterable[Any], AsyncIterable[Any]], max_concurrency: int) -> AsyncIterator[Tuple[int, Any]]:
+    """
+    Run ``func`` over ``items`` with at most ``max_concurrency`` calls in flight.
+
+    Items are pulled lazily, so the iterable is only consumed as fast as slots free up.
+    Yields ``(position, result)`` pairs in completion order, where ``position`` is the
+    item's offset in ``items``. ``items`` may also be an async iterable (e.g. a ``Prefetcher``);
+    the next item is then awaited alongside the running calls.
+    """
+    if hasattr(items, "__aiter__"):
+        async for pair in _bounded_map_async(func, items, max_concurrency):
+            yield pair
+        return
+
+    iterator = iter(items)
+    pending: Dict[asyncio.Task, int] = {}
+    position = 0
+    exhausted = False
+
+    while True:
+        while not exhausted and len(pending) < max_concurrency:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                exhausted = True
+                break
+            pending[asyncio.ensure_future(func(item))] = position
+            position += 1
+
+        if not pending:
+            return
+
+        done, _ = await asyncio.wait(pending.keys(), return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            yield pending.pop(task), task.result()
+
+
+async def _bounded_map_async(func, items, max_concurrency):
+    iterator = items.__aiter__()
+    pending: Dict[asyncio.Future, int] = {}
+    position = 0
+    fetch = None
+    exhausted = False
+
+    while True:
+        if fetch is None and not exhausted and len(pending) < max_concurrency:
+            fetch = asyncio.ensure_future(iterator.__anext__())
+        if not pending and fetch is None:
+            return
+
+        done, _ = await asyncio.wait([*pending, *([fetch] if fetch else [])], return_when=asyncio.FIRST_COMPLETED)
+        if fetch in done:
+            try:
+                pending[asyncio.ensure_future(func(fetch.result()))] = position
+                position += 1
+            except StopAsyncIteration:
+                exhausted = True
+            fetch = None
+        for task in done:
+            if task in pending:
+                yield pending.pop(task), task.result()
+
+
+class Prefetcher:
+    """
+    Async iterator over ``prepare(item)`` for ``items``, computed ahead of the consumer.
+
+    One background thread pulls from ``items`` (a blocking iterable, such as a streamed dataset)
+    and ``workers`` threads run ``prepare`` on the items pulled; at most ``depth`` items are pulled
+    or prepared ahead, so memory stays bounded. Results come out in input order. ``prepare`` should
+    handle its own errors; an exception ends the iteration.
+    """
+
+    _END = object()
+
+    def __init__(self, items: Iterable[Any], prepare: Callable[[Any], Any], depth: int = 32, workers: int = 4):
+        self.iterator = iter(items)
+        self.prepare = prepare
+        self.depth = max(1, depth)
+        self._source = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch-source")
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="prefetch")
+        self._ahead = deque()
+        self._exhausted = False
+
+    def _pull(self):
+        return next(self.iterator, self._END)
+
+    async def _load(self):
+        loop = asyncio.get_running_loop()
+        # The single source thread serves pulls in submission order
+        item = await loop.run_in_executor(self._source, self._pull)
+        if item is self._END:
+            return self._END
+        return await loop.run_in_executor(self._pool, self.prepare, item)
+
+    def __aiter__(self) -> "Prefetcher":
+        return self
+
+    async def __anext__(self):
+        while not self._exhausted and len(self._ahead) < self.depth:
+            self._ahead.append(asyncio.ensure_future(self._load()))
+        if not self._ahead:
+            raise StopAsyncIteration
+        result = await self._ahead.popleft()
+        if result is self._END:
+            self._exhausted = True
+            for future in self._ahead:
+                future.cancel()
+            self._ahead.clear()
+            raise StopAsyncIteration
+        return result
+
+    def close(self) -> None:
+        for future in self._ahead:
+            future.cancel()
+        self._source.shutdown(wait=False, cancel_futures=True)
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class OrderedBuffer:
+    """
+    Reassembly buffer that releases out-of-order results in position order.
+
+    A ``None`` value marks a position that produced no output; it still advances the
+    cursor so later results are not held back forever.
+    """
+
+    def __init__(self, emit: Callable[[Any], None], start: int = 0):
+        self.emit = emit
+        self.next_position = start
+        self.pending: Dict[int, Any] = {}
+
+    def put(self, position: int, value: Any) -> None:
+        self.pending[position] = value
+        while self.next_position in self.pending:
+            value = self.pending.pop(self.next_position)
+            if value is not None:
+                self.emit(value)
+            self.next_position += 1
+
+    def __len__(self) -> int:
+        return len(self.pending)
@@ -0,0 +1,195 @@
+"""
+Prompt-size estimates and context-length admission control for Qwen3-VL requests.
+
+Oversized prompts (8k HR-Bench images, multi-image ZeroBench items) otherwise fail only after the
+images were uploaded and prefilled, and long requests that do fit make vLLM preempt others once
+the KV cache runs out. ``ContextBudget`` estimates a request's prompt tokens locally, before
+anything is sent:
+
+- image tokens from the resolution, following the Qwen3-VL processor: the image is resized with
+  ``smart_resize`` to multiples of 32 pixels (16-pixel patches, 2x2 spatial merge) within the
+  pixel limits, and every merged 32x32 patch is one token, plus the vision start/end tokens;
+- text tokens from the model's tokenizer when ``transformers`` can load it, else about four
+  characters per token.
+
+A request fits when the prompt leaves room for at least ``min_completion_tokens``; ``max_tokens``
+is then lowered to what is left of the context, since vLLM rejects requests whose prompt plus
+``max_tokens`` exceeds ``--max-model-len``. ``InflightTokenLimiter`` caps the estimated tokens
+(prompt plus completion budget) of all requests in flight.
+"""
+
+import math
+import asyncio
+from collections import deque
+from typing import Callable, Iterable, Optional, Sequence, Tuple
+
+from utils.rate_limit import estimate_tokens
+
+# Qwen3-VL: 16-pixel patches merged 2x2 into one token
+PATCH_FACTOR = 32
+IMAGE_WRAP_TOKENS = 2
+# <|im_start|>role\n ... <|im_end|>\n around every message, and the assistant generation prompt
+MESSAGE_OVERHEAD_TOKENS = 5
+GENERATION_PROMPT_TOKENS = 3
+
+
+def smart_resize(width: int, height: int, min_pixels: int, max_pixels: int, factor: int = PATCH_FACTOR) -> Tuple[int, int]:
+    """
+    The size the Qwen-VL image processor resizes an image to before patching.
+    """
+    new_width = max(factor, round(width / factor) * factor)
+    new_height = max(factor, round(height / factor) * factor)
+    if new_width * new_height > max_pixels:
+        beta = math.sqrt(width * height / max_pixels)
+        new_width = max(factor, math.floor(width / beta / factor) * factor)
+        new_height = max(factor, math.floor(height / beta / factor) * factor)
+    elif new_width * new_height < min_pixels:
+        beta = math.sqrt(min_pixels / (width * height))
+        new_width = math.ceil(width * beta / factor) * factor
+        new_height = math.ceil(height * beta / factor) * factor
+    return new_width, new_height
+
+
+def image_tokens(width: int, height: int, min_pixels: int, max_pixels: int) -> int:
+    new_width, new_height = smart_resize(width, height, min_pixels, max_pixels)
+    return (new_width // PATCH_FACTOR) * (new_height // PATCH_FACTOR) + IMAGE_WRAP_TOKENS
+
+
+class TextTokenCounter:
+    """
+    Counts text tokens with the Hugging Face tokenizer ``name``. Falls back to ``estimate_tokens`` if
+    ``transformers`` is missing or the tokenizer can't be loaded.
+    """
+
+    def __init__(self, name: Optional[str]):
+        self.name = name
+        self._tokenizer = None
+        if name is None:
+            return
+        try:
+            from transformers import AutoTokenizer
+
+            self._tokenizer = AutoTokenizer.from_pretrained(name)
+        except Exception as e:
+            print(f"Could not load tokenizer {name} ({e}); estimating text tokens at 4 characters per token")
+
+    def __call__(self, text: str) -> int:
+        if not text:
+            return 0
+        if self._tokenizer is None:
+            return estimate_tokens(text)
+        return len(self._tokenizer.encode(text, add_special_tokens=False))
+
+
+class InflightTokenLimiter:
+    """
+    Caps the estimated tokens of all in-flight requests at ``capacity``, so the server's KV cache stays
+    full without preempting. Waiters are admitted in FIFO order; a request larger than the whole
+    capacity is admitted alone.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.in_flight = 0
+        self.peak = 0
+        self._waiters = deque()
+
+    async def acquire(self, tokens: int) -> int:
+        """
+        Wait until ``tokens`` fit. Returns the tokens reserved, to hand back to ``release``.
+        """
+        tokens = min(tokens, self.capacity)
+        if not self._waiters and self.in_flight + tokens <= self.capacity:
+            self._reserve(tokens)
+            return tokens
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append((tokens, waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(tokens)
+            else:
+                self._waiters.remove((tokens, waiter))
+                self._wake()
+            raise
+        return tokens
+
+    def _reserve(self, tokens: int) -> None:
+        self.in_flight += tokens
+        self.peak = max(self.peak, self.in_flight)
+
+    def _wake(self) -> None:
+        while self._waiters and self.in_flight + self._waiters[0][0] <= self.capacity:
+            tokens, waiter = self._waiters.popleft()
+            self._reserve(tokens)
+            waiter.set_result(None)
+
+    def release(self, tokens: int) -> None:
+        self.in_flight -= tokens
+        self._wake()
+
+
+class ContextBudget:
+    """
+    Admission decisions for a server with context length ``max_model_len``; ``min_pixels`` and
+    ``max_pixels`` are the server's image processor limits. ``route_client`` is an optional client for
+    a longer-context deployment with ``route_max_model_len``, for requests that don't fit.
+    """
+
+    def __init__(
+        self,
+        max_model_len: int,
+        count_text: Callable[[str], int],
+        min_pixels: int,
+        max_pixels: int,
+        min_completion_tokens: int = 1024,
+        max_inflight_tokens: Optional[int] = None,
+        route_client=None,
+        route_max_model_len: Optional[int] = None,
+    ):
+        self.max_model_len = max_model_len
+        self.count_text = count_text
+        self.min_pixels = min_pixels
+        self.max_pixels = max_pixels
+        self.min_completion_tokens = min_completion_tokens
+        self.inflight = InflightTokenLimiter(max_inflight_tokens) if max_inflight_tokens else None
+        self.route_client = route_client
+        self.route_max_model_len = route_max_model_len
+        self.rejected = 0
+        self.downscaled = 0
+        self.routed = 0
+
+    def text_tokens(self, texts: Iterable[str]) -> int:
+        return sum(self.count_text(text) + MESSAGE_OVERHEAD_TOKENS for text in texts) + GENERATION_PROMPT_TOKENS
+
+    def prompt_tokens(self, texts: Iterable[str], image_sizes: Sequence[Tuple[int, int]]) -> int:
+        return self.text_tokens(texts) + sum(image_tokens(width, height, self.min_pixels, self.max_pixels) for width, height in image_sizes)
+
+    def completion_budget(self, prompt_tokens: int, max_tokens: int, max_model_len: Optional[int] = None) -> Optional[int]:
+        """
+        ``max_tokens`` lowered to the room left in the context, or None if less than ``min_completion_tokens`` (or ``max_tokens``) is left.
+        """
+        remaining = (max_model_len or self.max_model_len) - prompt_tokens
+        if remaining < min(self.min_completion_tokens, max_tokens):
+            return None
+        return min(max_tokens, remaining)
+
+    def image_pixel_cap(self, text_tokens: int, num_images: int) -> Optional[int]:
+        """
+        Per-image pixel limit that fits ``num_images`` images next to the text and the minimum
+        completion, or None if that would go below ``min_pixels``.
+        """
+        if num_images == 0:
+            return None
+        per_image = (self.max_model_len - text_tokens - self.min_completion_tokens) // num_images - IMAGE_WRAP_TOKENS
+        cap = per_image * PATCH_FACTOR * PATCH_FACTOR
+        return cap if cap >= self.min_pixels else None
+
+    async def close(self) -> None:
+        if self.route_client is not None:
+            await self.route_client.close()
+
+    def report(self) -> None:
+        peak = f", peak {self.inflight.peak} tokens in flight" if self.inflight else ""
+        print(f"Context admission: {self.rejected} rejected, {self.downscaled} downscaled, {self.routed} routed to the long-context endpoint{peak}")
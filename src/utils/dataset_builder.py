@@ -0,0 +1,131 @@
+"""
+Parallel, bounded-memory dataset building into size-targeted Parquet shards.
+
+Row selection happens on metadata columns only; images are read and processed inside the
+workers that write the shards, so neither the full source nor the selected images are ever
+held in memory at once. The output directory loads memory-mapped with ``load_built_dataset``.
+"""
+
+import os
+import glob
+import random
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Optional
+
+import datasets
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+TARGET_SHARD_BYTES = 500 * 1024**2
+ROW_GROUP_BYTES = 64 * 1024**2
+
+
+def stratified_subset(dataset: datasets.Dataset, size: int, column: Optional[str] = None, seed: int = 42) -> List[int]:
+    """
+    Indices of a random ``size``-row subset, stratified on ``column`` when given.
+
+    Only ``column`` is read, so rows (and images) outside the subset are never materialized. Each
+    stratum gets its proportional share, with leftover rows going to the largest remainders.
+    """
+    rng = random.Random(seed)
+    if column is None:
+        return sorted(rng.sample(range(len(dataset)), min(size, len(dataset))))
+
+    strata = defaultdict(list)
+    for i, value in enumerate(dataset.select_columns([column])[column]):
+        strata[value].append(i)
+    total = len(dataset)
+    size = min(size, total)
+    quotas = {key: size * len(rows) / total for key, rows in strata.items()}
+    counts = {key: int(quota) for key, quota in quotas.items()}
+    for key in sorted(quotas, key=lambda k: quotas[k] - counts[k], reverse=True)[: size - sum(counts.values())]:
+        counts[key] += 1
+    indices = []
+    for key in sorted(strata, key=str):
+        indices.extend(rng.sample(strata[key], counts[key]))
+    return sorted(indices)
+
+
+def _write_shards(dataset, indices, process, features, output_dir, worker_id, target_shard_bytes):
+    """
+    Process ``indices`` of ``dataset`` and write them as ``train-<worker>-<n>.parquet`` files of
+    about ``target_shard_bytes`` each. Returns (rows written, rows skipped).
+    """
+    schema = features.arrow_schema
+    writer, shard, shard_bytes = None, 0, 0
+    rows, buffered_bytes = [], 0
+    written = skipped = 0
+
+    def flush():
+        nonlocal writer, shard, shard_bytes, rows, buffered_bytes
+        if not rows:
+            return
+        if writer is None:
+            writer = pq.ParquetWriter(os.path.join(output_dir, f"train-{worker_id:03d}-{shard:04d}.parquet"), schema)
+        table = pa.Table.from_pylist(rows, schema=schema)
+        writer.write_table(table)
+        shard_bytes += table.nbytes
+        rows, buffered_bytes = [], 0
+        if shard_bytes >= target_shard_bytes:
+            writer.close()
+            writer, shard, shard_bytes = None, shard + 1, 0
+
+    for i in indices:
+        try:
+            example = process(dataset[i])
+        except Exception as e:
+            print(f"[worker {worker_id}] skipping row {i}: {e}")
+            skipped += 1
+            continue
+        if example is None:
+            skipped += 1
+            continue
+        rows.append(features.encode_example(example))
+        written += 1
+        buffered_bytes += sum(len(v["bytes"]) for v in rows[-1].values() if isinstance(v, dict) and isinstance(v.get("bytes"), bytes))
+        if buffered_bytes >= ROW_GROUP_BYTES or len(rows) >= 10_000:
+            flush()
+    flush()
+    if writer is not None:
+        writer.close()
+    return written, skipped
+
+
+def build_parquet_shards(
+    dataset: datasets.Dataset,
+    indices: List[int],
+    process: Callable[[dict], Optional[dict]],
+    features: datasets.Features,
+    output_dir: str,
+    num_workers: int = 1,
+    target_shard_bytes: int = TARGET_SHARD_BYTES,
+) -> int:
+    """
+    Run ``process`` on each selected row in ``num_workers`` processes and write the results,
+    encoded with ``features``, as Parquet shards under ``output_dir``. ``process`` may return
+    None (or raise) to drop a row. Existing shards in ``output_dir`` are replaced.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(output_dir, "train-*.parquet")):
+        os.remove(path)
+
+    # Contiguous chunks keep each worker's reads local in the source Arrow file
+    num_workers = max(1, min(num_workers, len(indices)))
+    chunk = -(-len(indices) // num_workers)
+    chunks = [indices[i : i + chunk] for i in range(0, len(indices), chunk)]
+    print(f"Building {len(indices)} rows into {output_dir} with {len(chunks)} workers")
+
+    if len(chunks) == 1:
+        written, skipped = _write_shards(dataset, chunks[0], process, features, output_dir, 0, target_shard_bytes)
+    else:
+        with ProcessPoolExecutor(max_workers=len(chunks)) as pool:
+            futures = [pool.submit(_write_shards, dataset, part, process, features, output_dir, worker_id, target_shard_bytes) for worker_id, part in enumerate(chunks)]
+            results = [future.result() for future in futures]
+        written, skipped = sum(r[0] for r in results), sum(r[1] for r in results)
+    print(f"Wrote {written} rows ({skipped} skipped) in {len(glob.glob(os.path.join(output_dir, 'train-*.parquet')))} shards")
+    return written
+
+
+def load_built_dataset(output_dir: str) -> datasets.Dataset:
+    return datasets.load_dataset("parquet", data_files=sorted(glob.glob(os.path.join(output_dir, "train-*.parquet"))), split="train")
@@ -0,0 +1,45 @@
+"""
+Streamed dataset input for ``--streaming``.
+
+``load_dataset(..., streaming=True)`` returns an ``IterableDataset`` that reads rows as they are
+consumed, so the first request goes out once the first rows arrive instead of after the whole
+split (HR-Bench 8k is tens of GB) has been downloaded and prepared. Media decoding is turned off,
+so rows carry the stored image bytes; decoding and resizing happen in the ``Prefetcher`` workers
+(see ``utils.concurrency``) ahead of the request loop.
+"""
+
+from typing import Callable, Iterator, Optional, Tuple
+
+from datasets import IterableDataset, load_dataset
+
+
+def stream_dataset(name: str, split: str, limit: Optional[int] = None) -> IterableDataset:
+    dataset = load_dataset(name, split=split, streaming=True).decode(False)
+    return dataset.take(limit) if limit else dataset
+
+
+def split_size(dataset: IterableDataset, split: str, limit: Optional[int] = None) -> Optional[int]:
+    """
+    Number of rows from the dataset's metadata, or None when the metadata doesn't record it.
+    """
+    splits = dataset.info.splits
+    total = splits[split].num_examples if splits and split in splits else None
+    if total is not None and limit:
+        total = min(total, limit)
+    return total
+
+
+def iter_pending(dataset: IterableDataset, indices: Optional[range], is_done: Callable[[int], bool]) -> Iterator[Tuple[int, dict]]:
+    """
+    ``(index, row)`` for the rows within ``indices`` (all rows if None) that ``is_done`` doesn't
+    report as finished. Rows before the range are skipped without decoding and the stream stops at
+    its end.
+    """
+    start = indices.start if indices is not None else 0
+    if start:
+        dataset = dataset.skip(start)
+    if indices is not None:
+        dataset = dataset.take(len(indices))
+    for index, item in enumerate(dataset, start):
+        if not is_done(index):
+            yield index, item
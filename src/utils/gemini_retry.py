@@ -0,0 +1,89 @@
+"""
+Retries for Gemini ``generate_content`` calls, shared by ``infer/vlm/gemini.py`` and ``gemini_refine.py``.
+
+The genai client doesn't retry on its own. ``generate_content_with_retry`` retries quota, deadline
+and 5xx errors, waiting for the server's retry-after hint or a jittered exponential backoff, and
+reports every attempt to an optional ``AIMDLimiter`` so concurrency backs off under overload.
+"""
+
+import re
+import time
+import random
+import asyncio
+from typing import Callable, Optional
+
+import httpx
+from google.genai import errors
+
+from utils.adaptive_concurrency import AIMDLimiter
+
+# Quota and deadline errors mean "slow down"; the AIMD limiter backs off on them
+OVERLOAD_CODES = (429, 503, 504)
+OVERLOAD_STATUSES = ("RESOURCE_EXHAUSTED", "UNAVAILABLE", "DEADLINE_EXCEEDED")
+MAX_BACKOFF_SECONDS = 60.0
+
+
+def is_overload(error: Exception) -> bool:
+    if isinstance(error, (httpx.TimeoutException, asyncio.TimeoutError)):
+        return True
+    return isinstance(error, errors.APIError) and (error.code in OVERLOAD_CODES or error.status in OVERLOAD_STATUSES)
+
+
+def is_transient(error: Exception) -> bool:
+    return is_overload(error) or isinstance(error, httpx.TransportError) or (isinstance(error, errors.APIError) and error.code >= 500)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """
+    Seconds to wait from a ``Retry-After`` header or a ``google.rpc.RetryInfo`` detail, if the error carries one.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass
+    details = getattr(error, "details", None)
+    if isinstance(details, dict):
+        for detail in details.get("error", details).get("details", []) or []:
+            match = re.fullmatch(r"([\d.]+)s", str(detail.get("retryDelay", "")))
+            if match:
+                return float(match.group(1))
+    return None
+
+
+async def generate_content_with_retry(
+    client,
+    max_retries: int,
+    limiter: Optional[AIMDLimiter] = None,
+    on_error: Optional[Callable[[Exception, float], None]] = None,
+    label: str = "Request",
+    **request,
+):
+    """
+    ``client.aio.models.generate_content(**request)``, retried up to ``max_retries`` times on overload
+    and transient errors; other errors raise. ``on_error(error, started)`` is called for every failed
+    attempt. Returns ``(response, started)``, ``started`` being when the successful attempt was sent.
+    """
+    for attempt in range(max_retries + 1):
+        started = await limiter.acquire() if limiter else time.monotonic()
+        try:
+            response = await client.aio.models.generate_content(**request)
+        except Exception as e:
+            if on_error:
+                on_error(e, started)
+            hint = retry_after(e)
+            if limiter and is_overload(e):
+                await limiter.on_overload(started, hint)
+            elif limiter:
+                await limiter.on_error(started)
+            if not is_transient(e) or attempt == max_retries:
+                raise
+            delay = hint if hint is not None else min(MAX_BACKOFF_SECONDS, 2**attempt) * random.uniform(0.5, 1.5)
+            print(f"{label}: {type(e).__name__} {getattr(e, 'code', '')}, retry {attempt + 1}/{max_retries} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+
+        if limiter:
+            await limiter.on_success(started)
+        return response, started
@@ -0,0 +1,13 @@
+from utils.sqlite_cache import SqliteCache
+
+
+class ImageCache(SqliteCache):
+    """
+    Content-addressed SQLite store for encoded image payloads.
+
+    Keys are a hash of the source image content plus the encoding parameters, so the same image
+    encoded the same way is shared across runs, prompts and models. Entries are evicted least
+    recently used first once the stored payloads exceed ``max_bytes``.
+    """
+
+    TABLE = "image_payloads"
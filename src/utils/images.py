@@ -0,0 +1,261 @@
+import os
+import math
+import hashlib
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+import datasets
+from PIL import Image
+
+from utils.image_cache import ImageCache
+
+
+# Formats every endpoint we talk to (vLLM, OpenAI, Gemini) accepts without conversion.
+SUPPORTED_MIME_TYPES = ("image/jpeg", "image/png", "image/webp")
+
+
+def sniff_mime_type(data: bytes) -> Optional[str]:
+    """
+    Detect the image format from its magic bytes. Returns None for anything unrecognized.
+    """
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:2] == b"BM":
+        return "image/bmp"
+    if data[:4] in (b"II*\x00", b"MM\x00*"):
+        return "image/tiff"
+    return None
+
+
+def image_dimensions(data: bytes) -> Tuple[int, int]:
+    """
+    ``(width, height)`` of an encoded image. Image.open only parses the header, no pixel data is decoded.
+    """
+    with Image.open(BytesIO(data)) as image:
+        return image.size
+
+
+def disable_image_decoding(dataset: datasets.Dataset, column: str, strict: bool = True) -> datasets.Dataset:
+    """
+    Re-cast an image (or list-of-images) column with ``decode=False`` so rows yield the stored
+    ``{"bytes", "path"}`` dicts straight from Arrow instead of decoded PIL images. With
+    ``strict=False`` other columns (file paths, raw bytes) are left as they are.
+    """
+    feature = dataset.features[column]
+    if isinstance(feature, datasets.Image):
+        return dataset.cast_column(column, datasets.Image(decode=False))
+    if isinstance(feature, (datasets.Sequence, datasets.List)) and isinstance(feature.feature, datasets.Image):
+        return dataset.cast_column(column, type(feature)(datasets.Image(decode=False)))
+    if isinstance(feature, list) and isinstance(feature[0], datasets.Image):
+        return dataset.cast_column(column, [datasets.Image(decode=False)])
+    if not strict:
+        return dataset
+    raise ValueError(f"Column {column!r} is not an image column: {feature}")
+
+
+def fit_pixel_budget(width: int, height: int, max_pixels: Optional[int] = None, min_pixels: Optional[int] = None, factor: int = 32) -> Tuple[int, int]:
+    """
+    Target size for an image under a pixel budget, following Qwen-VL's ``smart_resize`` rounding.
+
+    Images already within ``max_pixels`` keep their size, since the server processor resizes them
+    the same way anyway. Larger ones are scaled down to multiples of ``factor`` (patch size times
+    spatial merge) without dropping below ``min_pixels``.
+    """
+    if max_pixels is None or width * height <= max_pixels:
+        return width, height
+    beta = math.sqrt(width * height / max_pixels)
+    new_width = max(factor, math.floor(width / beta / factor) * factor)
+    new_height = max(factor, math.floor(height / beta / factor) * factor)
+    if min_pixels is not None and new_width * new_height < min_pixels:
+        beta = math.sqrt(min_pixels / (new_width * new_height))
+        new_width = math.ceil(new_width * beta / factor) * factor
+        new_height = math.ceil(new_height * beta / factor) * factor
+    return new_width, new_height
+
+
+def _pil_source_bytes(image: Image.Image) -> Optional[bytes]:
+    """
+    The encoded bytes a PIL image was opened from, when they are still reachable (its file, or an
+    open ``fp``). Hashing those is much cheaper than the decoded pixels.
+    """
+    filename = getattr(image, "filename", None)
+    if filename and os.path.isfile(filename):
+        with open(filename, "rb") as f:
+            return f.read()
+    fp = getattr(image, "fp", None)
+    if fp is not None and not getattr(fp, "closed", False) and hasattr(fp, "seek"):
+        position = fp.tell()
+        try:
+            fp.seek(0)
+            return fp.read()
+        finally:
+            fp.seek(position)
+    return None
+
+
+def _hash_pil_image(image: Image.Image) -> str:
+    # Last resort for images without a source: decodes the pixels
+    digest = hashlib.sha256()
+    digest.update(f"{image.mode}:{image.size}".encode("utf-8"))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def _encode_pil_image(image: Image.Image, format: str = "JPEG", quality: int = 75) -> bytes:
+    if format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    buffered = BytesIO()
+    image.save(buffered, format=format, quality=quality)
+    return buffered.getvalue()
+
+
+def transcode_image(image_input, format: str = "JPEG", quality: int = 75, max_pixels: Optional[int] = None, min_pixels: Optional[int] = None) -> bytes:
+    """
+    Decode a PIL image or encoded bytes, downscale it to the pixel budget and encode it as ``format``.
+
+    Encoded JPEG sources are decoded in draft mode, so an 8k image that only needs to end up at a
+    quarter of its size is decoded at reduced scale by libjpeg instead of at full resolution.
+    Safe to run in a worker process.
+    """
+    if isinstance(image_input, Image.Image):
+        target = fit_pixel_budget(*image_input.size, max_pixels=max_pixels, min_pixels=min_pixels)
+        if target != image_input.size:
+            image_input = image_input.resize(target, Image.Resampling.BICUBIC)
+        return _encode_pil_image(image_input, format=format, quality=quality)
+
+    with Image.open(BytesIO(image_input)) as image:
+        target = fit_pixel_budget(*image.size, max_pixels=max_pixels, min_pixels=min_pixels)
+        if target != image.size:
+            if image.format == "JPEG":
+                image.draft("RGB", target)
+            resized = image.resize(target, Image.Resampling.BICUBIC)
+            return _encode_pil_image(resized, format=format, quality=quality)
+        return _encode_pil_image(image, format=format, quality=quality)
+
+
+def ensure_rgb_bytes(data: bytes) -> bytes:
+    """
+    Encoded RGB images in a supported format are returned untouched; only the header is parsed.
+    Anything else (palette, RGBA, CMYK, grayscale, GIF/BMP/TIFF) is converted to RGB and stored as PNG.
+    """
+    with Image.open(BytesIO(data)) as image:
+        if image.mode == "RGB" and sniff_mime_type(data) in SUPPORTED_MIME_TYPES:
+            return data
+        return _encode_pil_image(image.convert("RGB"), format="PNG")
+
+
+def _read_source_bytes(image_input) -> Optional[bytes]:
+    """
+    Raw encoded bytes behind an image input, or None for already decoded PIL images.
+    Files are read through a context manager so no handle outlives the call.
+    """
+    if isinstance(image_input, dict):
+        if image_input.get("bytes") is not None:
+            return image_input["bytes"]
+        image_input = image_input["path"]
+    if isinstance(image_input, str):
+        with open(image_input, "rb") as f:
+            return f.read()
+    if isinstance(image_input, bytes):
+        return image_input
+    if isinstance(image_input, Image.Image):
+        return None
+    raise ValueError(f"Unsupported image type: {type(image_input)}")
+
+
+class ImagePreprocessor:
+    """
+    Turns dataset image inputs into ``(bytes, mime_type)`` payloads.
+
+    Cache lookups happen in the calling thread; decoding, resizing and encoding are handed to a
+    process pool when ``num_workers`` is set, so the GIL-bound work never stalls the request loop.
+    Callers should hand over undecoded inputs (``{"bytes", "path"}`` dicts from a ``decode=False``
+    column, raw bytes or file paths): cache keys hash the encoded bytes, and a cache hit then never
+    decodes the image. PIL images are keyed on the file or buffer they were opened from when that
+    is still available, and on their pixels otherwise. With ``passthrough``, encoded inputs are sent
+    unchanged when their format is supported and they fit the pixel budget.
+    """
+
+    def __init__(
+        self,
+        cache: Optional[ImageCache] = None,
+        passthrough: bool = False,
+        max_pixels: Optional[int] = None,
+        min_pixels: Optional[int] = None,
+        num_workers: int = 0,
+        format: str = "JPEG",
+        quality: int = 75,
+    ):
+        if max_pixels is not None and min_pixels is not None and min_pixels > max_pixels:
+            raise ValueError(f"min_pixels ({min_pixels}) must not exceed max_pixels ({max_pixels})")
+        self.cache = cache
+        self.passthrough = passthrough
+        self.max_pixels = max_pixels
+        self.min_pixels = min_pixels
+        self.format = format
+        self.quality = quality
+        # Workers start lazily, once the writer flush thread and asyncio.to_thread workers exist, and
+        # forking a multi-threaded process can deadlock; forkserver children start from a clean process
+        self.pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("forkserver")) if num_workers > 0 else None
+
+    def _fits_budget(self, source: bytes, max_pixels: Optional[int]) -> bool:
+        if max_pixels is None:
+            return True
+        width, height = image_dimensions(source)
+        return width * height <= max_pixels
+
+    def _transcode(self, image_input, max_pixels: Optional[int]) -> bytes:
+        kwargs = dict(format=self.format, quality=self.quality, max_pixels=max_pixels, min_pixels=self.min_pixels)
+        if self.pool is None:
+            return transcode_image(image_input, **kwargs)
+        return self.pool.submit(transcode_image, image_input, **kwargs).result()
+
+    def __call__(self, image_input, max_pixels: Optional[int] = None, passthrough: Optional[bool] = None) -> Tuple[bytes, str]:
+        """
+        ``max_pixels`` tightens the preprocessor's own pixel budget and ``passthrough`` overrides
+        the preprocessor's setting, for this image only.
+        """
+        source = _read_source_bytes(image_input)
+        if source is None:
+            source = _pil_source_bytes(image_input)
+        if max_pixels is None or (self.max_pixels is not None and self.max_pixels < max_pixels):
+            max_pixels = self.max_pixels
+
+        if source is not None and (self.passthrough if passthrough is None else passthrough):
+            mime_type = sniff_mime_type(source)
+            if mime_type in SUPPORTED_MIME_TYPES and self._fits_budget(source, max_pixels):
+                return source, mime_type
+
+        key = None
+        if self.cache:
+            content_hash = _hash_pil_image(image_input) if source is None else hashlib.sha256(source).hexdigest()
+            key = ImageCache.make_key(
+                content_hash, format=self.format, quality=self.quality, max_pixels=max_pixels, min_pixels=self.min_pixels
+            )
+            data = self.cache.get(key)
+            if data is not None:
+                return data, f"image/{self.format.lower()}"
+
+        data = self._transcode(image_input if source is None else source, max_pixels)
+        if self.cache:
+            self.cache.put(key, data)
+        return data, f"image/{self.format.lower()}"
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown()
+        if self.cache:
+            print(f"Image cache: {self.cache.stats()}")
+            self.cache.close()
+
+
+def is_image_path(image_input) -> bool:
+    return isinstance(image_input, str) and len(image_input) < 4096 and os.path.exists(image_input)
@@ -0,0 +1,260 @@
+"""
+Client-side router over several OpenAI-compatible (vLLM) replicas.
+
+Each request goes to the healthy replica with the fewest requests outstanding. A background task
+probes ``/health`` on every replica to evict and readmit them. A request whose replica fails at
+the connection level (or with a 5xx) is retried on another one. Connection errors and timeouts
+evict the replica at once, while 5xx responses only do after ``max_server_errors`` in a row, since
+a single one is as likely caused by the request as by the replica. ``EndpointRouter`` exposes
+``chat.completions.create`` so it can be used anywhere an ``AsyncOpenAI`` client is.
+"""
+
+import time
+import random
+import asyncio
+from types import SimpleNamespace
+from typing import List, Optional
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+# Failures that say something about the replica rather than the request (APITimeoutError is a subclass)
+REPLICA_ERRORS = (openai.APIConnectionError,)
+# Failures retried on another replica
+RETRY_ERRORS = REPLICA_ERRORS + (openai.InternalServerError,)
+# A stream cut off mid-way surfaces as a transport error, or as an APIError for an error event
+STREAM_REPLICA_ERRORS = REPLICA_ERRORS + (httpx.TransportError,)
+STREAM_ERRORS = RETRY_ERRORS + (httpx.TransportError, openai.APIError)
+
+
+def normalize_base_url(endpoint: str) -> str:
+    """
+    Accept ``host:port``, ``http://host:port`` or a full ``.../v1`` base URL.
+    """
+    endpoint = endpoint.strip().rstrip("/")
+    if not endpoint.startswith(("http://", "https://")):
+        endpoint = f"http://{endpoint}"
+    if not endpoint.endswith("/v1"):
+        endpoint = f"{endpoint}/v1"
+    return endpoint
+
+
+class Endpoint:
+    def __init__(self, base_url: str, api_key: str, timeout: Optional[float] = None):
+        self.base_url = base_url
+        self.health_url = base_url[: -len("/v1")] + "/health"
+        self.client = AsyncOpenAI(base_url=base_url, api_key=api_key, max_retries=0, timeout=timeout)
+        self.healthy = True
+        self.outstanding = 0
+        self.completed = 0
+        self.failed = 0
+        self.server_errors = 0
+        self.latency = 0.0
+        self.completion_tokens = 0
+
+    def stats(self, elapsed: float) -> dict:
+        return {
+            "endpoint": self.base_url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "completed": self.completed,
+            "failed": self.failed,
+            "requests_per_s": self.completed / elapsed if elapsed else 0.0,
+            "tokens_per_s": self.completion_tokens / elapsed if elapsed else 0.0,
+            "mean_latency_s": self.latency / self.completed if self.completed else 0.0,
+        }
+
+
+class RoutedStream:
+    """
+    A streamed response that holds its replica's outstanding slot until it is read to the end or
+    closed, then records latency and completion tokens. Errors while reading count against the
+    replica like failed requests do; the request itself can't fail over once it has streamed.
+    """
+
+    def __init__(self, router: "EndpointRouter", endpoint: Endpoint, start: float, stream):
+        self.router = router
+        self.endpoint = endpoint
+        self.start = start
+        self.stream = stream
+        self.usage = None
+        self.finish_reason = None
+        self.finished = False
+
+    def _finish(self, error: Optional[Exception] = None) -> None:
+        if self.finished:
+            return
+        self.finished = True
+        self.endpoint.outstanding -= 1
+        if error is None:
+            self.router._record_success(self.endpoint, self.start, self.usage)
+        else:
+            self.router._record_failure(self.endpoint, error)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            chunk = await self.stream.__anext__()
+        except StopAsyncIteration:
+            # A server that dies mid-reply may just close a close-delimited response; no finish reason gives it away
+            self._finish(None if self.finish_reason else httpx.RemoteProtocolError("stream ended without a finish reason"))
+            raise
+        except STREAM_ERRORS as e:
+            self._finish(e)
+            raise
+        if getattr(chunk, "usage", None):
+            self.usage = chunk.usage
+        for choice in getattr(chunk, "choices", None) or ():
+            self.finish_reason = choice.finish_reason or self.finish_reason
+        return chunk
+
+    async def close(self) -> None:
+        # Closed early (e.g. an aborted generation) is not the replica's fault
+        self._finish()
+        await self.stream.close()
+
+    async def __aenter__(self) -> "RoutedStream":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+
+class EndpointRouter:
+    """
+    Least-outstanding-requests scheduling across ``base_urls`` with health probes and failover.
+    """
+
+    def __init__(
+        self,
+        base_urls: List[str],
+        api_key: str = "EMPTY",
+        health_interval: float = 10.0,
+        stats_interval: float = 60.0,
+        unavailable_timeout: float = 600.0,
+        timeout: Optional[float] = None,
+        max_server_errors: int = 3,
+    ):
+        if not base_urls:
+            raise ValueError("EndpointRouter needs at least one endpoint")
+        self.endpoints = [Endpoint(normalize_base_url(url), api_key, timeout=timeout) for url in base_urls]
+        self.health_interval = health_interval
+        self.stats_interval = stats_interval
+        self.unavailable_timeout = unavailable_timeout
+        self.max_server_errors = max_server_errors
+        self.max_attempts = 2 * len(self.endpoints)
+        self._http = None
+        self._monitor = None
+        self._probed = None
+        self._started = None
+        # Same call shape as AsyncOpenAI
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def _ensure_started(self) -> None:
+        if self._monitor is None:
+            self._started = time.monotonic()
+            self._http = httpx.AsyncClient(timeout=5.0)
+            self._probed = asyncio.Event()
+            self._monitor = asyncio.create_task(self._monitor_loop())
+        # Don't dispatch before the first probe round has weeded out dead replicas
+        await self._probed.wait()
+
+    async def _probe(self, endpoint: Endpoint) -> None:
+        try:
+            healthy = (await self._http.get(endpoint.health_url)).status_code == 200
+        except httpx.HTTPError:
+            healthy = False
+        if healthy != endpoint.healthy:
+            print(f"[router] {'readmitting' if healthy else 'evicting'} {endpoint.base_url}")
+        endpoint.healthy = healthy
+        if healthy:
+            endpoint.server_errors = 0
+
+    async def _monitor_loop(self) -> None:
+        last_stats = time.monotonic()
+        while True:
+            await asyncio.gather(*(self._probe(endpoint) for endpoint in self.endpoints))
+            self._probed.set()
+            if time.monotonic() - last_stats >= self.stats_interval:
+                self.log_stats()
+                last_stats = time.monotonic()
+            await asyncio.sleep(self.health_interval)
+
+    async def _pick(self, exclude) -> Endpoint:
+        deadline = time.monotonic() + self.unavailable_timeout
+        while True:
+            candidates = [e for e in self.endpoints if e.healthy and e not in exclude] or [e for e in self.endpoints if e.healthy]
+            if candidates:
+                fewest = min(e.outstanding for e in candidates)
+                return random.choice([e for e in candidates if e.outstanding == fewest])
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"No healthy endpoint for {self.unavailable_timeout:.0f}s")
+            await asyncio.sleep(min(1.0, self.health_interval))
+
+    def _record_failure(self, endpoint: Endpoint, error: Exception) -> None:
+        endpoint.failed += 1
+        if not isinstance(error, STREAM_REPLICA_ERRORS):
+            endpoint.server_errors += 1
+        if endpoint.healthy and (isinstance(error, STREAM_REPLICA_ERRORS) or endpoint.server_errors >= self.max_server_errors):
+            endpoint.healthy = False
+            print(f"[router] {endpoint.base_url} failed ({type(error).__name__}); evicted until its health probe passes")
+
+    def _record_success(self, endpoint: Endpoint, start: float, usage) -> None:
+        endpoint.server_errors = 0
+        endpoint.completed += 1
+        endpoint.latency += time.monotonic() - start
+        if usage:
+            endpoint.completion_tokens += usage.completion_tokens or 0
+
+    async def create(self, **kwargs):
+        """
+        ``chat.completions.create`` on the least loaded healthy replica, failing over to another
+        replica on connection errors and 5xx responses. A streamed response is returned wrapped in
+        ``RoutedStream``, which keeps the request outstanding on its replica until the stream ends.
+        """
+        await self._ensure_started()
+        tried = []
+        for attempt in range(self.max_attempts):
+            endpoint = await self._pick(tried)
+            endpoint.outstanding += 1
+            start = time.monotonic()
+            try:
+                response = await endpoint.client.chat.completions.create(**kwargs)
+            except RETRY_ERRORS as e:
+                endpoint.outstanding -= 1
+                tried.append(endpoint)
+                self._record_failure(endpoint, e)
+                if attempt == self.max_attempts - 1:
+                    raise
+                continue
+            except BaseException:
+                endpoint.outstanding -= 1
+                raise
+            if kwargs.get("stream"):
+                return RoutedStream(self, endpoint, start, response)
+            endpoint.outstanding -= 1
+            self._record_success(endpoint, start, getattr(response, "usage", None))
+            return response
+
+    def stats(self) -> List[dict]:
+        elapsed = time.monotonic() - self._started if self._started else 0.0
+        return [endpoint.stats(elapsed) for endpoint in self.endpoints]
+
+    def log_stats(self) -> None:
+        for s in self.stats():
+            print(
+                f"[router] {s['endpoint']}: {'up' if s['healthy'] else 'DOWN'}, {s['completed']} done, {s['failed']} failed, {s['outstanding']} in flight, "
+                f"{s['requests_per_s']:.2f} req/s, {s['tokens_per_s']:.1f} tok/s, {s['mean_latency_s']:.2f}s mean latency"
+            )
+
+    async def close(self) -> None:
+        if self._monitor is not None:
+            self._monitor.cancel()
+            await asyncio.gather(self._monitor, return_exceptions=True)
+            await self._http.aclose()
+            self.log_stats()
+        for endpoint in self.endpoints:
+            await endpoint.client.close()
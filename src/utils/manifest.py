@@ -0,0 +1,98 @@
+import os
+from typing import Iterable, List
+
+from utils.result_io import iter_records
+
+
+class CompletionManifest:
+    """
+    Sidecar record of which dataset indices already have a result in an output file.
+
+    Stored next to the output as an append-only file with one completed index per line, so marking
+    a sample done is a single small write and results may land in any order. Resuming reads only
+    this file (plus the output once, if the sidecar is missing), never the dataset rows.
+
+    Indices are marked after their record is committed to the output file (see ``ResultWriter``). A
+    crash between the two writes means the sample is redone and appears twice in the output;
+    consumers dedupe on ``sample_id``, keeping the latest record.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.completed = set()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.completed.update(int(line) for line in f if line.strip())
+        self._file = None
+
+    @classmethod
+    def for_output(cls, output_file: str) -> "CompletionManifest":
+        """
+        Open the manifest for ``output_file``, rebuilding it from the output if it doesn't exist yet.
+        """
+        manifest = cls(output_file + ".manifest")
+        if not os.path.exists(manifest.path) and os.path.exists(output_file):
+            manifest.rebuild_from_output(output_file)
+        return manifest
+
+    def rebuild_from_output(self, output_file: str) -> None:
+        """
+        Recover completed indices from ``sample_id`` fields. Outputs written before sample IDs were
+        recorded fall back to the old assumption that the first N lines are the first N samples.
+        """
+        indices = []
+        legacy_lines = 0
+        for record in iter_records(output_file):
+            if "sample_id" in record:
+                indices.append(record["sample_id"])
+            else:
+                legacy_lines += 1
+        if legacy_lines:
+            print(f"Warning: {legacy_lines} records in {output_file} have no sample_id; assuming they cover indices 0..{legacy_lines - 1}.")
+            indices.extend(range(legacy_lines))
+        self.mark_many(indices)
+        print(f"Rebuilt manifest {self.path} with {len(self.completed)} completed samples.")
+
+    def __contains__(self, index: int) -> bool:
+        return index in self.completed
+
+    def __len__(self) -> int:
+        return len(self.completed)
+
+    def missing(self, indices: Iterable[int]) -> List[int]:
+        """
+        Indices from ``indices`` that have no result yet, in the given order.
+        """
+        return [i for i in indices if i not in self.completed]
+
+    def mark(self, index: int) -> None:
+        self.mark_many([index])
+
+    def mark_many(self, indices: Iterable[int]) -> None:
+        new = [i for i in indices if i not in self.completed]
+        if not new:
+            return
+        if self._file is None:
+            self._file = open(self.path, "a")
+        self._file.write("".join(f"{i}\n" for i in new))
+        self._file.flush()
+        self.completed.update(new)
+
+    def unmark_many(self, indices: Iterable[int]) -> None:
+        """
+        Forget ``indices`` so they are run again. Rewrites the sidecar, which is otherwise append-only.
+        """
+        indices = self.completed.intersection(indices)
+        if not indices:
+            return
+        self.close()
+        self.completed -= indices
+        with open(self.path + ".tmp", "w") as f:
+            f.write("".join(f"{i}\n" for i in sorted(self.completed)))
+        os.replace(self.path + ".tmp", self.path)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
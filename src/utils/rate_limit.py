@@ -0,0 +1,77 @@
+import time
+import asyncio
+from typing import Optional
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count (about four characters per token for English text and code).
+    """
+    return len(text) // 4 + 1
+
+
+class TokenBucketLimiter:
+    """
+    Async limiter enforcing requests-per-minute and tokens-per-minute quotas.
+
+    Each quota is a bucket that refills continuously at the per-minute rate and holds at most
+    ``burst_seconds`` worth of budget. Providers enforce quotas over sub-minute windows, so a small
+    burst allowance keeps the sustained rate at the quota without spiking past it. Callers wait in
+    FIFO order.
+    """
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None, burst_seconds: float = 10.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_capacity = max(1.0, requests_per_minute * burst_seconds / 60) if requests_per_minute else 0.0
+        self.token_capacity = tokens_per_minute * burst_seconds / 60 if tokens_per_minute else 0.0
+        self._requests = self.request_capacity
+        self._tokens = self.token_capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        if self.requests_per_minute:
+            self._requests = min(self.request_capacity, self._requests + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self._tokens = min(self.token_capacity, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    def _wait_time(self, tokens: int) -> float:
+        wait = 0.0
+        if self.requests_per_minute and self._requests < 1:
+            wait = max(wait, (1 - self._requests) * 60 / self.requests_per_minute)
+        if self.tokens_per_minute and self._tokens < tokens:
+            wait = max(wait, (tokens - self._tokens) * 60 / self.tokens_per_minute)
+        return wait
+
+    async def acquire(self, tokens: int = 0) -> int:
+        """
+        Wait until a request costing ``tokens`` fits both quotas. Returns the tokens charged.
+        """
+        # A single request larger than the whole bucket would otherwise wait forever.
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.token_capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                wait = self._wait_time(tokens)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            if self.requests_per_minute:
+                self._requests -= 1
+            if self.tokens_per_minute:
+                self._tokens -= tokens
+        return tokens
+
+    def settle(self, estimated: int, actual: Optional[int]) -> None:
+        """
+        Correct the token bucket once the provider reports actual usage for a request.
+        Over-estimates are returned; under-estimates are charged and may push the bucket negative.
+        """
+        if self.tokens_per_minute and actual is not None:
+            self._refill()
+            self._tokens = min(self.token_capacity, self._tokens + estimated - actual)
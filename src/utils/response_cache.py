@@ -0,0 +1,55 @@
+import os
+import json
+import hashlib
+from typing import Optional
+
+from utils.sqlite_cache import SqliteCache
+
+DEFAULT_RESPONSE_CACHE_PATH = "cache/llm_responses.sqlite"
+
+
+class ResponseCache(SqliteCache):
+    """
+    Persistent cache of LLM responses keyed on model, fully rendered prompt and sampling parameters.
+
+    Rerunning a refine or judge pass after changing one prompt version only pays for records whose
+    rendered prompt actually changed; everything else is served from the local store.
+    """
+
+    TABLE = "responses"
+
+    @staticmethod
+    def request_key(model: str, prompt, **params) -> str:
+        """
+        Key for a request. ``prompt`` is anything JSON-serializable (a string, a messages list, or
+        content parts with image hashes standing in for image bytes).
+        """
+        rendered = json.dumps(prompt, sort_keys=True, ensure_ascii=False)
+        return SqliteCache.make_key(hashlib.sha256(rendered.encode("utf-8")).hexdigest(), model=model, **params)
+
+    def get_text(self, key: str) -> Optional[str]:
+        data = self.get(key)
+        return None if data is None else data.decode("utf-8")
+
+    def put_text(self, key: str, text: str) -> None:
+        self.put(key, text.encode("utf-8"))
+
+    def report(self, name: str = "Response cache") -> None:
+        stats = self.stats()
+        print(f"{name}: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%} hit rate), {stats['evictions']} evicted")
+
+
+def open_response_cache() -> Optional[ResponseCache]:
+    """
+    Open the shared response cache configured by ``RESPONSE_CACHE`` (path, empty to disable),
+    ``RESPONSE_CACHE_TTL_DAYS`` and ``RESPONSE_CACHE_SIZE_GB``.
+    """
+    path = os.getenv("RESPONSE_CACHE", DEFAULT_RESPONSE_CACHE_PATH)
+    if not path:
+        return None
+    ttl_days = os.getenv("RESPONSE_CACHE_TTL_DAYS")
+    return ResponseCache(
+        path,
+        max_bytes=int(float(os.getenv("RESPONSE_CACHE_SIZE_GB", 5)) * 1024**3),
+        ttl_seconds=float(ttl_days) * 86400 if ttl_days else None,
+    )
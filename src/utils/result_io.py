@@ -0,0 +1,305 @@
+"""
+Group-commit result output and a streaming reader for it.
+
+``ResultWriter`` buffers records and commits them in one append when ``commit_records`` records or
+``commit_bytes`` bytes are pending, or ``commit_interval`` seconds have passed since the last commit,
+instead of a write and flush per sample. The format follows the path:
+
+- ``.jsonl``: one appended write per commit.
+- ``.jsonl.zst``: one appended zstd frame per commit (needs ``zstandard``); readers decode the
+  concatenated frames as one stream.
+- ``.parquet``: a directory with one Parquet part per commit, written to a temp file and renamed.
+  Every top-level field is a ``large_string`` column holding the JSON of its value, so records
+  whose fields change type (an int ``answer`` here, a str one there) share one schema and
+  round-trip exactly.
+
+Records are serialised when they are written, so later changes to the dict don't leak into the
+output. A background thread commits pending records once ``commit_interval`` has passed even when
+no further record arrives. The completion manifest is only marked after a commit, so a crash loses
+at most the uncommitted records, and those are simply redone. A torn tail left by a crash mid-commit is cut off when the file
+is reopened for appending. ``iter_records`` streams any of the three formats record by record.
+"""
+
+import io
+import os
+import json
+import glob
+import time
+import shutil
+import threading
+from typing import Iterable, Iterator, Optional
+
+OUTPUT_FORMATS = ("jsonl", "jsonl.zst", "parquet")
+COMMIT_RECORDS = 256
+COMMIT_BYTES = 4 * 1024**2
+COMMIT_INTERVAL = 5.0
+# Parquet file metadata marking parts whose columns hold JSON-encoded values
+JSON_COLUMNS_KEY = b"result_io.json_columns"
+
+
+def output_format(path: str) -> str:
+    if path.endswith(".jsonl.zst"):
+        return "jsonl.zst"
+    if path.endswith(".parquet"):
+        return "parquet"
+    return "jsonl"
+
+
+def with_format(path: str, fmt: Optional[str]) -> str:
+    """
+    ``path`` with its ``.jsonl`` / ``.jsonl.zst`` / ``.parquet`` suffix replaced by ``fmt`` (unchanged if ``fmt`` is None).
+    """
+    if fmt is None:
+        return path
+    current = output_format(path)
+    if path.endswith("." + current):
+        path = path[: -len(current) - 1]
+    return f"{path}.{fmt}"
+
+
+def resolve_input(path: str) -> str:
+    """
+    ``path`` if it exists, otherwise the same output written in another format.
+    """
+    if os.path.exists(path):
+        return path
+    for fmt in OUTPUT_FORMATS:
+        candidate = with_format(path, fmt)
+        if os.path.exists(candidate):
+            return candidate
+    return path
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("Reading or writing .jsonl.zst needs the zstandard package (pip install zstandard)") from e
+    return zstandard
+
+
+def _truncate_partial_line(path: str) -> None:
+    """
+    Cut an unterminated last line (a record torn by a crash) so the next append starts on a fresh line.
+    """
+    with open(path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            step = min(65536, position)
+            f.seek(position - step)
+            chunk = f.read(step)
+            newline = chunk.rfind(b"\n")
+            if newline >= 0:
+                position = position - step + newline + 1
+                break
+            position -= step
+        if position < end:
+            print(f"Dropping a torn {end - position}-byte record at the end of {path}")
+            f.truncate(position)
+
+
+def _truncate_partial_frame(path: str) -> None:
+    """
+    Cut a torn zstd frame at the end of ``path``; frames after it would be unreadable otherwise.
+    """
+    zstandard = _zstandard()
+    decompressor = zstandard.ZstdDecompressor()
+    good = offset = 0
+    stream = decompressor.decompressobj()
+    try:
+        with open(path, "rb") as f:
+            while chunk := f.read(1024**2):
+                while chunk:
+                    stream.decompress(chunk)
+                    if not stream.eof:
+                        offset += len(chunk)
+                        break
+                    offset += len(chunk) - len(stream.unused_data)
+                    good = offset
+                    chunk = stream.unused_data
+                    stream = decompressor.decompressobj()
+    except zstandard.ZstdError:
+        pass
+    if good < os.path.getsize(path):
+        print(f"Dropping a torn {os.path.getsize(path) - good}-byte frame at the end of {path}")
+        with open(path, "rb+") as f:
+            f.truncate(good)
+
+
+class ResultWriter:
+    """
+    Batched, append-only writer for result records. Marks ``sample_id`` values in ``manifest`` once
+    their records are committed. ``overwrite`` starts from an empty output instead of appending.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        manifest=None,
+        overwrite: bool = False,
+        commit_records: int = COMMIT_RECORDS,
+        commit_bytes: int = COMMIT_BYTES,
+        commit_interval: float = COMMIT_INTERVAL,
+        fsync: bool = False,
+    ):
+        self.path = path
+        self.format = output_format(path)
+        self.manifest = manifest
+        self.commit_records = commit_records
+        self.commit_bytes = commit_bytes
+        self.commit_interval = commit_interval
+        self.fsync = fsync
+        self.pending = []
+        self.pending_bytes = 0
+        self.last_commit = time.monotonic()
+        self.committed = 0
+        self.commits = 0
+        # Writes, commits and the flush thread all go through this lock
+        self._lock = threading.RLock()
+        self._closed = threading.Event()
+
+        if overwrite and os.path.isdir(path):
+            shutil.rmtree(path)
+        elif overwrite and os.path.exists(path):
+            os.remove(path)
+        if self.format == "parquet":
+            os.makedirs(path, exist_ok=True)
+            for stale in glob.glob(os.path.join(path, "*.tmp")):
+                os.remove(stale)
+            self._next_part = len(glob.glob(os.path.join(path, "part-*.parquet")))
+            self._fd = None
+        else:
+            if os.path.exists(path) and os.path.getsize(path):
+                (_truncate_partial_frame if self.format == "jsonl.zst" else _truncate_partial_line)(path)
+            self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self._compressor = _zstandard().ZstdCompressor(level=3) if self.format == "jsonl.zst" else None
+        self._flusher = threading.Thread(target=self._flush_loop, name="result-writer-flush", daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self) -> None:
+        while not self._closed.wait(self.commit_interval / 4):
+            with self._lock:
+                if self.pending and time.monotonic() - self.last_commit >= self.commit_interval:
+                    self.commit()
+
+    def write(self, record: dict) -> None:
+        # Serialise now: the caller may keep changing the dict after handing it over
+        if self.format == "parquet":
+            payload = {key: json.dumps(value) for key, value in record.items()}
+            size = sum(len(value) for value in payload.values())
+        else:
+            payload = json.dumps(record) + "\n"
+            size = len(payload)
+        with self._lock:
+            self.pending.append((record.get("sample_id"), payload))
+            self.pending_bytes += size
+            if len(self.pending) >= self.commit_records or self.pending_bytes >= self.commit_bytes or time.monotonic() - self.last_commit >= self.commit_interval:
+                self.commit()
+
+    def write_many(self, records: Iterable[dict]) -> None:
+        for record in records:
+            self.write(record)
+
+    def commit(self) -> None:
+        with self._lock:
+            self._commit()
+
+    def _commit(self) -> None:
+        self.last_commit = time.monotonic()
+        if not self.pending:
+            return
+        if self.format == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            part = os.path.join(self.path, f"part-{self._next_part:05d}.parquet")
+            rows = [row for _, row in self.pending]
+            # Union of the keys over all records; a record without a key gets a null there
+            columns = list(dict.fromkeys(key for row in rows for key in row))
+            schema = pa.schema([(key, pa.large_string()) for key in columns], metadata={JSON_COLUMNS_KEY: b"1"})
+            table = pa.Table.from_pylist(rows, schema=schema)
+            pq.write_table(table, part + ".tmp", compression="zstd")
+            os.replace(part + ".tmp", part)
+            self._next_part += 1
+        else:
+            data = "".join(line for _, line in self.pending).encode("utf-8")
+            if self._compressor is not None:
+                data = self._compressor.compress(data)
+            # One O_APPEND write per commit; loop only in case the kernel writes it short
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self._fd, view) :]
+            if self.fsync:
+                os.fsync(self._fd)
+        if self.manifest is not None:
+            self.manifest.mark_many(sample_id for sample_id, _ in self.pending if sample_id is not None)
+        self.committed += len(self.pending)
+        self.commits += 1
+        self.pending = []
+        self.pending_bytes = 0
+
+    def close(self) -> None:
+        self._closed.set()
+        self._flusher.join()
+        with self._lock:
+            self._commit()
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def __enter__(self) -> "ResultWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def _drop_nulls(value):
+    # Parts written before the JSON columns fill keys a record didn't have with nulls; drop them
+    if isinstance(value, dict):
+        return {key: _drop_nulls(item) for key, item in value.items() if item is not None}
+    if isinstance(value, list):
+        return [_drop_nulls(item) for item in value]
+    return value
+
+
+def _iter_lines(lines: Iterable[str], path: str) -> Iterator[dict]:
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError:
+            print(f"Failed to decode JSON in {path}: {line[:50]}...")
+
+
+def iter_records(path: str, batch_size: int = 1024) -> Iterator[dict]:
+    """
+    Stream the records of a ``.jsonl``, ``.jsonl.zst`` or ``.parquet`` output without loading it whole.
+    """
+    fmt = output_format(path)
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+
+        parts = sorted(glob.glob(os.path.join(path, "part-*.parquet"))) if os.path.isdir(path) else [path]
+        for part in parts:
+            parquet_file = pq.ParquetFile(part)
+            json_columns = JSON_COLUMNS_KEY in (parquet_file.schema_arrow.metadata or {})
+            for batch in parquet_file.iter_batches(batch_size=batch_size):
+                for row in batch.to_pylist():
+                    if json_columns:
+                        yield {key: json.loads(value) for key, value in row.items() if value is not None}
+                    else:
+                        yield _drop_nulls(row)
+    elif fmt == "jsonl.zst":
+        zstandard = _zstandard()
+        with open(path, "rb") as f:
+            reader = io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True), encoding="utf-8")
+            try:
+                yield from _iter_lines(reader, path)
+            except zstandard.ZstdError as e:
+                print(f"Stopped reading {path} at a torn frame: {e}")
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            yield from _iter_lines(f, path)
@@ -0,0 +1,110 @@
+"""
+Deterministic data-parallel sharding for SLURM array jobs, and merging the shard outputs back.
+
+Shard ``k`` of ``n`` owns a contiguous block of dataset indices, so every job with the same
+``--num_shards`` computes the same partition. Each shard writes its own results file (and
+completion manifest next to it); ``merge_shards`` stitches them back together in dataset order.
+"""
+
+import os
+import re
+from typing import Dict, List
+
+from utils.manifest import CompletionManifest
+from utils.result_io import ResultWriter, iter_records
+
+
+def _default_num_shards() -> int:
+    return int(os.getenv("SLURM_ARRAY_TASK_COUNT", 1))
+
+
+def _default_shard_index() -> int:
+    # Arrays like --array=1-8 start at SLURM_ARRAY_TASK_MIN rather than 0
+    return int(os.getenv("SLURM_ARRAY_TASK_ID", 0)) - int(os.getenv("SLURM_ARRAY_TASK_MIN", 0))
+
+
+def add_shard_arguments(parser) -> None:
+    parser.add_argument("--num_shards", type=int, default=_default_num_shards(), help="Split the dataset into this many shards (default: SLURM array size).")
+    parser.add_argument("--shard_index", type=int, default=_default_shard_index(), help="Which shard this process runs (default: SLURM_ARRAY_TASK_ID).")
+    parser.add_argument("--merge", action="store_true", help="Merge finished shard outputs into the unsharded results file instead of running inference.")
+
+
+def shard_range(total: int, num_shards: int, shard_index: int) -> range:
+    """
+    Contiguous block of indices owned by ``shard_index``; the first ``total % num_shards`` shards get one extra row.
+    """
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"shard_index {shard_index} is outside [0, {num_shards})")
+    size, extra = divmod(total, num_shards)
+    start = shard_index * size + min(shard_index, extra)
+    return range(start, start + size + (1 if shard_index < extra else 0))
+
+
+def shard_tag(num_shards: int, shard_index: int) -> str:
+    return f"_shard-{shard_index:05d}-of-{num_shards:05d}" if num_shards > 1 else ""
+
+
+def shard_output_file(output_file: str, num_shards: int, shard_index: int) -> str:
+    """
+    Insert the shard tag before the ``_<stage>.<format>`` suffix, e.g. ``<stem>_results.jsonl`` ->
+    ``<stem>_shard-00003-of-00008_results.jsonl``, so stage files derived from a shard's stem line up.
+    """
+    return re.sub(r"((?:_[a-z]+)?\.(?:jsonl(?:\.zst)?|parquet))$", lambda m: shard_tag(num_shards, shard_index) + m.group(1), output_file, count=1)
+
+
+def merge_shards(output_file: str, total: int, num_shards: int) -> Dict[int, List[int]]:
+    """
+    Write every shard's records to ``output_file`` in dataset order, one shard in memory at a time.
+
+    Records outside a shard's range are reported and dropped. For a repeated ``sample_id`` the last
+    record wins, as everywhere else: a redone sample (crash recovery, ``--retry_rejected``) is
+    appended after its stale record. Returns ``{shard_index: missing indices}`` for shards that need rerunning;
+    the merged file and its manifest are written either way so finished work is usable.
+    """
+    incomplete = {}
+    duplicates = 0
+    merged = 0
+    open(output_file + ".manifest.tmp", "w").close()
+    manifest = CompletionManifest(output_file + ".manifest.tmp")
+    with ResultWriter(output_file, manifest=manifest, overwrite=True) as writer:
+        for shard_index in range(num_shards):
+            path = shard_output_file(output_file, num_shards, shard_index)
+            expected = shard_range(total, num_shards, shard_index)
+            records = {}
+            if os.path.exists(path):
+                for record in iter_records(path):
+                    sample_id = record.get("sample_id")
+                    if sample_id not in expected:
+                        print(f"Shard {shard_index}: sample_id {sample_id} is outside its range {expected.start}-{expected.stop - 1}; dropped")
+                    else:
+                        duplicates += sample_id in records
+                        records[sample_id] = record
+            else:
+                print(f"Shard {shard_index}: {path} not found")
+
+            writer.write_many(records[sample_id] for sample_id in sorted(records))
+            writer.commit()
+            merged += len(records)
+
+            missing = [i for i in expected if i not in records]
+            if missing:
+                incomplete[shard_index] = missing
+    manifest.close()
+    os.replace(output_file + ".manifest.tmp", output_file + ".manifest")
+
+    print(f"Merged {merged}/{total} samples from {num_shards} shards into {output_file} ({duplicates} superseded duplicates dropped)")
+    for shard_index, missing in incomplete.items():
+        print(f"Shard {shard_index} is missing {len(missing)} samples (e.g. {missing[:5]}); rerun with --shard_index {shard_index} --num_shards {num_shards}")
+    return incomplete
+
+
+def resolve_shard(args, total: int) -> range:
+    """
+    Indices this process should run, after validating the shard arguments.
+    """
+    if args.num_shards < 1:
+        raise ValueError("--num_shards must be at least 1")
+    indices = shard_range(total, args.num_shards, args.shard_index)
+    if args.num_shards > 1:
+        print(f"Shard {args.shard_index}/{args.num_shards}: samples {indices.start}-{indices.stop - 1} ({len(indices)} of {total})")
+    return indices
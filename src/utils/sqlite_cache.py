@@ -0,0 +1,102 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Optional
+
+
+class SqliteCache:
+    """
+    Key/blob store in a single SQLite file, shared across runs and processes.
+
+    WAL mode lets several processes read and write the same file concurrently; within a process a
+    lock serializes access so the connection can be used from worker threads. Entries older than
+    ``ttl_seconds`` are treated as misses, and once stored blobs exceed ``max_bytes`` the least
+    recently used ones are evicted.
+    """
+
+    TABLE = "entries"
+
+    def __init__(self, path: str, max_bytes: int = 20 * 1024**3, ttl_seconds: Optional[float] = None):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.TABLE} (key TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {self.TABLE}_last_access ON {self.TABLE} (last_access)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.TABLE}").fetchone()[0]
+
+    @staticmethod
+    def make_key(content_hash: str, **params) -> str:
+        """
+        Combine a content hash with the parameters that affect the stored value into a cache key.
+        """
+        suffix = ",".join(f"{k}={params[k]}" for k in sorted(params))
+        return hashlib.sha256(f"{content_hash}|{suffix}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._conn.execute(f"SELECT data, created FROM {self.TABLE} WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            if row is None or (self.ttl_seconds is not None and now - row[1] > self.ttl_seconds):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute(f"UPDATE {self.TABLE} SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key: str, data: bytes) -> None:
+        with self._lock:
+            previous = self._conn.execute(f"SELECT size FROM {self.TABLE} WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.TABLE} (key, data, size, created, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, sqlite3.Binary(data), len(data), now, now),
+            )
+            self._total_bytes += len(data) - (previous[0] if previous else 0)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        # Other processes may have written to the same file, so start from the real total.
+        self._total_bytes = self._conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.TABLE}").fetchone()[0]
+        if self.ttl_seconds is not None:
+            expired = self._conn.execute(f"DELETE FROM {self.TABLE} WHERE created < ?", (time.time() - self.ttl_seconds,)).rowcount
+            self.evictions += expired
+            self._total_bytes = self._conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.TABLE}").fetchone()[0]
+        # Trim to 90% of the budget so eviction doesn't run on every insert once full.
+        target = int(self.max_bytes * 0.9)
+        for key, size in self._conn.execute(f"SELECT key, size FROM {self.TABLE} ORDER BY last_access ASC").fetchall():
+            if self._total_bytes <= target:
+                break
+            self._conn.execute(f"DELETE FROM {self.TABLE} WHERE key = ?", (key,))
+            self._total_bytes -= size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "total_bytes": self._total_bytes,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,153 @@
+"""
+Early abort of streamed generations.
+
+A ``StreamGuard`` watches the deltas of a streamed chat completion and marks a choice as aborted
+once its reasoning runs past ``reasoning_budget`` tokens or one of its format checks fails. When
+every choice of the request is aborted the caller closes the stream; vLLM aborts a request whose
+client disconnected, so no further tokens are generated for it.
+
+Tokens are counted as stream deltas: vLLM sends one delta per decoding step. Reasoning is either
+``reasoning_content`` (server started with a reasoning parser) or the content up to ``</think>``.
+
+Format checks are given as ``name[:arg]`` specs, e.g. ``planning:300``. A check is built by a
+factory in ``FORMAT_CHECKS`` (or a ``module:function`` import path) and called with the reasoning
+text and token count so far; it returns None while undecided, True once satisfied, or a reason
+string when violated.
+"""
+
+import re
+import importlib
+from typing import Callable, Dict, Iterable, List, Optional, Union
+
+CheckResult = Union[None, bool, str]
+FormatCheck = Callable[[str, int], CheckResult]
+
+THINK_END = "</think>"
+
+
+def planning_check(within: str = "300") -> FormatCheck:
+    """
+    The ``think_first_v0.txt`` protocol: a Planning section must open within the first ``within`` reasoning tokens.
+    """
+    limit = int(within)
+    pattern = re.compile(r"\bplan(?:ning)?\b", re.IGNORECASE)
+
+    def check(text: str, tokens: int) -> CheckResult:
+        if pattern.search(text):
+            return True
+        if tokens >= limit:
+            return f"no Planning section within {limit} reasoning tokens"
+        return None
+
+    return check
+
+
+def repetition_check(window: str = "64") -> FormatCheck:
+    """
+    Abort a generation stuck in a loop: the last ``window`` characters of the reasoning occur at least four times in it.
+    """
+    size = int(window)
+
+    def check(text: str, tokens: int) -> CheckResult:
+        # Scanning the whole text on every token would be quadratic; every 16th token is soon enough
+        if tokens % 16 == 0 and len(text) >= 8 * size and text.count(text[-size:]) >= 4:
+            return f"repetition loop after {tokens} reasoning tokens"
+        return None
+
+    return check
+
+
+FORMAT_CHECKS: Dict[str, Callable[..., FormatCheck]] = {
+    "planning": planning_check,
+    "repetition": repetition_check,
+}
+
+
+def parse_format_check(spec: str) -> FormatCheck:
+    """
+    Build a check from ``name[:arg]``; names not in ``FORMAT_CHECKS`` are imported as ``module:function[:arg]``.
+    """
+    name, _, arg = spec.partition(":")
+    if name in FORMAT_CHECKS:
+        factory = FORMAT_CHECKS[name]
+    else:
+        function, _, arg = arg.partition(":")
+        if not function:
+            raise ValueError(f"Unknown format check {spec!r}; expected one of {sorted(FORMAT_CHECKS)} or module:function[:arg]")
+        factory = getattr(importlib.import_module(name), function)
+    return factory(arg) if arg else factory()
+
+
+class _ChoiceState:
+    def __init__(self, checks: List[FormatCheck]):
+        self.pending = list(checks)
+        self.reasoning = ""
+        self.reasoning_tokens = 0
+        self.separate_reasoning = False
+        self.reasoning_done = False
+        self.aborted: Optional[str] = None
+
+
+class StreamGuard:
+    """
+    Per-request abort state for ``n`` choices. ``checks`` are the format checks run on each choice.
+    Checks stop once a choice's reasoning ends; the answer itself is never cut off.
+    """
+
+    def __init__(self, reasoning_budget: Optional[int] = None, checks: Iterable[FormatCheck] = (), n: int = 1):
+        self.reasoning_budget = reasoning_budget
+        self.checks = list(checks)
+        self.states = [_ChoiceState(self.checks) for _ in range(n)]
+
+    def observe(self, index: int, reasoning: Optional[str], content: Optional[str]) -> None:
+        state = self.states[index]
+        if state.aborted or state.reasoning_done:
+            return
+        if reasoning:
+            state.separate_reasoning = True
+            piece = reasoning
+        elif content:
+            # The tag may be split across deltas, so look at the end of the text so far as well
+            if state.separate_reasoning or THINK_END in state.reasoning[-len(THINK_END) :] + content:
+                state.reasoning_done = True
+                return
+            piece = content
+        else:
+            return
+        state.reasoning += piece
+        state.reasoning_tokens += 1
+        if self.reasoning_budget is not None and state.reasoning_tokens > self.reasoning_budget:
+            state.aborted = f"reasoning budget of {self.reasoning_budget} tokens exceeded"
+            return
+        if state.pending:
+            still_pending = []
+            for check in state.pending:
+                result = check(state.reasoning, state.reasoning_tokens)
+                if isinstance(result, str):
+                    state.aborted = result
+                    return
+                if result is None:
+                    still_pending.append(check)
+            state.pending = still_pending
+
+    def aborted(self, index: int) -> Optional[str]:
+        return self.states[index].aborted
+
+    def reasoning_tokens(self, index: int) -> int:
+        return self.states[index].reasoning_tokens
+
+    @property
+    def stopped(self) -> bool:
+        """
+        True once every choice is aborted; the request can be cancelled.
+        """
+        return all(state.aborted for state in self.states)
+
+
+def build_guard(reasoning_budget: Optional[int], format_checks: Optional[Iterable[str]], n: int = 1) -> Optional[StreamGuard]:
+    """
+    A guard for one request from the CLI options, or None when neither a budget nor a check is set.
+    """
+    if reasoning_budget is None and not format_checks:
+        return None
+    return StreamGuard(reasoning_budget, [parse_format_check(spec) for spec in format_checks or ()], n)
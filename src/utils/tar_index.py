@@ -0,0 +1,193 @@
+"""
+Random-access reads from a tar archive that was split into parts (``cot_images_aa``, ``_ab``, ...).
+
+``build_tar_index`` scans the concatenated parts once and records where each member's data
+starts; ``TarArchiveReader`` then serves a member's bytes with ``os.pread`` straight from the
+parts, so the archive never has to be extracted.
+
+    python src/utils/tar_index.py data_viscot/cot_images_tar_split
+"""
+
+import os
+import sys
+import glob
+import bisect
+import tarfile
+import argparse
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_PARTS_PATTERN = "cot_images_*"
+INDEX_FILENAME = "cot_images.index.tsv"
+
+
+def find_parts(directory: str, pattern: str = DEFAULT_PARTS_PATTERN) -> List[str]:
+    # split(1) suffixes sort lexicographically in archive order
+    return sorted(glob.glob(os.path.join(directory, pattern)))
+
+
+def normalize_member_name(name: str) -> str:
+    return os.path.normpath(name).lstrip("/")
+
+
+class ConcatenatedParts:
+    """
+    Read-only, seekable file object over several files laid end to end.
+    """
+
+    def __init__(self, parts: List[str]):
+        self.parts = parts
+        self.sizes = [os.path.getsize(part) for part in parts]
+        self.starts = [sum(self.sizes[:i]) for i in range(len(parts))]
+        self.size = sum(self.sizes)
+        self.position = 0
+        self._fds: Dict[int, int] = {}
+        self._pid = os.getpid()
+
+    def _fd(self, part_index: int) -> int:
+        # Descriptors are not shared with forked workers; each process opens its own
+        if self._pid != os.getpid():
+            self._fds, self._pid = {}, os.getpid()
+        if part_index not in self._fds:
+            self._fds[part_index] = os.open(self.parts[part_index], os.O_RDONLY)
+        return self._fds[part_index]
+
+    def pread(self, size: int, offset: int) -> bytes:
+        """
+        Read ``size`` bytes at a virtual ``offset``, crossing part boundaries as needed.
+        """
+        chunks = []
+        part_index = bisect.bisect_right(self.starts, offset) - 1
+        while size > 0 and part_index < len(self.parts):
+            local = offset - self.starts[part_index]
+            chunk = os.pread(self._fd(part_index), min(size, self.sizes[part_index] - local), local)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+            offset += len(chunk)
+            part_index = bisect.bisect_right(self.starts, offset) - 1
+        return b"".join(chunks)
+
+    # Minimal file protocol for tarfile
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self.size - self.position
+        data = self.pread(size, self.position)
+        self.position += len(data)
+        return data
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.position, os.SEEK_END: self.size}[whence]
+        self.position = base + offset
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def close(self) -> None:
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_fds"] = {}
+        return state
+
+
+def build_tar_index(parts: List[str], index_path: str) -> int:
+    """
+    Write ``name<TAB>data_offset<TAB>size`` for every regular file in the archive formed by
+    ``parts``. Only headers are read; member data is skipped with seeks. Returns the member count.
+    """
+    stream = ConcatenatedParts(parts)
+    count = 0
+    tmp_path = index_path + ".tmp"
+    with tarfile.open(fileobj=stream, mode="r:") as archive, open(tmp_path, "w") as f:
+        while (member := archive.next()) is not None:
+            if member.isfile():
+                f.write(f"{normalize_member_name(member.name)}\t{member.offset_data}\t{member.size}\n")
+                count += 1
+                if count % 100_000 == 0:
+                    print(f"Indexed {count} members ({stream.tell() / 1024**3:.1f} / {stream.size / 1024**3:.1f} GiB)")
+            # tarfile keeps every member it has seen; the index is all we need
+            archive.members = []
+    stream.close()
+    os.replace(tmp_path, index_path)
+    return count
+
+
+class TarArchiveReader:
+    """
+    Serve member bytes by path from split tar parts using a prebuilt index.
+
+    Paths may be given relative to the archive root or prefixed with the directory holding the
+    parts, i.e. the path the member would have after extraction. Pickling keeps only file names;
+    the index and file descriptors are loaded lazily in each process, so one reader can be used
+    from ``datasets.map(num_proc=...)`` workers.
+    """
+
+    def __init__(self, directory: str, parts: Optional[List[str]] = None, index_path: Optional[str] = None):
+        self.directory = os.path.normpath(directory)
+        self.parts = parts or find_parts(directory)
+        self.index_path = index_path or os.path.join(directory, INDEX_FILENAME)
+        self._stream: Optional[ConcatenatedParts] = None
+        self._index: Optional[Dict[str, Tuple[int, int]]] = None
+
+    @classmethod
+    def available(cls, directory: str) -> bool:
+        return os.path.exists(os.path.join(directory, INDEX_FILENAME)) and bool(find_parts(directory))
+
+    def _load(self) -> None:
+        index = {}
+        with open(self.index_path, "r") as f:
+            for line in f:
+                name, offset, size = line.rstrip("\n").rsplit("\t", 2)
+                index[name] = (int(offset), int(size))
+        self._index = index
+        self._stream = ConcatenatedParts(self.parts)
+
+    def _member_name(self, path: str) -> str:
+        path = os.path.normpath(path)
+        if path.startswith(self.directory + os.sep):
+            path = path[len(self.directory) + 1 :]
+        return normalize_member_name(path)
+
+    def __contains__(self, path: str) -> bool:
+        if self._index is None:
+            self._load()
+        return self._member_name(path) in self._index
+
+    def read(self, path: str) -> bytes:
+        if self._index is None:
+            self._load()
+        name = self._member_name(path)
+        if name not in self._index:
+            raise FileNotFoundError(f"{path} is not in {self.index_path}")
+        offset, size = self._index[name]
+        data = self._stream.pread(size, offset)
+        if len(data) != size:
+            raise IOError(f"Short read for {name}: expected {size} bytes, got {len(data)}")
+        return data
+
+    def close(self) -> None:
+        if self._stream is not None:
+            self._stream.close()
+
+    def __getstate__(self):
+        return {"directory": self.directory, "parts": self.parts, "index_path": self.index_path, "_stream": None, "_index": None}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index the members of a split tar archive for random access.")
+    parser.add_argument("directory", type=str, help="Directory holding the archive parts.")
+    parser.add_argument("--pattern", type=str, default=DEFAULT_PARTS_PATTERN, help="Glob matching the parts, in archive order when sorted.")
+    parser.add_argument("--index_path", type=str, default=None, help=f"Where to write the index (default: <directory>/{INDEX_FILENAME}).")
+    args = parser.parse_args()
+
+    parts = find_parts(args.directory, args.pattern)
+    if not parts:
+        sys.exit(f"No parts matching {args.pattern} in {args.directory}")
+    index_path = args.index_path or os.path.join(args.directory, INDEX_FILENAME)
+    print(f"Indexing {len(parts)} parts into {index_path}")
+    print(f"Indexed {build_tar_index(parts, index_path)} members")
@@ -0,0 +1,268 @@
+"""
+Per-request latency and token telemetry.
+
+Every API request can be recorded with its queue wait (time from picking up the sample to sending
+the request: preprocessing plus rate-limiter waits), time to first token when streamed, total
+latency, prompt/completion/reasoning tokens and image bytes sent. Records are appended to a JSONL
+sidecar, aggregated for an end-of-run summary (p50/p95/p99, tokens/s, cost per 1k samples per
+model) and optionally exposed in Prometheus text format.
+"""
+
+import os
+import json
+import time
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+# USD per 1M (input, output) tokens at list price; self-hosted models have no entry.
+# Override or extend with MODEL_PRICES='{"model": [input, output]}'.
+MODEL_PRICES = {
+    "gpt-4.1-nano-2025-04-14": (0.10, 0.40),
+    "gemini-3-flash-preview": (0.50, 3.00),
+}
+MODEL_PRICES.update({model: tuple(prices) for model, prices in json.loads(os.getenv("MODEL_PRICES", "{}")).items()})
+
+QUANTILES = (0.5, 0.95, 0.99)
+# The sidecar is written through a buffer and flushed at most this often, on report() and on close()
+FLUSH_INTERVAL = 10.0
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def openai_usage(usage) -> dict:
+    """
+    Token counts from an OpenAI-style ``usage`` object (None-safe).
+    """
+    if usage is None:
+        return {}
+    details = getattr(usage, "completion_tokens_details", None)
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "reasoning_tokens": getattr(details, "reasoning_tokens", None) if details else None,
+    }
+
+
+def gemini_usage(usage) -> dict:
+    """
+    Token counts from a Gemini ``usage_metadata`` object (None-safe).
+    """
+    if usage is None:
+        return {}
+    return {
+        "prompt_tokens": usage.prompt_token_count,
+        "completion_tokens": usage.candidates_token_count,
+        "reasoning_tokens": usage.thoughts_token_count,
+    }
+
+
+async def stream_chat_completion(client, guard=None, **request):
+    """
+    Streamed ``chat.completions.create``. Returns ``(contents, usage, ttft_s)`` with one content string
+    per choice in index order; ``ttft_s`` is measured to the first content or reasoning delta.
+
+    Deltas are fed to ``guard`` (a ``utils.stream_guard.StreamGuard``); once it has aborted every
+    choice the stream is closed, which makes the server abort the request. ``usage`` is then None.
+    """
+    start = time.monotonic()
+    ttft = None
+    usage = None
+    pieces = defaultdict(list)
+    stream = await client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **request)
+    try:
+        async for chunk in stream:
+            if chunk.usage:
+                usage = chunk.usage
+            for choice in chunk.choices:
+                delta = choice.delta
+                reasoning = getattr(delta, "reasoning_content", None)
+                if ttft is None and (delta.content or reasoning):
+                    ttft = time.monotonic() - start
+                if delta.content:
+                    pieces[choice.index].append(delta.content)
+                if guard is not None:
+                    guard.observe(choice.index, reasoning, delta.content)
+            if guard is not None and guard.stopped:
+                break
+    finally:
+        await stream.close()
+    contents = ["".join(pieces[i]) for i in range(request.get("n") or 1)]
+    return contents, usage, ttft
+
+
+class _Series:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.aborted = 0
+        self.samples = set()
+        self.latency: List[float] = []
+        self.ttft: List[float] = []
+        self.queue_wait: List[float] = []
+        self.tokens = defaultdict(int)
+        self.image_bytes = 0
+
+
+class Telemetry:
+    """
+    Collects request records; ``path`` is the JSONL sidecar and ``prometheus_port`` serves ``/metrics``.
+    Sidecar lines are buffered and flushed every ``FLUSH_INTERVAL`` seconds rather than per request.
+    """
+
+    def __init__(self, path: Optional[str] = None, prometheus_port: Optional[int] = None):
+        self.path = path
+        self.started = time.monotonic()
+        self.series: Dict[tuple, _Series] = defaultdict(_Series)
+        self._lock = threading.Lock()
+        self._file = open(path, "a", buffering=1024**2) if path else None
+        self._last_flush = time.monotonic()
+        self._server = None
+        if prometheus_port:
+            self._server = ThreadingHTTPServer(("0.0.0.0", prometheus_port), self._make_handler())
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+            print(f"Serving Prometheus metrics on :{prometheus_port}/metrics")
+
+    def record(self, stage: str, model: str, sample_id=None, queue_wait_s=None, ttft_s=None, latency_s=None, image_bytes=0, error=None, aborted=None, **tokens) -> None:
+        """
+        Record one request. ``tokens`` takes ``prompt_tokens``, ``completion_tokens`` and ``reasoning_tokens``.
+        ``aborted`` is the reason a streamed generation was cut off early.
+        """
+        entry = {"time": time.time(), "stage": stage, "model": model, "sample_id": sample_id, "queue_wait_s": queue_wait_s, "ttft_s": ttft_s, "latency_s": latency_s, "image_bytes": image_bytes}
+        entry.update(tokens)
+        if error is not None:
+            entry["error"] = str(error)
+        if aborted is not None:
+            entry["aborted"] = aborted
+        with self._lock:
+            series = self.series[(stage, model)]
+            series.requests += 1
+            if error is not None:
+                series.errors += 1
+            else:
+                series.aborted += 1 if aborted is not None else 0
+                series.samples.add(sample_id)
+                if latency_s is not None:
+                    series.latency.append(latency_s)
+                if ttft_s is not None:
+                    series.ttft.append(ttft_s)
+                for kind, count in tokens.items():
+                    series.tokens[kind] += count or 0
+            if queue_wait_s is not None:
+                series.queue_wait.append(queue_wait_s)
+            series.image_bytes += image_bytes or 0
+            if self._file:
+                self._file.write(json.dumps(entry) + "\n")
+                if time.monotonic() - self._last_flush >= FLUSH_INTERVAL:
+                    self._flush()
+
+    def _flush(self) -> None:
+        self._file.flush()
+        self._last_flush = time.monotonic()
+
+    def summary(self) -> List[dict]:
+        elapsed = time.monotonic() - self.started
+        rows = []
+        with self._lock:
+            for (stage, model), series in sorted(self.series.items()):
+                row = {"stage": stage, "model": model, "requests": series.requests, "errors": series.errors, "aborted": series.aborted}
+                for name, values in (("latency", series.latency), ("ttft", series.ttft), ("queue_wait", series.queue_wait)):
+                    for q in QUANTILES:
+                        row[f"{name}_p{int(q * 100)}"] = percentile(values, q)
+                row["completion_tokens_per_s"] = series.tokens["completion_tokens"] / elapsed if elapsed else 0.0
+                row["image_mb"] = series.image_bytes / 1024**2
+                prices = MODEL_PRICES.get(model)
+                samples = len(series.samples) or series.requests
+                if prices and samples:
+                    cost = (series.tokens["prompt_tokens"] * prices[0] + series.tokens["completion_tokens"] * prices[1]) / 1e6
+                    row["cost_per_1k_samples"] = cost / samples * 1000
+                rows.append(row)
+        return rows
+
+    def report(self) -> None:
+        def fmt(value):
+            return "-" if value is None else f"{value:.2f}s"
+
+        with self._lock:
+            if self._file:
+                self._flush()
+
+        for row in self.summary():
+            cost = row.get("cost_per_1k_samples")
+            print(
+                f"[{row['stage']}] {row['model']}: {row['requests']} requests ({row['errors']} errors, {row['aborted']} aborted), "
+                f"latency p50/p95/p99 {fmt(row['latency_p50'])}/{fmt(row['latency_p95'])}/{fmt(row['latency_p99'])}, "
+                f"ttft p50/p95/p99 {fmt(row['ttft_p50'])}/{fmt(row['ttft_p95'])}/{fmt(row['ttft_p99'])}, "
+                f"queue wait p50/p95 {fmt(row['queue_wait_p50'])}/{fmt(row['queue_wait_p95'])}, "
+                f"{row['completion_tokens_per_s']:.1f} completion tok/s, {row['image_mb']:.1f} MB images, "
+                f"{'cost n/a' if cost is None else f'${cost:.3f} per 1k samples'}"
+            )
+
+    def prometheus_text(self) -> str:
+        lines = []
+        with self._lock:
+            items = sorted(self.series.items())
+            for (stage, model), series in items:
+                labels = f'stage="{stage}",model="{model}"'
+                lines.append(f"llm_requests_total{{{labels}}} {series.requests}")
+                lines.append(f"llm_request_errors_total{{{labels}}} {series.errors}")
+                lines.append(f"llm_requests_aborted_total{{{labels}}} {series.aborted}")
+                lines.append(f"llm_image_bytes_total{{{labels}}} {series.image_bytes}")
+                for kind, count in sorted(series.tokens.items()):
+                    lines.append(f'llm_tokens_total{{{labels},kind="{kind.replace("_tokens", "")}"}} {count}')
+                for name, values in (("latency", series.latency), ("ttft", series.ttft), ("queue_wait", series.queue_wait)):
+                    for q in QUANTILES:
+                        value = percentile(values, q)
+                        if value is not None:
+                            lines.append(f'llm_{name}_seconds{{{labels},quantile="{q}"}} {value}')
+                    lines.append(f"llm_{name}_seconds_sum{{{labels}}} {sum(values)}")
+                    lines.append(f"llm_{name}_seconds_count{{{labels}}} {len(values)}")
+        return "\n".join(lines) + "\n"
+
+    def _make_handler(self):
+        telemetry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = telemetry.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def close(self) -> None:
+        if self._server:
+            self._server.shutdown()
+        with self._lock:
+            if self._file:
+                # close() flushes what is still buffered
+                self._file.close()
+                self._file = None
+
+
+def metrics_path(output_file: str) -> str:
+    return output_file + ".metrics.jsonl"
+
+
+def open_telemetry(output_file: str, enabled: bool = True, prometheus_port: Optional[int] = None) -> Optional[Telemetry]:
+    """
+    Telemetry writing to ``metrics_path(output_file)``, or None unless enabled (a port implies enabled).
+    """
+    if not (enabled or prometheus_port):
+        return None
+    return Telemetry(metrics_path(output_file), prometheus_port=prometheus_port)